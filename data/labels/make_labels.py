@@ -1,23 +1,121 @@
+"""Generate the label glyphs drawn by draw_detections.
+
+Glyphs for the printable ASCII characters are rendered at 8 sizes in a
+process pool and packed into labels.atlas, which load_alphabet maps in
+one go instead of decoding 760 PNGs. The individual PNGs it falls back to
+can be written as well:
+
+    python make_labels.py --font /path/to/futura.ttf --png
+    python make_labels.py --pack        # pack the existing PNGs
+
+Atlas layout, little endian: a header of 8 uint32 (magic "DNLA", version,
+number of sizes, first and last (exclusive) character, channels and two
+reserved words), one (int32 w, int32 h, uint64 offset) entry per size and
+character, then every glyph as float32 CHW data at its offset.
+"""
+from __future__ import division
+import argparse
+import multiprocessing
 import os
-import string
-import pipes
-
-font = 'futura-normal'
-
-def make_labels(s):
-    l = string.printable
-    for word in l:
-        if word == ' ':
-            os.system('convert -fill black -background white -bordercolor white -font %s -pointsize %d label:"\ " 32_%d.png'%(font,s,s/12-1))
-        if word == '@':
-            os.system('convert -fill black -background white -bordercolor white -font %s -pointsize %d label:"\@" 64_%d.png'%(font,s,s/12-1))
-        elif word == '\\':
-            os.system('convert -fill black -background white -bordercolor white -font %s -pointsize %d label:"\\\\\\\\" 92_%d.png'%(font,s,s/12-1))
-        elif ord(word) in [9,10,11,12,13,14]:
-            pass
-        else:
-            os.system("convert -fill black -background white -bordercolor white -font %s -pointsize %d label:%s \"%d_%d.png\""%(font,s,pipes.quote(word), ord(word),s/12-1))
-
-for i in [12,24,36,48,60,72,84,96]:
-    make_labels(i)
+import struct
+
+import numpy
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # only needed to render or pack glyphs
+    Image = None
+
+SIZES = [12, 24, 36, 48, 60, 72, 84, 96]
+FIRST = 32
+LAST = 127
+CHANNELS = 3
+MAGIC = 0x414c4e44
+VERSION = 1
+ALIGNMENT = 16
+
+HEADER = struct.Struct('<8I')
+ENTRY = struct.Struct('<iiQ')
+
+root = os.path.dirname(os.path.abspath(__file__))
+
+
+def png_name(char, size_index):
+    return os.path.join(root, '%d_%d.png' % (char, size_index))
+
+
+def to_chw(im):
+    """Convert a PIL image into a float32 CHW array in [0, 1] as load_image_color does."""
+    a = numpy.asarray(im.convert('RGB'), dtype=numpy.float32) / 255
+    return numpy.ascontiguousarray(a.transpose(2, 0, 1))
+
+
+def render_glyph(job):
+    """Render one black on white glyph, the line height is the same for all characters of a size."""
+    char, size_index, font_path, write_png = job
+    font = ImageFont.truetype(font_path, SIZES[size_index])
+    ascent, descent = font.getmetrics()
+    text = chr(char)
+    width = max(int(round(font.getlength(text))), 1)
+    im = Image.new('RGB', (width, ascent + descent), 'white')
+    ImageDraw.Draw(im).text((0, 0), text, font=font, fill='black')
+    if write_png:
+        im.save(png_name(char, size_index))
+    return char, size_index, to_chw(im)
+
+
+def load_glyph(job):
+    char, size_index = job[:2]
+    return char, size_index, to_chw(Image.open(png_name(char, size_index)))
+
+
+def write_atlas(path, glyphs, nsize=len(SIZES), first=FIRST, last=LAST):
+    """Write glyphs, a dict of (char, size index) -> float32 CHW array, as an atlas."""
+    count = nsize * (last - first)
+    offset = HEADER.size + count * ENTRY.size
+    entries = []
+    for size_index in range(nsize):
+        for char in range(first, last):
+            g = glyphs[char, size_index]
+            offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+            entries.append((g, offset))
+            offset += g.nbytes
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, nsize, first, last, CHANNELS, 0, 0))
+        for g, offset in entries:
+            f.write(ENTRY.pack(g.shape[2], g.shape[1], offset))
+        for g, offset in entries:
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(numpy.ascontiguousarray(g, dtype='<f4').tobytes())
+    # Readers never see a partially written atlas
+    os.rename(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the label glyph atlas.')
+    parser.add_argument('--font', help='TrueType font to render the glyphs with')
+    parser.add_argument('--pack', action='store_true', help='pack the existing PNGs instead of rendering')
+    parser.add_argument('--png', action='store_true', help='also write the individual PNGs')
+    parser.add_argument('--output', default=os.path.join(root, 'labels.atlas'))
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes, all CPUs by default')
+    args = parser.parse_args()
+    if Image is None:
+        parser.error('PIL is required')
+    if not args.pack and not args.font:
+        parser.error('--font is required unless --pack is given')
+
+    jobs = [(char, size_index, args.font, args.png)
+            for size_index in range(len(SIZES)) for char in range(FIRST, LAST)]
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        work = load_glyph if args.pack else render_glyph
+        glyphs = dict(((char, size_index), g) for char, size_index, g in pool.imap_unordered(work, jobs, 16))
+    finally:
+        pool.close()
+        pool.join()
+    write_atlas(args.output, glyphs)
+
 
+if __name__ == '__main__':
+    main()
@@ -189,6 +189,13 @@ void partial(char *cfgfile, char *weightfile, char *outfile, int max)
     save_weights_upto(net, outfile, max);
 }
 
+void map_weights(char *cfgfile, char *weightfile, char *outfile)
+{
+    gpu_index = -1;
+    network *net = load_network(cfgfile, weightfile, 0);
+    save_weights_mapped(net, outfile);
+}
+
 void rescale_net(char *cfgfile, char *weightfile, char *outfile)
 {
     gpu_index = -1;
@@ -472,6 +479,8 @@ int main(int argc, char **argv)
         oneoff2(argv[2], argv[3], argv[4], atoi(argv[5]));
     } else if (0 == strcmp(argv[1], "partial")){
         partial(argv[2], argv[3], argv[4], atoi(argv[5]));
+    } else if (0 == strcmp(argv[1], "mapweights")){
+        map_weights(argv[2], argv[3], argv[4]);
     } else if (0 == strcmp(argv[1], "average")){
         average(argc, argv);
     } else if (0 == strcmp(argv[1], "visualize")){
@@ -37,15 +37,24 @@ void train_detector(char *datacfg, char *cfgfile, char *weightfile, int *gpus, i
     int classes = l.classes;
     float jitter = l.jitter;
 
-    list *plist = get_paths(train_images);
-    //int N = plist->size;
-    char **paths = (char **)list_to_array(plist);
-
     load_args args = get_base_args(net);
+    /* Packed shards replace the image list and its label files */
+    char *train_shards = option_find_str(options, "shards", 0);
+    list *plist = 0;
+    char **paths = 0;
+    if(train_shards){
+        args.shards = load_shards(train_shards);
+        args.m = shards_size(args.shards);
+    } else {
+        plist = get_paths(train_images);
+        //int N = plist->size;
+        paths = (char **)list_to_array(plist);
+        args.m = plist->size;
+    }
+
     args.coords = l.coords;
     args.paths = paths;
     args.n = imgs;
-    args.m = plist->size;
     args.classes = classes;
     args.jitter = jitter;
     args.num_boxes = l.max_boxes;
@@ -471,6 +471,10 @@ typedef struct network{
     int index;
     float *cost;
 
+    /* weights mapped by load_weights from a file written by save_weights_mapped */
+    void *weights_map;
+    size_t weights_map_size;
+
 #ifdef GPU
     float *input_gpu;
     float *truth_gpu;
@@ -497,6 +501,39 @@ typedef struct {
     float *data;
 } image;
 
+/* Interleaved 8 bit frame as delivered by decoders, rows may be padded */
+typedef struct{
+    unsigned char *data;
+    int w;
+    int h;
+    int c;
+    int bytes_per_line;
+} frame_data;
+
+/* Planar YUV 4:2:0 frame, I420 has separate u and v planes with
+ * uv_step 1, NV12 interleaves them: v = u + 1 and uv_step 2 */
+typedef struct{
+    unsigned char *y;
+    unsigned char *u;
+    unsigned char *v;
+    int y_stride;
+    int uv_stride;
+    int uv_step;
+    int w;
+    int h;
+    int bt709;
+} yuv_frame;
+
+/* Placement of a letterboxed frame in the network input: frame pixel
+ * (x, y) lands on (dx + x*scale, dy + y*scale) */
+typedef struct{
+    float scale;
+    int dx;
+    int dy;
+    int w;
+    int h;
+} letterbox_geometry;
+
 typedef struct{
     float x, y, w, h;
 } box;
@@ -520,9 +557,13 @@ typedef enum {
     CLASSIFICATION_DATA, DETECTION_DATA, CAPTCHA_DATA, REGION_DATA, IMAGE_DATA, COMPARE_DATA, WRITING_DATA, SWAG_DATA, TAG_DATA, OLD_CLASSIFICATION_DATA, STUDY_DATA, DET_DATA, SUPER_DATA, LETTERBOX_DATA, REGRESSION_DATA, SEGMENTATION_DATA, INSTANCE_DATA
 } data_type;
 
+/* Memory mapped training shards of python/shardpack.py */
+typedef struct shard_set shard_set;
+
 typedef struct load_args{
     int threads;
     char **paths;
+    shard_set *shards;
     char *path;
     int n;
     int m;
@@ -561,6 +602,7 @@ typedef struct{
 
 
 network *load_network(const char *cfg, const char *weights, int clear);
+network *load_network_batch(const char *cfg, const char *weights, int clear, int batch);
 load_args get_base_args(network *net);
 
 void free_data(data d);
@@ -650,10 +692,13 @@ char *option_find_str(list *l, char *key, char *def);
 int option_find_int(list *l, char *key, int def);
 
 network *parse_network_cfg(const char *filename);
+network *parse_network_cfg_batch(const char *filename, int batch);
 void save_weights(network *net, const char *filename);
 void load_weights(network *net, const char *filename);
 void save_weights_upto(network *net, const char *filename, int cutoff);
 void load_weights_upto(network *net, const char *filename, int start, int cutoff);
+void save_weights_mapped(network *net, const char *filename);
+void free_mapped_weights(network *net);
 
 void zero_objectness(layer l);
 void get_region_boxes(layer l, int w, int h, int netw, int neth, float thresh, float **probs, box *boxes, float **masks, int only_objectness, int *map, float tree_thresh, int relative);
@@ -662,9 +707,15 @@ void set_batch_network(network *net, int b);
 void set_temp_network(network *net, float t);
 image load_image(const char *filename, int w, int h, int c);
 image load_image_color(const char *filename, int w, int h);
+image load_image_memory(const unsigned char *buf, int len, int channels);
 image make_image(int w, int h, int c);
 image resize_image(image im, int w, int h);
 image letterbox_image(image im, int w, int h);
+void yuv_into_image(yuv_frame f, image im);
+void image_into_yuv(image im, yuv_frame f);
+letterbox_geometry letterbox_yuv_into(yuv_frame f, image boxed);
+letterbox_geometry letterbox_data_into(const unsigned char *data, int width, int height, int bytes_per_pixel, int bytes_per_line, int swap_rb, image boxed);
+void resize_data_into(const unsigned char *data, int width, int height, int bytes_per_pixel, int bytes_per_line, int swap_rb, image out);
 image crop_image(image im, int dx, int dy, int w, int h);
 image resize_min(image im, int min);
 image resize_max(image im, int max);
@@ -711,12 +762,16 @@ float *network_predict(network *net, float *input);
 
 int network_width(network *net);
 int network_height(network *net);
+int network_batch(network *net);
+int network_inputs(network *net);
+int network_outputs(network *net);
 float *network_predict_image(network *net, image im);
 void network_detect(network *net, image im, float thresh, float hier_thresh, float nms, box *boxes, float **probs);
 int num_boxes(network *net);
 box *make_boxes(network *net);
 void free_boxes(box *boxes);
 void reset_network_state(network *net, int b);
+void reorder_network_state(network *net, const int *rows, int n);
 
 char **get_labels(const char *filename);
 char **get_labels_size(const char *filename, int *size);
@@ -735,6 +790,9 @@ float train_network(network *net, data d);
 pthread_t load_data_in_thread(load_args args);
 void load_data_blocking(load_args args);
 list *get_paths(const char *filename);
+shard_set *load_shards(const char *filename);
+void free_shards(shard_set *set);
+int shards_size(shard_set *set);
 void hierarchy_predictions(float *predictions, int n, tree *hier, int only_leaves, int stride);
 void change_leaves(tree *t, char *leaf_list);
 
@@ -745,6 +803,7 @@ char *find_char_arg(int argc, char **argv, char *arg, char *def);
 char *basecfg(char *cfgfile);
 void find_replace(char *str, char *orig, char *rep, char *output);
 void free_ptrs(void **ptrs, int n);
+void set_num_threads(int n);
 char *fgetl(FILE *fp);
 void strip(char *s);
 float sec(clock_t clocks);
@@ -783,6 +842,50 @@ void detector_demo_process_file(detector_demo *det,
 void detector_demo_process_image(detector_demo *det,
                                  image in);
 
+typedef struct{
+    int class_id;
+    float prob;
+    box bbox;
+} detection_result;
+
+int detector_demo_detect(detector_demo *det,
+                         image im,
+                         int draw);
+int detector_demo_detect_batch(detector_demo *det,
+                               image *ims,
+                               int n,
+                               int draw,
+                               int *counts);
+int detector_demo_detect_frames(detector_demo *det,
+                                frame_data *frames,
+                                int n,
+                                int swap_rb,
+                                int *counts);
+int detector_demo_detect_yuv(detector_demo *det,
+                             yuv_frame *frames,
+                             int n,
+                             int *counts);
+void detector_demo_set_batch(detector_demo *det, int batch);
+int detector_demo_get_batch(detector_demo *det);
+network *detector_demo_get_network(detector_demo *det);
+int detector_demo_get_detections(detector_demo *det,
+                                 detection_result *dets,
+                                 int max_dets);
+void detector_demo_draw(detector_demo *det,
+                        image im,
+                        detection_result *dets,
+                        int n);
+
+/* Seconds spent in each stage of the last detect call */
+typedef struct{
+    double letterbox;
+    double forward;
+    double nms;
+    double draw;
+} detector_demo_timings;
+
+detector_demo_timings detector_demo_get_timings(detector_demo *det);
+
 void free_detector_demo(detector_demo * det);
 
 #endif
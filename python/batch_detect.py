@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""Detect objects in large sets of images, e.g. to backfill archives.
+
+Inputs are directories, glob patterns or manifests listing one image path
+per line, like the train.txt lists of scripts/voc_label.py:
+
+    python python/batch_detect.py images/ -o out
+    python python/batch_detect.py 'archive/2017-*/*.jpg' --format npz --draw -o out
+    python python/batch_detect.py train.txt 2007_test.txt -o out --batch 16
+
+Files are read and decoded by a pool of workers ahead of the network, which
+detects on batches of images, while writer threads store the results, so
+disk, decoding, inference and encoding overlap. Detections go to
+out/detections.jsonl, one record per image, or with --format npz to one
+.npz per image under out/npz; --draw also saves annotated images under
+out/images. Images with results in the output are skipped, so an
+interrupted run continues where it stopped.
+"""
+from __future__ import print_function, division
+import argparse
+import collections
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+import darknet
+from darknet import c_str
+from prefetch import decode_ahead
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tga', '.gif', '.ppm', '.pgm')
+# Seconds between syncs of the JSON lines output, a killed run loses at most these records
+JSONL_SYNC_INTERVAL = 5.0
+
+
+def _is_image(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_inputs(sources, recursive=False):
+    """Yield the image paths of directories, glob patterns and manifest files."""
+    for source in sources:
+        if os.path.isdir(source):
+            for dirname, dirnames, filenames in os.walk(source):
+                if recursive:
+                    dirnames.sort()
+                else:
+                    del dirnames[:]
+                for filename in sorted(filenames):
+                    if _is_image(filename):
+                        yield os.path.join(dirname, filename)
+        elif os.path.isfile(source) and not _is_image(source):
+            with open(source) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield line
+        elif os.path.isfile(source):
+            yield source
+        else:
+            matches = sorted(glob.glob(source))
+            if not matches:
+                logger.warning('No images match %s', source)
+            for path in matches:
+                if _is_image(path):
+                    yield path
+
+
+def _makedirs(dirname):
+    """Create dirname unless it exists, writer threads may race to create it."""
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+
+
+def output_key(path, root):
+    """Name of the outputs of path, relative to root if it is inside it."""
+    path = os.path.abspath(path)
+    rel = os.path.relpath(path, root)
+    if rel.startswith(os.pardir):
+        rel = path.lstrip(os.sep)
+    return os.path.splitext(rel)[0]
+
+
+class JsonlOutput(object):
+    """Detections of all images appended to one JSON lines file.
+
+    Records are synced to disk every JSONL_SYNC_INTERVAL seconds.
+    """
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, 'detections.jsonl')
+        self._done = set()
+        if os.path.exists(self.path):
+            self._recover()
+        self._file = open(self.path, 'a')
+        self._lock = threading.Lock()
+        self._synced = time.time()
+
+    def _recover(self):
+        """Read the images finished by an earlier run, dropping a partly written last line."""
+        valid = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    self._done.add(json.loads(line.decode('utf-8'))['path'])
+                except (ValueError, KeyError):
+                    break
+                valid += len(line)
+        if valid != os.path.getsize(self.path):
+            logger.warning('Truncating %s after %i complete bytes', self.path, valid)
+            with open(self.path, 'ab') as f:
+                f.truncate(valid)
+
+    def done(self, path, key):
+        with self._lock:
+            return path in self._done
+
+    def write(self, path, key, width, height, dets, names):
+        record = {'path': path, 'width': width, 'height': height,
+                  'detections': darknet.detections_to_list(dets, names)}
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._done.add(path)
+            if time.time() - self._synced >= JSONL_SYNC_INTERVAL:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = time.time()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+
+class NpzOutput(object):
+    """Detections of every image in its own .npz of DETECTION_DTYPE records."""
+
+    def __init__(self, out_dir):
+        self.out_dir = os.path.join(out_dir, 'npz')
+
+    def _path(self, key):
+        return os.path.join(self.out_dir, key + '.npz')
+
+    def done(self, path, key):
+        return os.path.exists(self._path(key))
+
+    def write(self, path, key, width, height, dets, names):
+        out = self._path(key)
+        _makedirs(os.path.dirname(out))
+        # Renamed into place, so an interrupted write is not taken for a result
+        tmp = out + '.tmp'
+        with open(tmp, 'wb') as f:
+            numpy.savez(f, detections=dets, width=width, height=height, path=path)
+        os.rename(tmp, out)
+
+    def close(self):
+        pass
+
+
+OUTPUTS = {'jsonl': JsonlOutput, 'npz': NpzOutput}
+
+
+class BatchDetector(object):
+    """Decode, detect and write pipeline of batch_detect."""
+
+    def __init__(self, args):
+        self.args = args
+        self.root = os.path.abspath(args.root)
+        self.output = OUTPUTS[args.format](args.out_dir)
+        self.images_dir = os.path.join(args.out_dir, 'images') if args.draw else None
+        self.det = darknet.make_detector_demo(c_str(args.data), c_str(args.cfg), c_str(args.weights),
+                                              args.thresh, args.hier_thresh)
+        darknet.detector_demo_set_batch(self.det, args.batch)
+        self.names = darknet.metadata_names(darknet.load_meta(c_str(args.data)))
+        self.decoders = ThreadPoolExecutor(args.workers)
+        self.writers = ThreadPoolExecutor(args.writers)
+        self.stats = collections.Counter()
+
+    def _image_done(self, key):
+        base = os.path.join(self.images_dir, key)
+        return os.path.exists(base + '.jpg') or os.path.exists(base + '.png')
+
+    def done(self, path, key):
+        return self.output.done(path, key) and (self.images_dir is None or self._image_done(key))
+
+    @staticmethod
+    def decode(path):
+        """Read and decode one file, returns an IMAGE or None if it is broken."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        im = darknet.load_image_memory(data, len(data), 3)
+        return im if im.data else None
+
+    def write(self, path, key, im, dets):
+        try:
+            # Images only missing their annotated file keep their first record
+            if not self.output.done(path, key):
+                self.output.write(path, key, im.w, im.h, dets, self.names)
+            if self.images_dir is not None:
+                out = os.path.join(self.images_dir, key)
+                _makedirs(os.path.dirname(out))
+                darknet.save_image(im, c_str(out))
+        finally:
+            darknet.free_image(im)
+
+    def _detect(self, batch, writes):
+        ims = [im for _, _, im in batch]
+        results = darknet.demo_detect_batch(self.det, ims, draw=self.images_dir is not None)
+        for (path, key, im), dets in zip(batch, results):
+            writes.append(self.writers.submit(self.write, path, key, im, dets))
+        self.stats['detected'] += len(batch)
+
+    def _collect(self, writes, limit):
+        """Wait for finished writes until at most limit are in flight."""
+        while writes and (len(writes) > limit or writes[0].done()):
+            try:
+                writes.popleft().result()
+            except (IOError, OSError) as e:
+                self.stats['write_errors'] += 1
+                logger.error('Cannot write results: %s', e)
+
+    def _pending(self, paths):
+        """Yield the paths whose results are not in the output yet."""
+        for path in paths:
+            if self.done(path, output_key(path, self.root)):
+                self.stats['skipped'] += 1
+            else:
+                yield path
+
+    def run(self, paths):
+        args = self.args
+        writes = collections.deque()
+        batch = []
+        start = last_report = time.time()
+        depth = args.batch * args.prefetch
+        for path, im in decode_ahead(self.decoders, self.decode, self._pending(paths), depth):
+            if im is None:
+                self.stats['failed'] += 1
+            else:
+                batch.append((path, output_key(path, self.root), im))
+                if len(batch) == args.batch:
+                    self._detect(batch, writes)
+                    del batch[:]
+            self._collect(writes, depth)
+            if time.time() - last_report >= args.report_interval:
+                last_report = time.time()
+                logger.info('%i detected, %i skipped, %i failed, %.1f images/s', self.stats['detected'],
+                            self.stats['skipped'], self.stats['failed'],
+                            self.stats['detected'] / (last_report - start))
+        if batch:
+            self._detect(batch, writes)
+        self._collect(writes, 0)
+        self.stats['seconds'] = time.time() - start
+        return self.stats
+
+    def close(self):
+        self.decoders.shutdown()
+        self.writers.shutdown()
+        self.output.close()
+        darknet.free_detector_demo(self.det)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('inputs', nargs='+', help='image directories, glob patterns or manifest files')
+    parser.add_argument('-o', '--out-dir', required=True)
+    parser.add_argument('--format', choices=sorted(OUTPUTS), default='jsonl')
+    parser.add_argument('--draw', action='store_true', help='also save annotated images')
+    parser.add_argument('--root', default='.', help='output names are the input paths relative to this')
+    parser.add_argument('-r', '--recursive', action='store_true', help='descend into subdirectories')
+    parser.add_argument('--data', default='cfg/coco.data')
+    parser.add_argument('--cfg', default='cfg/yolo.cfg')
+    parser.add_argument('--weights', default='yolo.weights')
+    parser.add_argument('--thresh', type=float, default=.24)
+    parser.add_argument('--hier-thresh', type=float, default=.5)
+    parser.add_argument('--batch', type=int, default=8, help='images per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='threads reading and decoding images')
+    parser.add_argument('--writers', type=int, default=2, help='threads writing results')
+    parser.add_argument('--prefetch', type=int, default=2, help='batches decoded ahead of the network')
+    parser.add_argument('--threads', type=int, help='OpenMP threads used by darknet')
+    parser.add_argument('--report-interval', type=float, default=10.0, help='seconds between progress logs')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = parse_args(argv)
+    if args.threads:
+        darknet.set_num_threads(args.threads)
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    detector = BatchDetector(args)
+    try:
+        stats = detector.run(iter_inputs(args.inputs, args.recursive))
+    finally:
+        detector.close()
+    print(json.dumps(dict(stats), sort_keys=True))
+    if stats['failed'] or stats['write_errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""Throughput benchmarks for the darknet bindings and the streaming pipeline.
+
+Runs on CPU with small configs, by default cfg/tiny-yolo.cfg and cfg/tiny.cfg
+with random weights, and prints per-call latency percentiles and FPS as JSON
+so runs can be compared across commits:
+
+    python python/benchmark.py -n 50 -o bench.json
+    python python/benchmark.py --only detect,detector_demo
+
+The streamproc benchmark decodes a local video file through StreamProc and
+only runs when --video is given.
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy
+
+import darknet
+from darknet import c_str
+
+logger = logging.getLogger(__name__)
+
+
+def summarize(samples):
+    """Return latency percentiles in milliseconds and calls per second for samples in seconds."""
+    a = numpy.asarray(samples, dtype=numpy.float64)
+    if not len(a):
+        return {'n': 0}
+    p50, p90, p99 = numpy.percentile(a, [50, 90, 99])
+    return {
+        'n': len(a),
+        'mean_ms': a.mean() * 1000,
+        'min_ms': a.min() * 1000,
+        'p50_ms': p50 * 1000,
+        'p90_ms': p90 * 1000,
+        'p99_ms': p99 * 1000,
+        'max_ms': a.max() * 1000,
+        'fps': len(a) / a.sum() if a.sum() > 0 else None,
+    }
+
+
+def measure(fn, iterations, warmup=1):
+    """Call fn warmup + iterations times and summarize the timed calls."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.time()
+        fn()
+        samples.append(time.time() - start)
+    return summarize(samples)
+
+
+def bench_classify(args):
+    net = darknet.load_net(c_str(args.classifier_cfg), c_str(args.classifier_weights), 0)
+    meta = darknet.load_meta(c_str(args.classifier_data))
+    im = darknet.load_image(c_str(args.image), 0, 0)
+    try:
+        return measure(lambda: darknet.classify(net, meta, im), args.iterations, args.warmup)
+    finally:
+        darknet.free_image(im)
+        darknet.free_net(net)
+
+
+def bench_classify_batch(args):
+    import classifier
+
+    clf = classifier.Classifier(args.classifier_data, args.classifier_cfg, args.classifier_weights,
+                                batch_size=args.classify_batch)
+    images = [args.image] * args.classify_batch
+    try:
+        res = measure(lambda: clf.classify(images), args.iterations, args.warmup)
+    finally:
+        clf.close()
+    res['images_per_second'] = res['fps'] * args.classify_batch if res.get('fps') else None
+    return res
+
+
+def bench_detect(args):
+    net = darknet.load_net(c_str(args.cfg), c_str(args.weights), 0)
+    meta = darknet.load_meta(c_str(args.data))
+    im = darknet.load_image(c_str(args.image), 0, 0)
+    try:
+        return measure(lambda: darknet.detect_image(net, meta, im, args.thresh, args.hier_thresh),
+                       args.iterations, args.warmup)
+    finally:
+        darknet.free_image(im)
+        darknet.free_net(net)
+
+
+def bench_detector_demo(args):
+    det = darknet.make_detector_demo(c_str(args.data), c_str(args.cfg), c_str(args.weights),
+                                     args.thresh, args.hier_thresh)
+    im = darknet.load_image(c_str(args.image), 0, 0)
+    stages = dict((name, []) for name, _ in darknet.DETECTOR_DEMO_TIMINGS._fields_)
+
+    def run():
+        darknet.detector_demo_process_image(det, im)
+        for name, seconds in darknet.demo_timings(det).items():
+            stages[name].append(seconds)
+
+    try:
+        res = measure(run, args.iterations, args.warmup)
+    finally:
+        darknet.free_image(im)
+        darknet.free_detector_demo(det)
+    res['stages'] = dict((name, summarize(samples[args.warmup:])) for name, samples in stages.items())
+    return res
+
+
+def bench_conversions(args):
+    h, w = args.frame_height, args.frame_width
+    frame = numpy.random.RandomState(0).randint(0, 256, (h, w, 3)).astype(numpy.uint8)
+    out = numpy.empty_like(frame)
+    data = frame.ctypes.data
+    out_data = out.ctypes.data
+
+    def to_image():
+        darknet.free_image(darknet.data_to_image(data, w, h, 3, w * 3))
+
+    im = darknet.data_to_image(data, w, h, 3, w * 3)
+    buf = darknet.ImageBuffer()
+    planes = darknet.yuv_planes(w, h, 'I420')
+    yuv = numpy.random.RandomState(0).randint(0, 256, planes[2][0] + planes[2][1] * ((h + 1) // 2))
+    yuv = darknet.yuv_frame(yuv.astype(numpy.uint8), w, h, 'I420', planes)
+    boxed = darknet.make_image(416, 416, 3)
+    try:
+        return {
+            'data_to_image': measure(to_image, args.iterations, args.warmup),
+            'data_into_image': measure(lambda: darknet.data_into_image(data, w, h, 3, w * 3, im),
+                                       args.iterations, args.warmup),
+            'copy_image_into_data': measure(lambda: darknet.copy_image_into_data(im, out_data, w, h, 3, w * 3),
+                                            args.iterations, args.warmup),
+            'image_buffer_load': measure(lambda: buf.load(frame), args.iterations, args.warmup),
+            'image_buffer_store': measure(lambda: buf.store(out), args.iterations, args.warmup),
+            'letterbox_frame': measure(lambda: darknet.letterbox_frame(boxed, frame), args.iterations, args.warmup),
+            'letterbox_yuv': measure(lambda: darknet.letterbox_yuv_into(yuv, boxed), args.iterations, args.warmup),
+            'image_buffer_load_yuv': measure(lambda: buf.load_yuv(yuv), args.iterations, args.warmup),
+            'image_buffer_store_yuv': measure(lambda: buf.store(yuv), args.iterations, args.warmup),
+        }
+    finally:
+        darknet.free_image(boxed)
+        darknet.free_image(im)
+        buf.free()
+
+
+def bench_streamproc(args):
+    import streamproc
+    from metrics import REGISTRY
+
+    streamproc.configure(datacfg=c_str(args.data), cfgfile=c_str(args.cfg), weightfile=c_str(args.weights),
+                         thresh=args.thresh, hier_thresh=args.hier_thresh)
+
+    outputs = []
+
+    def on_out_data(data, binary=True):
+        outputs.append(time.time())
+
+    with open(args.video, 'rb') as f:
+        video = f.read()
+
+    proc = streamproc.StreamProc('benchmark')
+    proc.run(on_out_data, streamproc.StreamProc.DETECTIONS, 'queue', yuv=not args.stream_rgb,
+             maxlen=args.stream_queue)
+    start = time.time()
+    for offset in range(0, len(video), args.chunk_size):
+        proc.process_data(video[offset:offset + args.chunk_size])
+    proc.in_src.emit('end-of-stream')
+
+    # Finished when every decoded frame was processed or dropped and nothing arrived for a while
+    stats = proc.scheduler.stats
+    idle = 0.0
+    while idle < args.stream_idle and time.time() - start < args.stream_timeout:
+        count = len(outputs)
+        time.sleep(0.1)
+        settled = stats.received and stats.received == stats.processed + stats.dropped + stats.errors
+        idle = idle + 0.1 if settled and count == len(outputs) else 0.0
+    snapshot = stats.snapshot()
+    stages = {}
+    for labels, hist in REGISTRY.histograms('stage_seconds', stream=proc.name):
+        _, count, total = hist.samples()
+        stages[labels['stage']] = {'n': count, 'mean_ms': total / count * 1000 if count else None}
+    proc.stop()
+
+    res = summarize(numpy.diff([start] + outputs))
+    res['frames'] = len(outputs)
+    res['fps'] = len(outputs) / (outputs[-1] - start) if outputs else None
+    res['scheduler'] = snapshot
+    res['stages'] = stages
+    return res
+
+
+BENCHMARKS = [
+    ('classify', bench_classify),
+    ('classify_batch', bench_classify_batch),
+    ('detect', bench_detect),
+    ('detector_demo', bench_detector_demo),
+    ('conversions', bench_conversions),
+    ('streamproc', bench_streamproc),
+]
+
+
+def git_revision():
+    try:
+        root = os.path.dirname(os.path.abspath(__file__))
+        with open(os.devnull, 'w') as devnull:
+            rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root, stderr=devnull)
+        return rev.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--iterations', type=int, default=20, help='timed calls per benchmark')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed calls before measuring')
+    parser.add_argument('--only', help='comma separated benchmarks to run: ' +
+                        ', '.join(name for name, _ in BENCHMARKS))
+    parser.add_argument('-o', '--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--threads', type=int, help='OpenMP threads used by darknet')
+    parser.add_argument('--data', default='cfg/coco.data')
+    parser.add_argument('--cfg', default='cfg/tiny-yolo.cfg')
+    parser.add_argument('--weights', help='detector weights, random when not given')
+    parser.add_argument('--thresh', type=float, default=.24)
+    parser.add_argument('--hier-thresh', type=float, default=.5)
+    parser.add_argument('--classifier-data', default='cfg/imagenet1k.data')
+    parser.add_argument('--classifier-cfg', default='cfg/tiny.cfg')
+    parser.add_argument('--classifier-weights', help='classifier weights, random when not given')
+    parser.add_argument('--classify-batch', type=int, default=8, help='images per classify_batch call')
+    parser.add_argument('--image', default='data/dog.jpg')
+    parser.add_argument('--frame-width', type=int, default=1280, help='frame size for the conversions')
+    parser.add_argument('--frame-height', type=int, default=720)
+    parser.add_argument('--video', help='video file decoded by the streamproc benchmark')
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024, help='bytes per websocket message')
+    parser.add_argument('--stream-queue', type=int, default=64, help='frames StreamProc may queue')
+    parser.add_argument('--stream-idle', type=float, default=2.0, help='seconds without output that end the run')
+    parser.add_argument('--stream-timeout', type=float, default=300.0)
+    parser.add_argument('--stream-rgb', action='store_true', help='decode to RGB instead of planar YUV')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args(argv)
+    if args.threads:
+        darknet.set_num_threads(args.threads)
+    if args.only:
+        selected = set(args.only.split(','))
+        unknown = selected.difference(name for name, _ in BENCHMARKS)
+        if unknown:
+            sys.exit('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+        if 'streamproc' in selected and not args.video:
+            sys.exit('The streamproc benchmark needs --video')
+    else:
+        selected = set(name for name, _ in BENCHMARKS)
+        if not args.video:
+            selected.discard('streamproc')
+
+    report = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None,
+        'args': vars(args),
+        'results': {},
+    }
+    for name, bench in BENCHMARKS:
+        if name in selected:
+            logger.warning('Running %s', name)
+            report['results'][name] = bench(args)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+from __future__ import division
+import ctypes
+import logging
+
+import numpy
+
+import darknet
+from darknet import c_str
+
+logger = logging.getLogger(__name__)
+
+# Characters of the byte vocabulary of the char-RNN configs
+DEFAULT_VOCAB = 256
+# Characters generated per sequence before it is cut off
+DEFAULT_MAX_LENGTH = 200
+
+
+class CharRNN(object):
+    """Advances a batch of character sequences through a recurrent network together.
+
+    Every row of the batch is its own sequence with its own recurrent
+    state, so n candidates cost one batched pass per character instead of
+    n passes. The network has to be loaded for the batch with
+    darknet.load_net_batch, its recurrent layers cannot be resized later;
+    rows that are not needed are fed zeros. Sampling, temperature and
+    top-k run on the (batch, vocab) output with NumPy.
+    """
+
+    def __init__(self, net, batch, vocab=DEFAULT_VOCAB):
+        self.net = net
+        self.batch = batch
+        self.vocab = vocab
+        outputs = darknet.network_outputs(net)
+        if outputs != vocab:
+            raise ValueError('network outputs {} values, expected {}'.format(outputs, vocab))
+        # network_predict reads one input row per batch entry and time step
+        net_batch = darknet.network_batch(net)
+        if net_batch != batch:
+            raise ValueError('network runs {} rows per pass, expected {}: it has to be loaded for '
+                             'batch {} with time_steps=1'.format(net_batch, batch, batch))
+        self._input = numpy.zeros((batch, vocab), dtype=numpy.float32)
+        self._input_ptr = self._input.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+    @classmethod
+    def load(cls, cfgfile, weightfile, batch, vocab=DEFAULT_VOCAB):
+        net = darknet.load_net_batch(c_str(cfgfile), c_str(weightfile), 0, batch)
+        return cls(net, batch, vocab)
+
+    def free(self):
+        if self.net is not None:
+            darknet.free_net(self.net)
+            self.net = None
+
+    def reset(self, rows=None):
+        """Clear the recurrent state of the given rows, all by default."""
+        for b in range(self.batch) if rows is None else rows:
+            darknet.reset_network_state(self.net, int(b))
+
+    def reorder(self, rows):
+        """Continue row j from the state of row rows[j], for the first len(rows) rows."""
+        rows = numpy.ascontiguousarray(rows, dtype=numpy.intc)
+        darknet.reorder_network_state(self.net, rows.ctypes.data_as(ctypes.POINTER(ctypes.c_int)), len(rows))
+
+    def step(self, chars):
+        """Feed one character code per row, -1 or missing rows get no input.
+
+        Returns the (batch, vocab) probabilities of the next character, a
+        view that the next step overwrites.
+        """
+        x = self._input
+        x.fill(0)
+        chars = numpy.asarray(chars, dtype=numpy.int64)
+        rows = numpy.flatnonzero(chars >= 0)
+        x[rows, chars[rows]] = 1
+        out = darknet.predict(self.net, self._input_ptr)
+        return numpy.ctypeslib.as_array(out, shape=(self.batch, self.vocab))
+
+    def prime(self, prefix):
+        """Reset every row and feed all but the last character of prefix.
+
+        Returns the code of the last character, the input of the first
+        generated step. An empty prefix starts from a newline.
+        """
+        codes = bytearray(c_str(prefix) or b'\n')
+        self.reset()
+        for c in codes[:-1]:
+            self.step(numpy.full(self.batch, c))
+        return codes[-1]
+
+    def sample(self, prefix, n=None, temperature=1.0, top_k=None, stop='.', max_length=DEFAULT_MAX_LENGTH,
+               random_state=None):
+        """Sample n continuations of prefix, each ending with stop or at max_length.
+
+        Returns (text, log probability) tuples, best first; the log
+        probability is that of the network's own distribution, before
+        temperature and top-k. More sequences than the batch are sampled
+        in several rounds.
+        """
+        n = self.batch if n is None else n
+        rng = random_state or numpy.random
+        results = []
+        while len(results) < n:
+            results.extend(self._sample_batch(prefix, min(n - len(results), self.batch), temperature, top_k,
+                                              stop, max_length, rng))
+        return sorted(results, key=lambda r: -r[1])
+
+    def _sample_batch(self, prefix, n, temperature, top_k, stop, max_length, rng):
+        stop = ord(stop) if stop else -1
+        chars = numpy.full(self.batch, -1, dtype=numpy.int64)
+        chars[:n] = self.prime(prefix)
+        codes = numpy.zeros((n, max_length), dtype=numpy.uint8)
+        lengths = numpy.zeros(n, dtype=numpy.int64)
+        logp = numpy.zeros(n)
+        active = numpy.ones(n, dtype=bool)
+        for t in range(max_length):
+            probs = self.step(chars)[:n]
+            picked = sample_rows(probs, temperature, top_k, rng)
+            rows = numpy.flatnonzero(active)
+            logp[rows] += numpy.log(numpy.maximum(probs[rows, picked[rows]], 1e-30))
+            codes[rows, t] = picked[rows]
+            lengths[rows] += 1
+            active &= picked != stop
+            if not active.any():
+                break
+            chars[:n] = numpy.where(active, picked, -1)
+        return [(_decode(codes[i, :lengths[i]]), float(logp[i])) for i in range(n)]
+
+    def beam_search(self, prefix, width=None, stop='.', max_length=DEFAULT_MAX_LENGTH):
+        """Return the width most likely continuations of prefix ending with stop.
+
+        Every step extends each live beam by every character and keeps the
+        width best of them, the recurrent state follows the kept beams
+        through reorder(). Beams reaching max_length are returned unfinished
+        when fewer than width sequences ended with stop. Results are (text,
+        log probability) tuples, best first.
+        """
+        width = self.batch if width is None else width
+        if width > self.batch:
+            raise ValueError('beam width {} exceeds the batch of {}'.format(width, self.batch))
+        stop = ord(stop) if stop else -1
+        chars = numpy.full(self.batch, -1, dtype=numpy.int64)
+        chars[:1] = self.prime(prefix)
+        beams = [b'']
+        scores = numpy.zeros(1)
+        finished = []
+        kept = []
+        for t in range(max_length):
+            probs = self.step(chars)[:len(beams)]
+            total = scores[:, None] + numpy.log(numpy.maximum(probs, 1e-30))
+            flat = total.ravel()
+            best = numpy.argpartition(-flat, width - 1)[:width] if flat.size > width else numpy.arange(flat.size)
+            best = best[numpy.argsort(-flat[best], kind='mergesort')]
+            parents, picked = numpy.divmod(best, self.vocab)
+            kept = []
+            for parent, c, score in zip(parents, picked, flat[best]):
+                text = beams[parent] + bytes(bytearray([c]))
+                if c == stop:
+                    finished.append((text, float(score)))
+                else:
+                    kept.append((parent, c, text, score))
+            finished.sort(key=lambda r: -r[1])
+            del finished[width:]
+            # Scores only decrease, no live beam can beat a full set of finished ones
+            if not kept or (len(finished) == width and finished[-1][1] >= kept[0][3]):
+                kept = []
+                break
+            self.reorder([k[0] for k in kept])
+            beams = [k[2] for k in kept]
+            scores = numpy.array([k[3] for k in kept])
+            chars.fill(-1)
+            chars[:len(kept)] = [k[1] for k in kept]
+        results = finished + [(text, float(score)) for text, score in zip(beams, scores)] if kept else finished
+        results = sorted(results, key=lambda r: -r[1])[:width]
+        return [(_decode(text), score) for text, score in results]
+
+
+def sample_rows(probs, temperature=1.0, top_k=None, random_state=None):
+    """Draw one index from each row of a (n, vocab) probability array.
+
+    temperature sharpens (< 1) or flattens (> 1) the distribution, top_k
+    restricts each row to its k most likely entries.
+    """
+    rng = random_state or numpy.random
+    p = numpy.maximum(probs.astype(numpy.float64), 0)
+    if temperature != 1.0:
+        p = numpy.exp(numpy.log(numpy.maximum(p, 1e-30)) / temperature)
+    if top_k and top_k < p.shape[1]:
+        kth = numpy.partition(p, -top_k, axis=1)[:, -top_k]
+        p = numpy.where(p >= kth[:, None], p, 0)
+    cdf = numpy.cumsum(p, axis=1)
+    r = rng.uniform(0, 1, size=len(p)) * cdf[:, -1]
+    return numpy.minimum((cdf <= r[:, None]).sum(axis=1), p.shape[1] - 1)
+
+
+def _decode(codes):
+    return bytes(bytearray(codes)).decode('latin-1')
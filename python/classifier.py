@@ -0,0 +1,136 @@
+from __future__ import division
+import atexit
+import ctypes
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+import darknet
+from darknet import c_str
+
+logger = logging.getLogger(__name__)
+
+# Classes returned per image
+DEFAULT_TOP_K = 5
+
+
+class Classifier(object):
+    """Batched top-k classification of image files and arrays.
+
+    Images are decoded and letterboxed, like network_predict_image does
+    for darknet.classify, on a thread pool straight into the network input
+    of a batch, while the previous batch runs through the
+    network, which is loaded for batch_size images. Only the k best
+    classes of each image are picked, with argpartition on the (batch,
+    classes) output, and returned as NumPy arrays of indices and scores;
+    names resolves indices to labels from the metadata loaded once.
+    """
+
+    def __init__(self, datacfg, cfgfile, weightfile, batch_size=8, workers=None):
+        logger.info('Init darknet classifier, batch size %i', batch_size)
+        self.batch_size = batch_size
+        self.net = darknet.load_net_batch(c_str(cfgfile), c_str(weightfile), 0, batch_size)
+        self.meta = darknet.load_meta(c_str(datacfg))
+        self.width = darknet.network_width(self.net)
+        self.height = darknet.network_height(self.net)
+        self.channels = darknet.network_inputs(self.net) // (self.width * self.height)
+        self.classes = darknet.network_outputs(self.net)
+        self._names = None
+        # Two inputs, one is filled while the network reads the other
+        self._inputs = [numpy.zeros((batch_size, self.channels, self.height, self.width), dtype=numpy.float32)
+                        for _ in range(2)]
+        self._pool = ThreadPoolExecutor(workers or batch_size)
+        atexit.register(self.close)
+
+    @property
+    def names(self):
+        """Class names as a NumPy array, so label lookups can take index arrays."""
+        if self._names is None:
+            self._names = numpy.array(darknet.metadata_names(self.meta), dtype=object)
+        return self._names
+
+    def close(self):
+        if self.net is None:
+            return
+        self._pool.shutdown()
+        darknet.free_net(self.net)
+        self.net = None
+
+    def _load(self, image, row):
+        """Letterbox image, a path or an HWC uint8 RGB array, into one row of an input.
+
+        Returns False for files that cannot be read or decoded.
+        """
+        boxed = darknet.IMAGE(self.width, self.height, self.channels,
+                              row.ctypes.data_as(ctypes.POINTER(ctypes.c_float)))
+        if isinstance(image, numpy.ndarray):
+            darknet.letterbox_frame(boxed, image)
+            return True
+        try:
+            with open(image, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            logger.warning('Cannot read %s: %s', image, e)
+            return False
+        # Unlike load_image a broken file does not end the process
+        im = darknet.load_image_memory(data, len(data), self.channels)
+        if not im.data:
+            logger.warning('Cannot decode %s', image)
+            return False
+        try:
+            row.fill(.5)
+            darknet.letterbox_image_into(im, self.width, self.height, boxed)
+        finally:
+            darknet.free_image(im)
+        return True
+
+    def _fill(self, images, buf):
+        return [self._pool.submit(self._load, image, buf[i]) for i, image in enumerate(images)]
+
+    def _predict(self, buf, n):
+        out = darknet.predict(self.net, buf.ctypes.data_as(ctypes.POINTER(ctypes.c_float)))
+        return numpy.ctypeslib.as_array(out, shape=(self.batch_size, self.classes))[:n]
+
+    def classify(self, images, k=DEFAULT_TOP_K):
+        """Return the k best classes of every image, best first.
+
+        images is a sequence of paths or HWC uint8 RGB arrays, or an NHWC
+        array. Returns an (n, k) int array of class indices and an (n, k)
+        float32 array of their scores. Rows of images that cannot be read
+        or decoded hold index -1 and score NaN.
+        """
+        n = len(images)
+        k = min(k, self.classes)
+        indices = numpy.empty((n, k), dtype=numpy.int64)
+        scores = numpy.empty((n, k), dtype=numpy.float32)
+        starts = range(0, n, self.batch_size)
+        pending = self._fill(images[:self.batch_size], self._inputs[0]) if n else []
+        for b, start in enumerate(starts):
+            buf = self._inputs[b % 2]
+            loaded = numpy.array([f.result() for f in pending], dtype=bool)
+            count = min(self.batch_size, n - start)
+            following = start + self.batch_size
+            pending = self._fill(images[following:following + self.batch_size], self._inputs[(b + 1) % 2])
+            probs = self._predict(buf, count)
+            top = numpy.argpartition(-probs, k - 1, axis=1)[:, :k] if k < self.classes else \
+                numpy.tile(numpy.arange(self.classes), (count, 1))
+            rows = numpy.arange(count)[:, None]
+            order = numpy.argsort(-probs[rows, top], axis=1, kind='mergesort')
+            top = top[rows, order]
+            indices[start:start + count] = top
+            scores[start:start + count] = probs[rows, top]
+            indices[start:start + count][~loaded] = -1
+            scores[start:start + count][~loaded] = numpy.nan
+        return indices, scores
+
+    def classify_labels(self, images, k=DEFAULT_TOP_K):
+        """Like classify with lists of (name, score) per image, like darknet.classify.
+
+        Images that cannot be read or decoded get None.
+        """
+        indices, scores = self.classify(images, k)
+        names = self.names[indices]
+        return [list(zip(n, s)) if i[0] >= 0 else None
+                for i, n, s in zip(indices, names.tolist(), scores.tolist())]
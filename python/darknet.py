@@ -3,6 +3,12 @@ import math
 import random
 import sys
 
+try:
+    import numpy
+    import numpy.ctypeslib
+except ImportError:  # numpy is only needed by the array helpers below
+    numpy = None
+
 def sample(probs):
     s = sum(probs)
     probs = [a/s for a in probs]
@@ -18,6 +24,12 @@ def c_array(ctype, values):
     arr[:] = values
     return arr
 
+def c_str(s):
+    """Return s as the bytes char* arguments take, None and bytes as they are."""
+    if s is None or isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
 class NETWORK(Structure):
     pass
 
@@ -39,31 +51,133 @@ class IMAGE(Structure):
                 ("c", c_int),
                 ("data", POINTER(c_float))]
 
+class FRAME_DATA(Structure):
+    _fields_ = [("data", c_void_p),
+                ("w", c_int),
+                ("h", c_int),
+                ("c", c_int),
+                ("bytes_per_line", c_int)]
+
+class YUV_FRAME(Structure):
+    _fields_ = [("y", c_void_p),
+                ("u", c_void_p),
+                ("v", c_void_p),
+                ("y_stride", c_int),
+                ("uv_stride", c_int),
+                ("uv_step", c_int),
+                ("w", c_int),
+                ("h", c_int),
+                ("bt709", c_int)]
+
+class LETTERBOX_GEOMETRY(Structure):
+    _fields_ = [("scale", c_float),
+                ("dx", c_int),
+                ("dy", c_int),
+                ("w", c_int),
+                ("h", c_int)]
+
+class DETECTION(Structure):
+    _fields_ = [("class_id", c_int),
+                ("score", c_float),
+                ("bbox", BOX)]
+
+if numpy is not None:
+    # NumPy view of DETECTION records, box coordinates are relative to the image
+    DETECTION_DTYPE = numpy.dtype([("class_id", numpy.int32),
+                                   ("score", numpy.float32),
+                                   ("x", numpy.float32),
+                                   ("y", numpy.float32),
+                                   ("w", numpy.float32),
+                                   ("h", numpy.float32)])
+
+class DETECTOR_DEMO_TIMINGS(Structure):
+    _fields_ = [("letterbox", c_double),
+                ("forward", c_double),
+                ("nms", c_double),
+                ("draw", c_double)]
+
 class METADATA(Structure):
     _fields_ = [("classes", c_int),
                 ("names", POINTER(c_char_p))]
 
     
 
-#lib = CDLL("/home/pjreddie/documents/darknet/libdarknet.so", RTLD_GLOBAL)
-lib = CDLL("libdarknet.so", RTLD_GLOBAL)
-lib.network_width.argtypes = [c_void_p]
-lib.network_width.restype = c_int
-lib.network_height.argtypes = [c_void_p]
-lib.network_height.restype = c_int
+class _Library(object):
+    """libdarknet.so, loaded on first use so importing this module stays cheap."""
+
+    def __init__(self, name):
+        self._name = name
+        self._lib = None
+
+    def _load(self):
+        if self._lib is None:
+            self._lib = CDLL(self._name, RTLD_GLOBAL)
+        return self._lib
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+class _Function(object):
+    """A darknet function resolved on its first call.
+
+    argtypes and restype may be assigned before the library is loaded,
+    they are applied when the symbol is resolved.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_func'] = None
+        self.__dict__['_attrs'] = {}
+
+    def _resolve(self):
+        func = self._func
+        if func is None:
+            func = getattr(lib, self._name)
+            for attr, value in self._attrs.items():
+                setattr(func, attr, value)
+            self.__dict__['_func'] = func
+        return func
+
+    def __setattr__(self, attr, value):
+        self._attrs[attr] = value
+        if self._func is not None:
+            setattr(self._func, attr, value)
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
 
-predict = lib.network_predict
+    def __call__(self, *args):
+        return (self._func or self._resolve())(*args)
+
+#lib = _Library("/home/pjreddie/documents/darknet/libdarknet.so")
+lib = _Library("libdarknet.so")
+
+network_width = _Function("network_width")
+network_width.argtypes = [c_void_p]
+network_width.restype = c_int
+
+network_height = _Function("network_height")
+network_height.argtypes = [c_void_p]
+network_height.restype = c_int
+
+network_batch = _Function("network_batch")
+network_batch.argtypes = [c_void_p]
+network_batch.restype = c_int
+
+predict = _Function("network_predict")
 predict.argtypes = [c_void_p, POINTER(c_float)]
 predict.restype = POINTER(c_float)
 
-set_gpu = lib.cuda_set_device
+set_gpu = _Function("cuda_set_device")
 set_gpu.argtypes = [c_int]
 
-make_image = lib.make_image
+make_image = _Function("make_image")
 make_image.argtypes = [c_int, c_int, c_int]
 make_image.restype = IMAGE
 
-data_to_image = lib.data_to_image
+data_to_image = _Function("data_to_image")
 data_to_image.argtypes = (
             c_void_p, # imagedata
             c_int,    # width
@@ -72,7 +186,7 @@ data_to_image.argtypes = (
             c_int)    # bytes_per_line
 data_to_image.restype = IMAGE
 
-data_into_image = lib.data_into_image
+data_into_image = _Function("data_into_image")
 data_into_image.argtypes = (
             c_void_p, # imagedata
             c_int,    # width
@@ -82,7 +196,7 @@ data_into_image.argtypes = (
             IMAGE)           # image
 data_into_image.restype = None
 
-copy_image_into_data = lib.copy_image_into_data
+copy_image_into_data = _Function("copy_image_into_data")
 copy_image_into_data.argtypes = (
             IMAGE,    # image
             c_void_p, # imagedata
@@ -94,128 +208,507 @@ copy_image_into_data.argtypes = (
 copy_image_into_data.restype = None
 
 
-save_image = lib.save_image
+save_image = _Function("save_image")
 save_image.argtypes = (
             IMAGE,   # image
             c_char_p # name
             )
 save_image.restype = None
 
-show_image = lib.show_image
+show_image = _Function("show_image")
 show_image.argtypes = (
             IMAGE,   # image
             c_char_p # name
             )
 show_image.restype = None
 
-make_boxes = lib.make_boxes
+make_boxes = _Function("make_boxes")
 make_boxes.argtypes = [c_void_p]
 make_boxes.restype = POINTER(BOX)
 
-free_boxes = lib.free_boxes
+free_boxes = _Function("free_boxes")
 free_boxes.argtypes = [POINTER(BOX)]
 free_boxes.restype = None
 
-free_ptr = lib.free_ptr
+free_ptr = _Function("free_ptr")
 free_ptr.argtypes = [c_void_p]
 free_ptr.restype = None
 
-free_ptrs = lib.free_ptrs
+free_ptrs = _Function("free_ptrs")
 free_ptrs.argtypes = [POINTER(c_void_p), c_int]
 
-num_boxes = lib.num_boxes
+set_num_threads = _Function("set_num_threads")
+set_num_threads.argtypes = [c_int]
+set_num_threads.restype = None
+
+num_boxes = _Function("num_boxes")
 num_boxes.argtypes = [c_void_p]
 num_boxes.restype = c_int
 
-make_probs = lib.make_probs
+make_probs = _Function("make_probs")
 make_probs.argtypes = [c_void_p]
 make_probs.restype = POINTER(POINTER(c_float))
 
-detect = lib.network_predict
-detect.argtypes = [c_void_p, IMAGE, c_float, c_float, c_float, POINTER(BOX), POINTER(POINTER(c_float))]
-
-reset_rnn = lib.reset_rnn
+reset_rnn = _Function("reset_rnn")
 reset_rnn.argtypes = [c_void_p]
 
-load_net = lib.load_network
+# Recurrent state of one batch entry, and of the first n entries gathered
+# from the given rows, see charrnn.CharRNN
+reset_network_state = _Function("reset_network_state")
+reset_network_state.argtypes = [c_void_p, c_int]
+reset_network_state.restype = None
+
+reorder_network_state = _Function("reorder_network_state")
+reorder_network_state.argtypes = [c_void_p, POINTER(c_int), c_int]
+reorder_network_state.restype = None
+
+network_inputs = _Function("network_inputs")
+network_inputs.argtypes = [c_void_p]
+network_inputs.restype = c_int
+
+network_outputs = _Function("network_outputs")
+network_outputs.argtypes = [c_void_p]
+network_outputs.restype = c_int
+
+load_net = _Function("load_network")
 load_net.argtypes = [c_char_p, c_char_p, c_int]
 load_net.restype = POINTER(NETWORK)
 
-free_net = lib.free_network
-free_net.argtypes = [c_void_p]
-free_net.restype = None
+# Like load_net with state for batch sequences, recurrent layers cannot be
+# resized after loading
+load_net_batch = _Function("load_network_batch")
+load_net_batch.argtypes = [c_char_p, c_char_p, c_int, c_int]
+load_net_batch.restype = POINTER(NETWORK)
+
+free_network = _Function("free_network")
+free_network.argtypes = [c_void_p]
+free_network.restype = None
+
+def free_net(net):
+    """Free a network and the DetectBuffers cached for it."""
+    release_detect_buffers(net)
+    free_network(net)
+
+# Writes weights that load_net and make_detector_demo map instead of reading,
+# shared between all processes loading the same file
+save_weights_mapped = _Function("save_weights_mapped")
+save_weights_mapped.argtypes = [c_void_p, c_char_p]
+save_weights_mapped.restype = None
 
-free_image = lib.free_image
+free_image = _Function("free_image")
 free_image.argtypes = [IMAGE]
 
-letterbox_image = lib.letterbox_image
+resize_image = _Function("resize_image")
+resize_image.argtypes = [IMAGE, c_int, c_int]
+resize_image.restype = IMAGE
+
+letterbox_image = _Function("letterbox_image")
 letterbox_image.argtypes = [IMAGE, c_int, c_int]
 letterbox_image.restype = IMAGE
 
-load_meta = lib.get_metadata
-lib.get_metadata.argtypes = [c_char_p]
-lib.get_metadata.restype = METADATA
+# Letterboxes into boxed without filling the borders, fill boxed with .5 first
+letterbox_image_into = _Function("letterbox_image_into")
+letterbox_image_into.argtypes = [IMAGE, c_int, c_int, IMAGE]
+letterbox_image_into.restype = None
+
+letterbox_data_into = _Function("letterbox_data_into")
+letterbox_data_into.argtypes = (
+            c_void_p, # imagedata
+            c_int,    # width
+            c_int,    # height
+            c_int,    # bytes_per_pixel
+            c_int,    # bytes_per_line
+            c_int,    # swap_rb
+            IMAGE)    # boxed
+letterbox_data_into.restype = LETTERBOX_GEOMETRY
+
+resize_data_into = _Function("resize_data_into")
+resize_data_into.argtypes = (
+            c_void_p, # imagedata
+            c_int,    # width
+            c_int,    # height
+            c_int,    # bytes_per_pixel
+            c_int,    # bytes_per_line
+            c_int,    # swap_rb
+            IMAGE)    # out
+resize_data_into.restype = None
+
+yuv_into_image = _Function("yuv_into_image")
+yuv_into_image.argtypes = [YUV_FRAME, IMAGE]
+yuv_into_image.restype = None
+
+image_into_yuv = _Function("image_into_yuv")
+image_into_yuv.argtypes = [IMAGE, YUV_FRAME]
+image_into_yuv.restype = None
 
-load_image = lib.load_image_color
+letterbox_yuv_into = _Function("letterbox_yuv_into")
+letterbox_yuv_into.argtypes = [YUV_FRAME, IMAGE]
+letterbox_yuv_into.restype = LETTERBOX_GEOMETRY
+
+load_meta = _Function("get_metadata")
+load_meta.argtypes = [c_char_p]
+load_meta.restype = METADATA
+
+load_image = _Function("load_image_color")
 load_image.argtypes = [c_char_p, c_int, c_int]
 load_image.restype = IMAGE
 
-rgbgr_image = lib.rgbgr_image
+# Returns an IMAGE without data instead of exiting on broken images
+load_image_memory = _Function("load_image_memory")
+load_image_memory.argtypes = [c_char_p, c_int, c_int]
+load_image_memory.restype = IMAGE
+
+rgbgr_image = _Function("rgbgr_image")
 rgbgr_image.argtypes = [IMAGE]
 rgbgr_image.restype = None
 
-predict_image = lib.network_predict_image
+predict_image = _Function("network_predict_image")
 predict_image.argtypes = [c_void_p, IMAGE]
 predict_image.restype = POINTER(c_float)
 
-network_detect = lib.network_detect
+network_detect = _Function("network_detect")
 network_detect.argtypes = [POINTER(NETWORK), IMAGE, c_float, c_float, c_float, POINTER(BOX), POINTER(POINTER(c_float))]
 
-get_network_n = lib.get_network_n
+get_network_n = _Function("get_network_n")
 get_network_n.argtypes = [POINTER(NETWORK)]
 get_network_n.restype = c_int
 
-get_network_layer = lib.get_network_layer
+get_network_layer = _Function("get_network_layer")
 get_network_layer.argtypes = [POINTER(NETWORK), c_int]
 get_network_layer.restype = POINTER(LAYER)
 
-get_layer_h = lib.get_layer_h
+get_layer_h = _Function("get_layer_h")
 get_layer_h.argtypes = [POINTER(LAYER)]
 get_layer_h.restype = c_int
 
-get_layer_w = lib.get_layer_w
+get_layer_w = _Function("get_layer_w")
 get_layer_w.argtypes = [POINTER(LAYER)]
 get_layer_w.restype = c_int
 
-get_layer_n = lib.get_layer_n
+get_layer_n = _Function("get_layer_n")
 get_layer_n.argtypes = [POINTER(LAYER)]
 get_layer_n.restype = c_int
 
-load_alphabet = lib.load_alphabet
+get_layer_classes = _Function("get_layer_classes")
+get_layer_classes.argtypes = [POINTER(LAYER)]
+get_layer_classes.restype = c_int
+
+load_alphabet = _Function("load_alphabet")
 load_alphabet.restype = POINTER(POINTER(IMAGE))
 
-free_alphabet = lib.free_alphabet
+free_alphabet = _Function("free_alphabet")
 free_alphabet.argtypes = [POINTER(POINTER(IMAGE))]
 
-draw_detections = lib.draw_detections
+draw_detections = _Function("draw_detections")
 draw_detections.argtypes = [IMAGE, c_int, c_float, POINTER(BOX), POINTER(POINTER(c_float)), POINTER(POINTER(c_float)), POINTER(c_char_p), POINTER(POINTER(IMAGE)), c_int]
 
-make_detector_demo = lib.make_detector_demo
+make_detector_demo = _Function("make_detector_demo")
 make_detector_demo.argtypes = [c_char_p, c_char_p, c_char_p, c_float, c_float]
 make_detector_demo.restype = POINTER(DETECTOR_DEMO)
 
-free_detector_demo = lib.free_detector_demo
+free_detector_demo = _Function("free_detector_demo")
 free_detector_demo.argtypes = [POINTER(DETECTOR_DEMO)]
 free_detector_demo.restype = None
 
-detector_demo_process_file = lib.detector_demo_process_file
+detector_demo_process_file = _Function("detector_demo_process_file")
 detector_demo_process_file.argtypes = [POINTER(DETECTOR_DEMO), c_char_p, c_char_p]
 detector_demo_process_file.restype = None
 
-detector_demo_process_image = lib.detector_demo_process_image
+detector_demo_process_image = _Function("detector_demo_process_image")
 detector_demo_process_image.argtypes = [POINTER(DETECTOR_DEMO), IMAGE]
 detector_demo_process_image.restype = None
 
+detector_demo_detect = _Function("detector_demo_detect")
+detector_demo_detect.argtypes = [POINTER(DETECTOR_DEMO), IMAGE, c_int]
+detector_demo_detect.restype = c_int
+
+detector_demo_detect_batch = _Function("detector_demo_detect_batch")
+detector_demo_detect_batch.argtypes = [POINTER(DETECTOR_DEMO), POINTER(IMAGE), c_int, c_int, POINTER(c_int)]
+detector_demo_detect_batch.restype = c_int
+
+detector_demo_detect_frames = _Function("detector_demo_detect_frames")
+detector_demo_detect_frames.argtypes = [POINTER(DETECTOR_DEMO), POINTER(FRAME_DATA), c_int, c_int, POINTER(c_int)]
+detector_demo_detect_frames.restype = c_int
+
+detector_demo_detect_yuv = _Function("detector_demo_detect_yuv")
+detector_demo_detect_yuv.argtypes = [POINTER(DETECTOR_DEMO), POINTER(YUV_FRAME), c_int, POINTER(c_int)]
+detector_demo_detect_yuv.restype = c_int
+
+detector_demo_set_batch = _Function("detector_demo_set_batch")
+detector_demo_set_batch.argtypes = [POINTER(DETECTOR_DEMO), c_int]
+detector_demo_set_batch.restype = None
+
+detector_demo_get_batch = _Function("detector_demo_get_batch")
+detector_demo_get_batch.argtypes = [POINTER(DETECTOR_DEMO)]
+detector_demo_get_batch.restype = c_int
+
+detector_demo_get_network = _Function("detector_demo_get_network")
+detector_demo_get_network.argtypes = [POINTER(DETECTOR_DEMO)]
+detector_demo_get_network.restype = c_void_p
+
+detector_demo_get_detections = _Function("detector_demo_get_detections")
+detector_demo_get_detections.argtypes = [POINTER(DETECTOR_DEMO), c_void_p, c_int]
+detector_demo_get_detections.restype = c_int
+
+detector_demo_draw = _Function("detector_demo_draw")
+detector_demo_draw.argtypes = [POINTER(DETECTOR_DEMO), IMAGE, c_void_p, c_int]
+detector_demo_draw.restype = None
+
+detector_demo_get_timings = _Function("detector_demo_get_timings")
+detector_demo_get_timings.argtypes = [POINTER(DETECTOR_DEMO)]
+detector_demo_get_timings.restype = DETECTOR_DEMO_TIMINGS
+
+
+def image_to_array(im):
+    """Return a (c, h, w) float32 NumPy view of the IMAGE data (no copy)."""
+    return numpy.ctypeslib.as_array(im.data, shape=(im.c, im.h, im.w))
+
+def frame_to_array(data, width=None, height=None, depth=3, bytes_per_line=None):
+    """Return an HWC uint8 NumPy view of a frame without copying it.
+
+    data may be a NumPy array or any object supporting the buffer protocol,
+    in which case width and height must be given. bytes_per_line allows
+    padded rows as delivered by GStreamer.
+    """
+    if isinstance(data, numpy.ndarray):
+        if data.dtype != numpy.uint8 or data.ndim != 3:
+            raise ValueError('expected HWC uint8 array, got {} {}'.format(data.dtype, data.shape))
+        return data
+    if width is None or height is None:
+        raise ValueError('width and height are required for buffer input')
+    if bytes_per_line is None:
+        bytes_per_line = width * depth
+    return numpy.ndarray((height, width, depth), dtype=numpy.uint8, buffer=data,
+                         strides=(bytes_per_line, depth, 1))
+
+def frame_data(data, width=None, height=None, depth=3, bytes_per_line=None):
+    """Describe an HWC uint8 frame as FRAME_DATA, see frame_to_array.
+
+    The frame may have padded rows but its pixels must be packed.
+    """
+    frame = frame_to_array(data, width, height, depth, bytes_per_line)
+    height, width, depth = frame.shape
+    if frame.strides[1:] != (depth, 1):
+        raise ValueError('frame pixels must be contiguous')
+    return FRAME_DATA(frame.ctypes.data, width, height, depth, frame.strides[0])
+
+def resize_frame(out, data, width=None, height=None, depth=3, bytes_per_line=None, swap_rb=False):
+    """Resize an HWC uint8 frame straight into the IMAGE out, like resize_image."""
+    f = frame_data(data, width, height, depth, bytes_per_line)
+    resize_data_into(f.data, f.w, f.h, f.c, f.bytes_per_line, int(swap_rb), out)
+
+def letterbox_frame(boxed, data, width=None, height=None, depth=3, bytes_per_line=None, swap_rb=False):
+    """Letterbox an HWC uint8 frame straight into the IMAGE boxed.
+
+    Returns the LETTERBOX_GEOMETRY mapping frame to boxed coordinates.
+    """
+    f = frame_data(data, width, height, depth, bytes_per_line)
+    return letterbox_data_into(f.data, f.w, f.h, f.c, f.bytes_per_line, int(swap_rb), boxed)
+
+YUV_FORMATS = ("I420", "NV12")
+
+def _round_up(n, align):
+    return (n + align - 1) // align * align
+
+def yuv_planes(width, height, format="I420"):
+    """Return the default (offset, stride) of each plane of a 4:2:0 frame.
+
+    Follows the GStreamer layout: rows padded to 4 bytes, chroma planes
+    sized for the height rounded up to even.
+    """
+    y_stride = _round_up(width, 4)
+    y_size = y_stride * _round_up(height, 2)
+    if format == "NV12":
+        return [(0, y_stride), (y_size, y_stride)]
+    if format == "I420":
+        uv_stride = _round_up(_round_up(width, 2) // 2, 4)
+        return [(0, y_stride), (y_size, uv_stride), (y_size + uv_stride * _round_up(height, 2) // 2, uv_stride)]
+    raise ValueError("unsupported YUV format %r" % (format,))
+
+def yuv_frame(data, width, height, format="I420", planes=None, bt709=False):
+    """Describe an I420 or NV12 frame in a bytes-like object or array as YUV_FRAME.
+
+    planes is a list of (offset, stride) per plane as given by the
+    decoder, yuv_planes is used when missing. The returned frame keeps
+    data alive.
+    """
+    if format not in YUV_FORMATS:
+        raise ValueError("unsupported YUV format %r" % (format,))
+    buf = numpy.frombuffer(data, dtype=numpy.uint8) if not isinstance(data, numpy.ndarray) else data
+    buf = buf.reshape(-1)
+    if planes is None:
+        planes = yuv_planes(width, height, format)
+    chroma_w = (width + 1) // 2
+    chroma_h = (height + 1) // 2
+    rows = [(height, width)] + [(chroma_h, chroma_w * (2 if format == "NV12" else 1))] * (len(planes) - 1)
+    for (offset, stride), (h, w) in zip(planes, rows):
+        if offset + stride * (h - 1) + w > buf.size:
+            raise ValueError("YUV frame data too small for %dx%d %s" % (width, height, format))
+    base = buf.ctypes.data
+    (y_off, y_stride), (u_off, uv_stride) = planes[:2]
+    if format == "NV12":
+        v, step = base + u_off + 1, 2
+    else:
+        v, step = base + planes[2][0], 1
+    f = YUV_FRAME(base + y_off, base + u_off, v, y_stride, uv_stride, step, width, height, int(bt709))
+    f._data = buf
+    return f
+
+class ImageBuffer(object):
+    """Preallocated planar float IMAGE reused for HWC uint8 frames.
+
+    The IMAGE is only reallocated when the frame geometry changes, so
+    converting a stream of equally sized frames does no malloc/free and
+    both conversions run as single vectorized NumPy passes.
+    """
+
+    def __init__(self):
+        self.image = None
+        self.array = None
+
+    def ensure(self, width, height, depth):
+        im = self.image
+        if im is None or im.w != width or im.h != height or im.c != depth:
+            self.free()
+            self.image = make_image(width, height, depth)
+            self.array = image_to_array(self.image)
+        return self.image
+
+    def load(self, data, width=None, height=None, depth=3, bytes_per_line=None):
+        """Convert an HWC uint8 frame or a YUV_FRAME into the buffer and return the IMAGE."""
+        if isinstance(data, YUV_FRAME):
+            return self.load_yuv(data)
+        frame = frame_to_array(data, width, height, depth, bytes_per_line)
+        height, width, depth = frame.shape
+        self.ensure(width, height, depth)
+        numpy.divide(frame.transpose(2, 0, 1), numpy.float32(255.), out=self.array, dtype=numpy.float32)
+        return self.image
+
+    def load_yuv(self, frame):
+        """Convert a YUV_FRAME into the buffer and return the IMAGE."""
+        self.ensure(frame.w, frame.h, 3)
+        yuv_into_image(frame, self.image)
+        return self.image
+
+    def store(self, frame, swap_rb=False):
+        """Copy the buffer back into a writable HWC uint8 frame.
+
+        With swap_rb the first and last channels are exchanged on the fly,
+        e.g. to hand an RGB image to OpenCV as BGR. frame may also be a
+        YUV_FRAME of the buffer size, swap_rb does not apply then.
+        """
+        if isinstance(frame, YUV_FRAME):
+            image_into_yuv(self.image, frame)
+            return frame
+        out = frame[:, :, ::-1] if swap_rb else frame
+        numpy.multiply(self.array.transpose(1, 2, 0), numpy.float32(255.), out=out, casting='unsafe')
+        return frame
+
+    def free(self):
+        if self.image is not None:
+            free_image(self.image)
+            self.image = None
+            self.array = None
+
+    def __del__(self):
+        self.free()
+
+def demo_detect(det, im, draw=False):
+    """Run a detector_demo on im and return its post-NMS detections.
+
+    The result is a DETECTION_DTYPE array sorted by descending score.
+    Detections are only drawn into im when draw is set.
+    """
+    num = detector_demo_detect(det, im, int(draw))
+    dets = numpy.empty(num, dtype=DETECTION_DTYPE)
+    if num:
+        detector_demo_get_detections(det, dets.ctypes.data, num)
+        dets = dets[numpy.argsort(-dets["score"], kind="mergesort")]
+    return dets
+
+def _split_detections(det, total, counts):
+    """Fetch the detections of a batch call as one sorted array per frame."""
+    dets = numpy.empty(total, dtype=DETECTION_DTYPE)
+    if total:
+        detector_demo_get_detections(det, dets.ctypes.data, total)
+    res = []
+    offset = 0
+    for count in counts:
+        d = dets[offset:offset + count]
+        res.append(d[numpy.argsort(-d["score"], kind="mergesort")])
+        offset += count
+    return res
+
+def demo_detect_batch(det, ims, draw=False):
+    """Run a detector_demo on a sequence of IMAGEs in one forward pass.
+
+    Returns one DETECTION_DTYPE array per image, see demo_detect. The
+    network runs at a batch of len(ims); its buffers are reallocated only
+    when more images are passed than ever before, see
+    detector_demo_set_batch.
+    """
+    n = len(ims)
+    images = (IMAGE * n)(*ims)
+    counts = (c_int * n)()
+    total = detector_demo_detect_batch(det, images, n, int(draw), counts)
+    return _split_detections(det, total, counts)
+
+def demo_draw(det, im, dets):
+    """Draw a DETECTION_DTYPE array returned by an earlier detect call into im.
+
+    Does not run the network and may be called while another thread
+    detects with det.
+    """
+    dets = numpy.ascontiguousarray(dets, dtype=DETECTION_DTYPE)
+    detector_demo_draw(det, im, dets.ctypes.data, len(dets))
+
+def demo_timings(det):
+    """Return the seconds spent per stage by the last detect call as a dict."""
+    t = detector_demo_get_timings(det)
+    return dict((name, getattr(t, name)) for name, _ in DETECTOR_DEMO_TIMINGS._fields_)
+
+def demo_detect_frames(det, frames, swap_rb=False):
+    """Detect on HWC uint8 frames without converting them to IMAGEs first.
+
+    Frames are letterboxed straight into the network input. Returns one
+    DETECTION_DTYPE array per frame like demo_detect_batch, nothing is drawn.
+    """
+    n = len(frames)
+    descs = (FRAME_DATA * n)(*[frame_data(f) for f in frames])
+    counts = (c_int * n)()
+    total = detector_demo_detect_frames(det, descs, n, int(swap_rb), counts)
+    return _split_detections(det, total, counts)
+
+def demo_detect_yuv(det, frames):
+    """Detect on YUV_FRAMEs, converting colors while letterboxing.
+
+    Returns one DETECTION_DTYPE array per frame like demo_detect_frames.
+    """
+    n = len(frames)
+    descs = (YUV_FRAME * n)(*frames)
+    counts = (c_int * n)()
+    total = detector_demo_detect_yuv(det, descs, n, counts)
+    return _split_detections(det, total, counts)
+
+def metadata_names(meta):
+    """Return the class names of a METADATA as a list of native strings."""
+    names = [meta.names[i] for i in range(meta.classes)]
+    return [n if isinstance(n, str) else n.decode("utf-8") for n in names]
+
+def detections_to_list(dets, names=None, track_ids=None):
+    """Convert a DETECTION_DTYPE array into JSON serializable dicts.
+
+    track_ids, one per detection, are added as "track_id" when given.
+    """
+    res = []
+    for i, (class_id, score, x, y, w, h) in enumerate(dets.tolist()):
+        d = {"class_id": class_id, "score": score, "box": [x, y, w, h]}
+        if names is not None:
+            d["name"] = names[class_id]
+        if track_ids is not None:
+            d["track_id"] = int(track_ids[i])
+        res.append(d)
+    return res
 
 def classify(net, meta, im):
     out = predict_image(net, im)
@@ -225,31 +718,82 @@ def classify(net, meta, im):
     res = sorted(res, key=lambda x: -x[1])
     return res
 
+class DetectBuffers(object):
+    """Box and probability buffers for network_detect, reused across calls.
+
+    Both buffers are NumPy arrays; probs is handed to C as a table of row
+    pointers into one contiguous (num, classes + 1) array, so results can
+    be filtered with vectorized masks instead of ctypes indexing.
+    """
+
+    def __init__(self, net):
+        l = get_network_layer(net, get_network_n(net)-1)
+        self.num = num_boxes(net)
+        self.classes = get_layer_classes(l)
+        self.boxes = numpy.zeros((self.num, 4), dtype=numpy.float32)
+        self.probs = numpy.zeros((self.num, self.classes + 1), dtype=numpy.float32)
+        self._rows = self.probs.ctypes.data + numpy.arange(self.num, dtype=numpy.uintp) * self.probs.strides[0]
+        self.boxes_ptr = self.boxes.ctypes.data_as(POINTER(BOX))
+        self.probs_ptr = self._rows.ctypes.data_as(POINTER(POINTER(c_float)))
+
+_detect_buffers = {}
+
+def get_detect_buffers(net):
+    """Return the DetectBuffers of net, allocating them on first use.
+
+    Buffers are checked against the size of the output, a network loaded
+    at the address of a freed one never gets buffers too small for it.
+    """
+    key = cast(net, c_void_p).value
+    buf = _detect_buffers.get(key)
+    if buf is None or buf.num != num_boxes(net) or \
+            buf.classes != get_layer_classes(get_network_layer(net, get_network_n(net)-1)):
+        buf = _detect_buffers[key] = DetectBuffers(net)
+    return buf
+
+def release_detect_buffers(net):
+    _detect_buffers.pop(cast(net, c_void_p).value, None)
+
+_alphabet = None
+
+def get_alphabet():
+    """Return the label alphabet, loading it only once per process."""
+    global _alphabet
+    if _alphabet is None:
+        _alphabet = load_alphabet()
+    return _alphabet
+
+def detect_array(net, im, thresh=.5, hier_thresh=.5, nms=.45, names=None):
+    """Detect objects in an IMAGE and return a DETECTION_DTYPE array.
+
+    Detections are sorted by descending score. When names (e.g.
+    meta.names) is given they are also drawn into im.
+    """
+    buf = get_detect_buffers(net)
+    buf.probs.fill(0)
+    network_detect(net, im, thresh, hier_thresh, nms, buf.boxes_ptr, buf.probs_ptr)
+    probs = buf.probs[:, :buf.classes]
+    j, i = numpy.nonzero(probs > 0)
+    dets = numpy.empty(len(j), dtype=DETECTION_DTYPE)
+    dets["class_id"] = i
+    dets["score"] = probs[j, i]
+    boxes = buf.boxes[j]
+    dets["x"] = boxes[:, 0]
+    dets["y"] = boxes[:, 1]
+    dets["w"] = boxes[:, 2]
+    dets["h"] = boxes[:, 3]
+    if names is not None:
+        draw_detections(im, buf.num, thresh, buf.boxes_ptr, buf.probs_ptr, None, names, get_alphabet(), buf.classes)
+    return dets[numpy.argsort(-dets["score"], kind="mergesort")]
+
+def detect_image(net, meta, im, thresh=.5, hier_thresh=.5, nms=.45):
+    dets = detect_array(net, im, thresh, hier_thresh, nms)
+    return [(meta.names[class_id], score, (x, y, w, h)) for class_id, score, x, y, w, h in dets.tolist()]
+
 def detect(net, meta, image, thresh=.5, hier_thresh=.5, nms=.45):
-    alphabet = load_alphabet()
     im = load_image(image, 0, 0)
-    boxes = make_boxes(net)
-    probs = make_probs(net)
-    num =   num_boxes(net)
-
-    l = get_network_layer(net, get_network_n(net)-1)
-
-    lw = get_layer_w(l)
-    lh = get_layer_h(l)
-    ln = get_layer_n(l)
-    masks = None
-    network_detect(net, im, thresh, hier_thresh, nms, boxes, probs)
-    res = []
-    for j in range(num):
-        for i in range(meta.classes):
-            if probs[j][i] > 0:
-                res.append((meta.names[i], probs[j][i], (boxes[j].x, boxes[j].y, boxes[j].w, boxes[j].h)))
-    res = sorted(res, key=lambda x: -x[1])
-    #draw_detections(im, lw*lh*ln, thresh, boxes, probs, masks, names, alphabet, l.classes);
-    free_alphabet(alphabet)
-    free_boxes(boxes)
+    res = detect_image(net, meta, im, thresh, hier_thresh, nms)
     free_image(im)
-    free_ptrs(cast(probs, POINTER(c_void_p)), num)
     return res
 
 if __name__ == "__main__":
@@ -0,0 +1,206 @@
+from __future__ import print_function
+import atexit
+import logging
+import threading
+import time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from concurrent.futures import Future
+
+import darknet
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class _Request(object):
+    __slots__ = ('image', 'out', 'future')
+
+    def __init__(self, image, out, future):
+        self.image = image
+        self.out = out
+        self.future = future
+
+
+class BatchEngine(object):
+    """Batching detector around a single detector_demo.
+
+    Frames submitted from any thread are collected until batch_size frames
+    are pending or max_wait seconds passed since the first one, then run
+    through the network in one forward pass on the engine thread. Results
+    are delivered through concurrent.futures.Future objects.
+
+    thread_init, if given, is called on the engine thread before the first
+    batch, e.g. to pin it to CPUs.
+    """
+
+    def __init__(self, datacfg, cfgfile, weightfile, thresh=.24, hier_thresh=.5,
+                 batch_size=1, max_wait=0.015, thread_init=None, name='BatchEngine'):
+        logger.info('Init darknet batch engine, batch size %i', batch_size)
+        self.name = name
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.det = darknet.make_detector_demo(datacfg, cfgfile, weightfile, thresh, hier_thresh)
+        # Allocates for full batches, smaller ones only run their own frames
+        darknet.detector_demo_set_batch(self.det, batch_size)
+        net = darknet.detector_demo_get_network(self.det)
+        # Network input resolution, frames are letterboxed to it
+        self.width = darknet.network_width(net)
+        self.height = darknet.network_height(net)
+        meta = darknet.load_meta(datacfg)
+        self.names = darknet.metadata_names(meta)
+        self._buffers = [darknet.ImageBuffer() for _ in range(batch_size)]
+        # Buffers of the threads calling draw
+        self._draw_buffers = threading.local()
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._inflight = 0
+        self._thread_init = thread_init
+        self._thread = threading.Thread(name=name, target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.destroy)
+
+    def submit(self, image, out=None):
+        """Queue an HWC RGB uint8 image for detection.
+
+        Returns a Future resolving to a darknet.DETECTION_DTYPE array. When
+        out is given the annotated image is written into it as BGR before
+        the future completes.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('engine is destroyed')
+            self._queue.put(_Request(image, out, future))
+            self._inflight += 1
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self._lock:
+            self._inflight -= 1
+
+    def process_image(self, image, out=None):
+        if out is None:
+            out = image
+        self.submit(image, out).result()
+        return out
+
+    def detect(self, image, out=None):
+        return self.submit(image, out).result()
+
+    def draw(self, image, dets, out=None):
+        """Draw detections of an earlier frame into image without running the network.
+
+        Runs on the calling thread; the annotated image is written into
+        out, or image itself, as BGR like process_image.
+        """
+        if out is None:
+            out = image
+        buf = getattr(self._draw_buffers, 'buffer', None)
+        if buf is None:
+            buf = self._draw_buffers.buffer = darknet.ImageBuffer()
+        darknet.demo_draw(self.det, buf.load(image), dets)
+        buf.store(out, swap_rb=True)
+        return out
+
+    @property
+    def capacity(self):
+        """Number of frames that can be processed at the same time."""
+        return self.batch_size
+
+    def pending(self):
+        """Return the approximate number of queued frames."""
+        return self._queue.qsize()
+
+    def load(self):
+        """Return the number of submitted frames that are not finished yet."""
+        return self._inflight
+
+    def destroy(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        darknet.free_detector_demo(self.det)
+        self.det = None
+        for buf in self._buffers:
+            buf.free()
+
+    def __del__(self):
+        self.destroy()
+
+    def _next_batch(self):
+        req = self._queue.get()
+        if req is None:
+            return None
+        batch = [req]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=timeout)
+            except Empty:
+                break
+            if req is None:
+                # Finish this batch first, stop on the next round
+                self._queue.put(None)
+                break
+            batch.append(req)
+        return batch
+
+    def _run(self):
+        if self._thread_init is not None:
+            self._thread_init()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            batch = [req for req in batch if req.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self._process_batch(batch)
+            except Exception as e:
+                logger.exception('Error while processing batch')
+                for req in batch:
+                    req.future.set_exception(e)
+            else:
+                for req, dets in zip(batch, results):
+                    req.future.set_result(dets)
+
+    def _process_batch(self, batch):
+        # Drawing is done for the whole batch, frames without out are just not copied back
+        draw = any(req.out is not None for req in batch)
+        if draw:
+            images = [buf.load(req.image) for buf, req in zip(self._buffers, batch)]
+            results = darknet.demo_detect_batch(self.det, images, draw)
+        else:
+            # Nothing to draw, frames go straight into the network input
+            frames = [req.image for req in batch]
+            yuv = sum(isinstance(f, darknet.YUV_FRAME) for f in frames)
+            if yuv == len(frames):
+                results = darknet.demo_detect_yuv(self.det, frames)
+            elif not yuv:
+                results = darknet.demo_detect_frames(self.det, frames)
+            else:
+                images = [buf.load(f) for buf, f in zip(self._buffers, frames)]
+                results = darknet.demo_detect_batch(self.det, images)
+        for stage, seconds in darknet.demo_timings(self.det).items():
+            REGISTRY.observe('detector_stage_seconds', seconds, detector=self.name, stage=stage)
+        REGISTRY.inc('detector_batches_total', detector=self.name)
+        REGISTRY.inc('detector_frames_total', len(batch), detector=self.name)
+        for buf, req in zip(self._buffers, batch):
+            if req.out is not None:
+                buf.store(req.out, swap_rb=True)
+        return results
@@ -0,0 +1,121 @@
+from __future__ import print_function
+import atexit
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+
+import darknet
+from detengine import BatchEngine
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus():
+    """Return the sorted list of CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def split_cpus(cpus, n):
+    """Split cpus into n contiguous, nearly equal sized groups."""
+    size, rest = divmod(len(cpus), n)
+    groups = []
+    start = 0
+    for i in range(n):
+        end = start + size + (1 if i < rest else 0)
+        groups.append(cpus[start:end] or cpus)
+        start = end
+    return groups
+
+
+def _make_thread_init(cpus, num_threads):
+    def thread_init():
+        # Pins the engine thread; OpenMP threads it starts inherit the affinity
+        if cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        if num_threads:
+            darknet.set_num_threads(num_threads)
+        logger.info('Detector thread %s pinned to CPUs %s with %s threads',
+                    threading.current_thread().name, cpus, num_threads)
+
+    return thread_init
+
+
+class DetectorPool(object):
+    """Pool of independent detectors with least-loaded dispatch.
+
+    Each worker is a BatchEngine with its own network running on its own
+    thread; since ctypes releases the GIL during calls into darknet the
+    workers run inference concurrently. With pin_cpus the available CPUs
+    are split between the workers and every worker uses as many OpenMP
+    threads as it has CPUs, unless num_threads is given.
+    """
+
+    def __init__(self, datacfg, cfgfile, weightfile, thresh=.24, hier_thresh=.5,
+                 size=1, batch_size=1, max_wait=0.015, pin_cpus=True, num_threads=None):
+        logger.info('Init detector pool with %i workers', size)
+        if pin_cpus:
+            cpu_groups = split_cpus(available_cpus(), size)
+        else:
+            cpu_groups = [None] * size
+        self.workers = []
+        for i, cpus in enumerate(cpu_groups):
+            threads = num_threads or (len(cpus) if cpus else None)
+            self.workers.append(BatchEngine(datacfg, cfgfile, weightfile, thresh, hier_thresh,
+                                            batch_size=batch_size, max_wait=max_wait,
+                                            thread_init=_make_thread_init(cpus, threads),
+                                            name='Detector-{}'.format(i)))
+        self.names = self.workers[0].names
+        # Rotates the start of the search so ties are spread over all workers
+        self._counter = itertools.count()
+        atexit.register(self.destroy)
+
+    @property
+    def size(self):
+        return len(self.workers)
+
+    @property
+    def input_size(self):
+        """(width, height) of the network input."""
+        worker = self.workers[0]
+        return worker.width, worker.height
+
+    @property
+    def capacity(self):
+        """Number of frames that can be processed at the same time."""
+        return sum(w.capacity for w in self.workers)
+
+    def least_loaded(self):
+        start = next(self._counter) % len(self.workers)
+        workers = self.workers[start:] + self.workers[:start]
+        return min(workers, key=lambda w: w.load())
+
+    def submit(self, image, out=None):
+        """Queue an image on the least loaded worker, see BatchEngine.submit."""
+        return self.least_loaded().submit(image, out)
+
+    def process_image(self, image, out=None):
+        if out is None:
+            out = image
+        self.submit(image, out).result()
+        return out
+
+    def detect(self, image, out=None):
+        return self.submit(image, out).result()
+
+    def draw(self, image, dets, out=None):
+        """Draw detections into image on the calling thread, see BatchEngine.draw."""
+        return self.workers[0].draw(image, dets, out)
+
+    def load(self):
+        return sum(w.load() for w in self.workers)
+
+    def destroy(self):
+        for w in self.workers:
+            w.destroy()
+
+    def __del__(self):
+        self.destroy()
@@ -0,0 +1,157 @@
+from __future__ import print_function
+import logging
+import mmap
+import os
+import threading
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# Slots start on page boundaries so every frame is aligned for vectorized access
+SLOT_ALIGNMENT = mmap.PAGESIZE
+
+
+def _align(size, alignment=SLOT_ALIGNMENT):
+    return (size + alignment - 1) // alignment * alignment
+
+
+class FrameSlot(object):
+    """One frame sized region of a FrameRing.
+
+    The slot memory stays mapped for the lifetime of the ring; array()
+    returns an HWC uint8 view of the current frame without copying. Planar
+    YUV frames record the (offset, stride) of each plane in planes, their
+    array() is the luma plane, bt709 tells their color matrix.
+    """
+
+    def __init__(self, ring, index):
+        self.ring = ring
+        self.index = index
+        self.data = numpy.frombuffer(ring.mmap, dtype=numpy.uint8, count=ring.slot_size,
+                                     offset=index * ring.slot_size)
+        self.width = 0
+        self.height = 0
+        self.depth = 0
+        self.bytes_per_line = 0
+        self.size = 0
+        self.format = 'RGB'
+        self.planes = None
+        self.bt709 = False
+        self.pts = None
+        self.duration = None
+        self.seq = None
+
+    def write(self, data, width, height, depth=3, bytes_per_line=None, pts=None, seq=None, duration=None,
+              format='RGB', planes=None, bt709=False):
+        """Copy a frame from any buffer-protocol object into the slot."""
+        src = numpy.frombuffer(data, dtype=numpy.uint8)
+        if src.size > self.ring.slot_size:
+            raise ValueError('frame of {} bytes does not fit into slot of {} bytes'.format(
+                src.size, self.ring.slot_size))
+        self.data[:src.size] = src
+        self.set_frame(width, height, depth, bytes_per_line, pts, seq, duration, format, planes, src.size, bt709)
+
+    def set_frame(self, width, height, depth=3, bytes_per_line=None, pts=None, seq=None, duration=None,
+                  format='RGB', planes=None, size=None, bt709=False):
+        """Set the geometry of a frame written directly into data.
+
+        seq is the number of the frame within its stream, size the number
+        of bytes it takes in data.
+        """
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.bytes_per_line = bytes_per_line or width * depth
+        self.size = size or self.bytes_per_line * height
+        self.format = format
+        self.planes = planes
+        self.bt709 = bt709
+        self.pts = pts
+        self.duration = duration
+        self.seq = seq
+
+    def array(self):
+        return _frame_view(self.data, self.width, self.height, self.depth, self.bytes_per_line)
+
+    def descriptor(self):
+        """Return a small picklable description of the frame for FrameRing.view."""
+        return (self.index, self.width, self.height, self.depth, self.bytes_per_line, self.pts, self.seq)
+
+    def release(self):
+        self.ring.release(self)
+
+
+def _frame_view(data, width, height, depth, bytes_per_line):
+    return numpy.ndarray((height, width, depth), dtype=numpy.uint8, buffer=data,
+                         strides=(bytes_per_line, depth, 1))
+
+
+class FrameRing(object):
+    """Ring of preallocated frame slots in shared memory.
+
+    Producers acquire() a free slot, fill it and hand it to a consumer,
+    which reads the frame in place and release()s the slot afterwards.
+    Without path the ring is an anonymous shared mapping inherited by
+    forked worker processes; with path (e.g. below /dev/shm) unrelated
+    processes can map the same slots with FrameRing.attach and pass frames
+    around as slot descriptors instead of pickled pixel data.
+    """
+
+    def __init__(self, num_slots, slot_size, path=None, create=True):
+        self.num_slots = num_slots
+        self.slot_size = _align(slot_size)
+        self.path = path
+        self.owner = create
+        size = self.slot_size * num_slots
+        if path is None:
+            self.mmap = mmap.mmap(-1, size)
+        else:
+            flags = os.O_RDWR | (os.O_CREAT | os.O_TRUNC if create else 0)
+            fd = os.open(path, flags, 0o600)
+            try:
+                if create:
+                    os.ftruncate(fd, size)
+                self.mmap = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        self.slots = [FrameSlot(self, i) for i in range(num_slots)]
+        self._free = list(range(num_slots))
+        self._cond = threading.Condition()
+
+    @classmethod
+    def attach(cls, path, num_slots, slot_size):
+        """Map the slots of a ring created by another process."""
+        return cls(num_slots, slot_size, path=path, create=False)
+
+    def acquire(self, timeout=0):
+        """Return a free slot, or None if none became free within timeout.
+
+        timeout=None blocks until a slot is released.
+        """
+        with self._cond:
+            if timeout is None:
+                while not self._free:
+                    self._cond.wait()
+            elif not self._free and timeout > 0:
+                self._cond.wait(timeout)
+            if not self._free:
+                return None
+            return self.slots[self._free.pop()]
+
+    def release(self, slot):
+        with self._cond:
+            self._free.append(slot.index)
+            self._cond.notify()
+
+    def free_slots(self):
+        return len(self._free)
+
+    def view(self, descriptor):
+        """Return the HWC frame described by FrameSlot.descriptor()."""
+        index, width, height, depth, bytes_per_line = descriptor[:5]
+        return _frame_view(self.slots[index].data, width, height, depth, bytes_per_line)
+
+    def close(self):
+        if self.owner and self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
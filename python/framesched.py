@@ -0,0 +1,208 @@
+from __future__ import print_function
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FrameStats(object):
+    """Frame counters and timings of one stream."""
+
+    # Weight of the newest sample in the moving averages
+    EMA_ALPHA = 0.1
+
+    def __init__(self):
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.queue_age = 0.0
+        self.max_queue_age = 0.0
+        self.avg_queue_age = 0.0
+        self.avg_process_time = 0.0
+
+    def _ema(self, avg, value):
+        return value if avg == 0.0 else avg + self.EMA_ALPHA * (value - avg)
+
+    def add_queue_age(self, age):
+        self.queue_age = age
+        self.max_queue_age = max(self.max_queue_age, age)
+        self.avg_queue_age = self._ema(self.avg_queue_age, age)
+
+    def add_process_time(self, duration):
+        self.avg_process_time = self._ema(self.avg_process_time, duration)
+
+    def snapshot(self):
+        return dict(self.__dict__)
+
+
+class FrameScheduler(object):
+    """Decides which frames of a stream are processed and when.
+
+    The producer first asks admit() whether the next frame is wanted at
+    all, which avoids copying frames the policy would drop anyway, and
+    then hands the frame over with push(). Frames are run through process
+    on executor, at most max_in_flight at a time and in arrival order;
+    every frame that is not processed is passed to drop, e.g. to release
+    its frame slot. This base class queues without limit; subclasses
+    implement the dropping policies.
+    """
+
+    def __init__(self, executor, process, drop=None, max_in_flight=1):
+        self.executor = executor
+        self.process = process
+        self.drop = drop
+        self.max_in_flight = max_in_flight
+        self.stats = FrameStats()
+        self._pending = collections.deque()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def admit(self):
+        """Count a received frame and return whether the policy wants it."""
+        with self._lock:
+            self.stats.received += 1
+            if self._want_frame(time.time()):
+                return True
+            self.stats.dropped += 1
+            return False
+
+    def reject(self):
+        """Count an admitted frame that could not be delivered."""
+        with self._lock:
+            self.stats.dropped += 1
+
+    def push(self, frame):
+        with self._lock:
+            if self._closed:
+                self._drop(frame)
+                return
+            self._enqueue(frame, time.time())
+            self._schedule()
+
+    def pending(self):
+        return len(self._pending)
+
+    def close(self):
+        """Drop all pending frames and stop scheduling new ones."""
+        with self._lock:
+            self._closed = True
+            while self._pending:
+                self._drop(self._pending.popleft()[0])
+
+    # Policy hooks, called with the lock held
+
+    def _want_frame(self, now):
+        return True
+
+    def _enqueue(self, frame, now):
+        self._pending.append((frame, now))
+
+    def _drop(self, frame):
+        self.stats.dropped += 1
+        if self.drop is not None:
+            self.drop(frame)
+
+    def _schedule(self):
+        while self._pending and self._in_flight < self.max_in_flight:
+            frame, queued = self._pending.popleft()
+            self.stats.add_queue_age(time.time() - queued)
+            self._in_flight += 1
+            self.executor.submit(self._run, frame)
+
+    def _run(self, frame):
+        start = time.time()
+        try:
+            self.process(frame)
+        except Exception:
+            logger.exception('Error while processing frame')
+            with self._lock:
+                self.stats.errors += 1
+        else:
+            # Failed frames count as errors only, so received == processed + dropped + errors
+            with self._lock:
+                self.stats.processed += 1
+        finally:
+            with self._lock:
+                self.stats.add_process_time(time.time() - start)
+                self._in_flight -= 1
+                if not self._closed:
+                    self._schedule()
+
+
+class LatestOnlyScheduler(FrameScheduler):
+    """Keeps only the newest waiting frame, older ones are dropped."""
+
+    def _enqueue(self, frame, now):
+        while self._pending:
+            self._drop(self._pending.popleft()[0])
+        self._pending.append((frame, now))
+
+
+class BoundedQueueScheduler(FrameScheduler):
+    """Queues up to maxlen frames and drops the oldest when full."""
+
+    def __init__(self, executor, process, drop=None, max_in_flight=1, maxlen=2):
+        super(BoundedQueueScheduler, self).__init__(executor, process, drop, max_in_flight)
+        self.maxlen = maxlen
+
+    def _enqueue(self, frame, now):
+        while len(self._pending) >= self.maxlen:
+            self._drop(self._pending.popleft()[0])
+        self._pending.append((frame, now))
+
+
+class EveryNthScheduler(LatestOnlyScheduler):
+    """Considers only every n-th received frame, latest wins among those."""
+
+    def __init__(self, executor, process, drop=None, max_in_flight=1, n=2):
+        super(EveryNthScheduler, self).__init__(executor, process, drop, max_in_flight)
+        self.n = n
+
+    def _want_frame(self, now):
+        return (self.stats.received - 1) % self.n == 0
+
+
+class AdaptiveFpsScheduler(LatestOnlyScheduler):
+    """Admits frames at target_fps or at the rate processing sustains.
+
+    The admission interval is the larger of 1 / target_fps and the
+    average processing time per frame divided by max_in_flight, so frames
+    that could only wait in the queue are not copied at all.
+    """
+
+    def __init__(self, executor, process, drop=None, max_in_flight=1, target_fps=10.0):
+        super(AdaptiveFpsScheduler, self).__init__(executor, process, drop, max_in_flight)
+        self.target_fps = target_fps
+        self._next_time = 0.0
+
+    def interval(self):
+        return max(1.0 / self.target_fps, self.stats.avg_process_time / self.max_in_flight)
+
+    def _want_frame(self, now):
+        if now < self._next_time:
+            return False
+        interval = self.interval()
+        # Stay on the frame grid, but do not burst to catch up after a stall
+        self._next_time = max(self._next_time + interval, now + interval / 2)
+        return True
+
+
+SCHEDULERS = {
+    'latest': LatestOnlyScheduler,
+    'queue': BoundedQueueScheduler,
+    'nth': EveryNthScheduler,
+    'fps': AdaptiveFpsScheduler,
+}
+
+
+def make_scheduler(policy, executor, process, drop=None, **kwargs):
+    """Create a scheduler by policy name, see SCHEDULERS."""
+    try:
+        cls = SCHEDULERS[policy]
+    except KeyError:
+        raise ValueError('Unknown frame scheduling policy: {}'.format(policy))
+    return cls(executor, process, drop, **kwargs)
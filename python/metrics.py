@@ -0,0 +1,198 @@
+from __future__ import division
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond draws to slow forward passes
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .075, .1, .15, .25, .5, 1.0, 2.5)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in items) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    """Cumulative latency histogram with fixed buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    def samples(self):
+        """Return ([(upper bound, cumulative count)], count, sum)."""
+        with self._lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        cumulative = []
+        acc = 0
+        for bound, c in zip(self.buckets, counts):
+            acc += c
+            cumulative.append((bound, acc))
+        return cumulative, count, total
+
+
+class Counter(object):
+    """Monotonic counter."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class MetricsRegistry(object):
+    """Named histograms and counters with labels, rendered as Prometheus text.
+
+    Metrics are created on first use. Labels are passed as keyword
+    arguments, e.g. observe('stage_seconds', 0.01, stream='cam1', stage='forward').
+    """
+
+    def __init__(self, prefix='darknet_'):
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def _get(self, metrics, name, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = metrics.setdefault(key, factory())
+        return metric
+
+    def histogram(self, name, **labels):
+        return self._get(self._histograms, name, labels, Histogram)
+
+    def counter(self, name, **labels):
+        return self._get(self._counters, name, labels, Counter)
+
+    def histograms(self, name, **labels):
+        """Return (labels dict, Histogram) pairs of the histograms of name carrying the given label values."""
+        match = set(labels.items())
+        with self._lock:
+            items = sorted(self._histograms.items())
+        return [(dict(key[1]), hist) for key, hist in items if key[0] == name and match.issubset(key[1])]
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        self.counter(name, **labels).inc(amount)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe the wall time spent in the with block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def add_collector(self, collect):
+        """Register a callable returning (name, type, labels dict, value) samples at render time."""
+        with self._lock:
+            self._collectors.append(collect)
+
+    def remove_collector(self, collect):
+        with self._lock:
+            if collect in self._collectors:
+                self._collectors.remove(collect)
+
+    def remove(self, **labels):
+        """Drop all metrics carrying the given label values, e.g. of a closed stream."""
+        match = set(labels.items())
+        with self._lock:
+            for metrics in (self._histograms, self._counters):
+                for key in [k for k in metrics if match.issubset(k[1])]:
+                    del metrics[key]
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            collectors = list(self._collectors)
+        last = None
+        for (name, labels), hist in histograms:
+            full = self.prefix + name
+            if name != last:
+                if name in self._help:
+                    lines.append('# HELP {} {}'.format(full, self._help[name]))
+                lines.append('# TYPE {} histogram'.format(full))
+                last = name
+            buckets, count, total = hist.samples()
+            for bound, acc in buckets:
+                lines.append('{}_bucket{} {}'.format(full, _format_labels(labels, [('le', _format_value(bound))]),
+                                                      acc))
+            lines.append('{}_sum{} {}'.format(full, _format_labels(labels), _format_value(total)))
+            lines.append('{}_count{} {}'.format(full, _format_labels(labels), count))
+        last = None
+        for (name, labels), counter in counters:
+            full = self.prefix + name
+            if name != last:
+                if name in self._help:
+                    lines.append('# HELP {} {}'.format(full, self._help[name]))
+                lines.append('# TYPE {} counter'.format(full))
+                last = name
+            lines.append('{}{} {}'.format(full, _format_labels(labels), counter.value))
+        collected = {}
+        for collect in collectors:
+            for name, kind, labels, value in collect():
+                collected.setdefault((name, kind), []).append((sorted(labels.items()), value))
+        for (name, kind), samples in sorted(collected.items()):
+            full = self.prefix + name
+            if name in self._help:
+                lines.append('# HELP {} {}'.format(full, self._help[name]))
+            lines.append('# TYPE {} {}'.format(full, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(full, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+REGISTRY.describe('stage_seconds', 'Time spent per frame in a processing stage.')
+REGISTRY.describe('detector_stage_seconds', 'Time spent per detector batch in a darknet stage.')
+REGISTRY.describe('detector_batches_total', 'Forward passes run by a detector.')
+REGISTRY.describe('detector_frames_total', 'Frames run through a detector.')
+REGISTRY.describe('frames_total', 'Frames per stream by outcome.')
+REGISTRY.describe('queue_age_seconds', 'Average time frames waited for the detector.')
+REGISTRY.describe('sent_bytes_total', 'Bytes sent to websocket clients.')
+REGISTRY.describe('send_lag_seconds', 'Time messages waited in the send queue of a client.')
+REGISTRY.describe('send_dropped_total', 'Messages dropped because a client fell behind.')
+REGISTRY.describe('send_queue_length', 'Messages waiting to be sent to a client.')
+REGISTRY.describe('motion_gate_frames_total', 'Frames the motion gate passed to the detector or skipped.')
@@ -0,0 +1,76 @@
+from __future__ import division
+import logging
+import threading
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# Mean luma change of a grid cell, in 0-255 levels, that counts as motion
+DEFAULT_THRESHOLD = 4.0
+# Frames after which detection runs again even without motion
+DEFAULT_REFRESH_INTERVAL = 30
+# Cells the frame is averaged into, (columns, rows)
+DEFAULT_GRID = (32, 18)
+
+
+def thumbnail(frame, grid=DEFAULT_GRID, step=2):
+    """Average an HWC uint8 frame into a grid of mean luma values.
+
+    Only every step-th pixel of every step-th row is read. Three channel
+    frames are averaged over their channels, one channel frames such as
+    the luma plane of a YUV frame are used as they are.
+    """
+    a = frame[::step, ::step]
+    h, w = a.shape[:2]
+    cols, rows = min(grid[0], w), min(grid[1], h)
+    a = a[:h // rows * rows, :w // cols * cols]
+    if a.ndim == 3:
+        a = a.mean(axis=2, dtype=numpy.float32) if a.shape[2] > 1 else a[:, :, 0]
+    cells = a.reshape(rows, h // rows, cols, w // cols)
+    return cells.mean(axis=(1, 3), dtype=numpy.float32)
+
+
+class MotionGate(object):
+    """Decides whether a frame of a static camera needs to be detected again.
+
+    Frames are reduced to a grid of mean luma values and compared to the
+    last frame that was let through. Only when a cell changed by more
+    than threshold, or refresh_interval frames passed, update() returns
+    True; otherwise the detections of that last frame still apply.
+    Averaging over cells hides sensor noise while an object moving
+    through a single cell is still noticed.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 grid=DEFAULT_GRID, step=2):
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        self.grid = grid
+        self.step = step
+        self.passed = 0
+        self.skipped = 0
+        self._reference = None
+        self._since = 0
+        self._lock = threading.Lock()
+
+    def update(self, frame):
+        """Return whether frame has to go through the detector."""
+        thumb = thumbnail(frame, self.grid, self.step)
+        with self._lock:
+            ref = self._reference
+            self._since += 1
+            if (ref is None or ref.shape != thumb.shape or self._since >= self.refresh_interval or
+                    numpy.abs(thumb - ref).max() > self.threshold):
+                self._reference = thumb
+                self._since = 0
+                self.passed += 1
+                return True
+            self.skipped += 1
+            return False
+
+    def reset(self):
+        """Let the next frame through, e.g. after a seek."""
+        with self._lock:
+            self._reference = None
+            self._since = 0
@@ -0,0 +1,34 @@
+from __future__ import print_function
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def decode_ahead(pool, decode, paths, depth, errors=(IOError, OSError)):
+    """Yield (path, decode(path)) in the order of paths, decoding on pool ahead of the caller.
+
+    Up to depth paths are submitted to the executor pool before their
+    result is taken, so reading and decoding overlap with whatever the
+    caller does with the previous results. A failed path yields None: when
+    decode raised one of errors or returned None itself, both are logged.
+    """
+    pending = collections.deque()
+
+    def take():
+        path, future = pending.popleft()
+        try:
+            result = future.result()
+        except errors as e:
+            logger.warning('Cannot read %s: %s', path, e)
+            return path, None
+        if result is None:
+            logger.warning('Cannot decode %s', path)
+        return path, result
+
+    for path in paths:
+        pending.append((path, pool.submit(decode, path)))
+        if len(pending) >= depth:
+            yield take()
+    while pending:
+        yield take()
@@ -1,4 +1,6 @@
+from __future__ import print_function
 from darknet import *
+from charrnn import CharRNN
 
 def predict_tactic(net, s):
     prob = 0
@@ -24,14 +26,15 @@ def predict_tactic(net, s):
         tac = tac + c
     return (tac, prob)
 
-def predict_tactics(net, s, n):
-    tacs = []
-    for i in range(n):
-        reset_rnn(net)
-        tacs.append(predict_tactic(net, s))
-    tacs = sorted(tacs, key=lambda x: -x[1])
-    return tacs
+def predict_tactics(rnn, s, n, temperature=1.0, top_k=None):
+    """Sample n tactics together through a CharRNN, best first."""
+    return rnn.sample(s, n, temperature=temperature, top_k=top_k, stop='.')
 
-net = load_net("cfg/coq.test.cfg", "/home/pjreddie/backup/coq.backup", 0)
-t = predict_tactics(net, "+++++\n", 10)
-print t
+def search_tactics(rnn, s, n):
+    """Return the n most likely tactics by beam search."""
+    return rnn.beam_search(s, n, stop='.')
+
+if __name__ == "__main__":
+    rnn = CharRNN.load("cfg/coq.test.cfg", "/home/pjreddie/backup/coq.backup", 10)
+    t = predict_tactics(rnn, "+++++\n", 10)
+    print(t)
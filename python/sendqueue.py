@@ -0,0 +1,112 @@
+from __future__ import print_function
+import collections
+import logging
+import threading
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Messages a client may fall behind before old ones are dropped
+DEFAULT_MAXLEN = 4
+
+
+class SendQueue(object):
+    """Bounded queue of outgoing messages of one websocket client.
+
+    put() may be called from any thread; messages are written on the
+    IOLoop one at a time and the next write only starts once the previous
+    one was flushed to the socket, so a slow client cannot make Tornado
+    buffer without limit. When maxlen messages are waiting the oldest is
+    dropped, which suits self contained messages such as JPEG frames or
+    detections. Streams that cannot lose data, like WEBM, pass
+    drop_oldest=False: the queue of a client that falls behind is closed
+    and on_overflow called once, e.g. to close the connection.
+
+    Queue lag, write times, drops and bytes are recorded in the metrics
+    registry with the given labels.
+    """
+
+    def __init__(self, write, maxlen=DEFAULT_MAXLEN, drop_oldest=True, on_overflow=None, io_loop=None,
+                 **labels):
+        self.write = write
+        self.maxlen = maxlen
+        self.drop_oldest = drop_oldest
+        self.on_overflow = on_overflow
+        self.io_loop = io_loop or IOLoop.current()
+        self.labels = labels
+        self.sent = 0
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._writing = False
+        self._closed = False
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, data, binary=True):
+        """Queue a message, returns False if the queue is closed or overflowed."""
+        overflow = False
+        with self._lock:
+            if self._closed:
+                return False
+            if len(self._queue) >= self.maxlen:
+                if self.drop_oldest:
+                    self._queue.popleft()
+                    self.dropped += 1
+                    REGISTRY.inc('send_dropped_total', **self.labels)
+                else:
+                    # Nothing more is sent to a client that lost data
+                    overflow = True
+                    self._closed = True
+                    self._queue.clear()
+            if not overflow:
+                self._queue.append((data, binary, time.time()))
+            start = not overflow and not self._writing
+            if start:
+                self._writing = True
+        if overflow:
+            logger.warning('Client %s fell behind by %i messages', self.labels, self.maxlen)
+            if self.on_overflow is not None:
+                self.io_loop.add_callback(self.on_overflow)
+            return False
+        if start:
+            self.io_loop.add_callback(self._drain)
+        return True
+
+    @gen.coroutine
+    def _drain(self):
+        while True:
+            with self._lock:
+                if self._closed or not self._queue:
+                    self._writing = False
+                    return
+                data, binary, queued = self._queue.popleft()
+            start = time.time()
+            REGISTRY.observe('send_lag_seconds', start - queued, **self.labels)
+            try:
+                yield self.write(data, binary=binary)
+            except (WebSocketClosedError, StreamClosedError):
+                logger.info('Client %s closed while sending', self.labels)
+                self.close()
+                return
+            self.sent += 1
+            REGISTRY.observe('stage_seconds', time.time() - start, stage='send', **self.labels)
+            REGISTRY.inc('sent_bytes_total', len(data), **self.labels)
+
+    def close(self):
+        """Drop all queued messages, later puts are ignored."""
+        with self._lock:
+            self._closed = True
+            self._queue.clear()
+
+    def collect_metrics(self):
+        """Queue length of the client, see metrics.MetricsRegistry.add_collector."""
+        yield 'send_queue_length', 'gauge', self.labels, len(self._queue)
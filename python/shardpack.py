@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""Pack an image list and its darknet labels into a few large shard files.
+
+Training lists such as the train.txt of scripts/voc_label.py point to
+millions of full size JPEGs with one label .txt each. This packs them into
+shards of pre-resized pixels that are read with sequential I/O and need no
+decoding:
+
+    python python/shardpack.py train.txt -o shards/voc --size 416x416
+    python python/shardpack.py train.txt -o shards/voc --max-side 608 --shard-images 20000
+
+Every shard NAME-NNNNN consists of
+    NAME-NNNNN.bin        the HWC uint8 RGB pixels of its images, each
+                          starting at a multiple of ALIGNMENT bytes
+    NAME-NNNNN.index.npy  one INDEX_DTYPE record per image: the offset and
+                          size of its pixels and its range of boxes
+    NAME-NNNNN.boxes.npy  the (n, 5) float32 class, x, y, w, h boxes of all
+                          images, relative to the image size like the labels
+and NAME.json lists the shards with their image counts. All parts can be
+memory mapped; ShardReader reads them. NAME.shards lists the shard names
+one per line for darknet, which trains on them instead of an image list
+when the .data file has
+
+    shards = shards/voc.shards
+"""
+from __future__ import print_function, division
+import argparse
+import collections
+import functools
+import json
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+import darknet
+from prefetch import decode_ahead
+
+logger = logging.getLogger(__name__)
+
+INDEX_DTYPE = numpy.dtype([
+    ("offset", "<u8"),
+    ("height", "<u4"),
+    ("width", "<u4"),
+    ("box_start", "<u8"),
+    ("box_count", "<u4"),
+])
+
+# Pixel data of every image starts at a multiple of this
+ALIGNMENT = 64
+
+
+def label_path(path):
+    """Return the label file darknet reads for an image path, see fill_truth_region."""
+    for find, replace in (("images", "labels"), ("JPEGImages", "labels"), (".jpg", ".txt"), (".png", ".txt"),
+                          (".JPG", ".txt"), (".JPEG", ".txt")):
+        path = path.replace(find, replace, 1)
+    return path
+
+
+def read_labels(path):
+    """Return the boxes of a label file as an (n, 5) float32 array, empty when it is missing.
+
+    Raises ValueError if the file does not hold rows of five numbers.
+    """
+    try:
+        with open(path) as f:
+            values = f.read().split()
+    except IOError:
+        return numpy.zeros((0, 5), dtype=numpy.float32)
+    try:
+        return numpy.array(values, dtype=numpy.float32).reshape(-1, 5)
+    except ValueError:
+        raise ValueError('malformed labels in {}'.format(path))
+
+
+def target_size(width, height, size=None, max_side=None):
+    """Size images are stored at: size, or scaled down so no side exceeds max_side."""
+    if size is not None:
+        return size
+    if max_side is None or max(width, height) <= max_side:
+        return width, height
+    scale = max_side / max(width, height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def load_resized(path, size=None, max_side=None):
+    """Decode and resize one image to HWC uint8, or return None if it cannot be decoded."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    im = darknet.load_image_memory(data, len(data), 3)
+    if not im.data:
+        return None
+    try:
+        w, h = target_size(im.w, im.h, size, max_side)
+        if (w, h) != (im.w, im.h):
+            resized = darknet.resize_image(im, w, h)
+            darknet.free_image(im)
+            im = resized
+        pixels = darknet.image_to_array(im).transpose(1, 2, 0) * 255 + .5
+        return numpy.clip(pixels, 0, 255).astype(numpy.uint8)
+    finally:
+        darknet.free_image(im)
+
+
+class ShardWriter(object):
+    """Appends images and their boxes to numbered shards of at most shard_images images."""
+
+    def __init__(self, prefix, shard_images=10000):
+        self.prefix = prefix
+        self.shard_images = shard_images
+        self.shards = []
+        self._bin = None
+
+    def _open(self):
+        self._name = '%s-%05d' % (self.prefix, len(self.shards))
+        self._bin = open(self._name + '.bin', 'wb')
+        self._offset = 0
+        self._index = []
+        self._boxes = []
+        self._box_count = 0
+
+    def _close_shard(self):
+        self._bin.close()
+        self._bin = None
+        numpy.save(self._name + '.index.npy', numpy.array(self._index, dtype=INDEX_DTYPE))
+        boxes = numpy.concatenate(self._boxes) if self._boxes else numpy.zeros((0, 5), dtype=numpy.float32)
+        numpy.save(self._name + '.boxes.npy', boxes)
+        self.shards.append({'name': os.path.basename(self._name), 'images': len(self._index),
+                            'boxes': self._box_count})
+
+    def add(self, pixels, boxes):
+        if self._bin is None:
+            self._open()
+        h, w = pixels.shape[:2]
+        self._bin.write(numpy.ascontiguousarray(pixels).tobytes())
+        padding = -(self._offset + pixels.nbytes) % ALIGNMENT
+        self._bin.write(b'\0' * padding)
+        self._index.append((self._offset, h, w, self._box_count, len(boxes)))
+        self._offset += pixels.nbytes + padding
+        self._boxes.append(boxes)
+        self._box_count += len(boxes)
+        if len(self._index) == self.shard_images:
+            self._close_shard()
+
+    def close(self, **info):
+        """Finish the last shard and write the manifest, info is stored in it too."""
+        if self._bin is not None:
+            self._close_shard()
+        manifest = dict(info, shards=self.shards, images=sum(s['images'] for s in self.shards))
+        with open(self.prefix + '.json', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        # Read by load_shards in src/data.c, names are relative to the list
+        with open(self.prefix + '.shards', 'w') as f:
+            f.writelines(s['name'] + '\n' for s in self.shards)
+        return manifest
+
+
+class ShardReader(object):
+    """Reads the images and boxes of the shards written by shardpack.
+
+    Iterating yields (pixels, boxes) pairs shard after shard, in the order
+    of the packed list, as read only views of the memory mapped shards.
+    Images can also be accessed by position.
+    """
+
+    def __init__(self, manifest):
+        if not manifest.endswith('.json'):
+            manifest += '.json'
+        with open(manifest) as f:
+            self.manifest = json.load(f)
+        self.dirname = os.path.dirname(manifest)
+        self.names = [s['name'] for s in self.manifest['shards']]
+        self._starts = numpy.cumsum([0] + [s['images'] for s in self.manifest['shards']])
+        self._open = {}
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def shard(self, i):
+        """Return the memory mapped (pixels, index, boxes) arrays of shard i."""
+        parts = self._open.get(i)
+        if parts is None:
+            base = os.path.join(self.dirname, self.names[i])
+            index = numpy.load(base + '.index.npy', mmap_mode='r')
+            boxes = numpy.load(base + '.boxes.npy', mmap_mode='r')
+            pixels = numpy.memmap(base + '.bin', dtype=numpy.uint8, mode='r') if len(index) else None
+            parts = self._open[i] = (pixels, index, boxes)
+        return parts
+
+    def _record(self, parts, j):
+        pixels, index, boxes = parts
+        offset, h, w, box_start, box_count = index[j].tolist()
+        image = pixels[offset:offset + h * w * 3].reshape(h, w, 3)
+        return image, boxes[box_start:box_start + box_count]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        s = int(numpy.searchsorted(self._starts, i, side='right')) - 1
+        return self._record(self.shard(s), i - int(self._starts[s]))
+
+    def __iter__(self):
+        for s in range(len(self.names)):
+            parts = self.shard(s)
+            for j in range(len(parts[1])):
+                yield self._record(parts, j)
+            # Shards are read once when streaming, do not keep them mapped
+            self._open.pop(s, None)
+
+
+def iter_list(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def load_record(path, size=None, max_side=None):
+    """Return the resized pixels and the boxes of one list entry, None if the image is broken."""
+    pixels = load_resized(path, size, max_side)
+    if pixels is None:
+        return None
+    return pixels, read_labels(label_path(path))
+
+
+def pack(paths, writer, size=None, max_side=None, workers=4, prefetch=64):
+    """Decode paths on a thread pool and add them to writer in list order.
+
+    Images that cannot be read or decoded and malformed label files are
+    skipped. Returns counts of packed and failed images.
+    """
+    stats = collections.Counter()
+    pool = ThreadPoolExecutor(workers)
+    load = functools.partial(load_record, size=size, max_side=max_side)
+    try:
+        for path, record in decode_ahead(pool, load, paths, prefetch, errors=(IOError, OSError, ValueError)):
+            if record is None:
+                stats['failed'] += 1
+                continue
+            writer.add(*record)
+            stats['packed'] += 1
+    finally:
+        pool.shutdown()
+    return stats
+
+
+def _size(s):
+    w, h = s.lower().split('x')
+    return int(w), int(h)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('lists', nargs='+', help='image list files, e.g. train.txt')
+    parser.add_argument('-o', '--output', required=True, help='path and name prefix of the shards')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--size', type=_size, help='resize every image to WxH, e.g. the network resolution')
+    group.add_argument('--max-side', type=int, help='scale images down to at most this many pixels per side')
+    parser.add_argument('--shard-images', type=int, default=10000, help='images per shard')
+    parser.add_argument('--workers', type=int, default=4, help='threads reading and resizing images')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = parse_args(argv)
+    dirname = os.path.dirname(args.output)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    start = time.time()
+    writer = ShardWriter(args.output, args.shard_images)
+    paths = (path for l in args.lists for path in iter_list(l))
+    stats = pack(paths, writer, args.size, args.max_side, args.workers, args.workers * 16)
+    manifest = writer.close(lists=args.lists, size=args.size, max_side=args.max_side)
+    logger.info('Packed %i images into %i shards in %.1fs, %i failed', stats['packed'],
+                len(manifest['shards']), time.time() - start, stats['failed'])
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
 
 import os
 import os.path
+import itertools
 import signal
 import sys
 
@@ -18,12 +19,18 @@ import tornado.web
 import tornado.websocket
 from tornado.options import define, options
 
-from streamproc import StreamProc, glib_thread
+import metrics
+import streamproc
+from motiongate import MotionGate
+from sendqueue import SendQueue
+from streamhub import HUB
+from tracker import IouTracker
+from streamproc import StreamProc
 
 
 def signal_term_handler(signal, frame):
     print('Got signal {}, exiting'.format(signal), file=sys.stderr)
-    glib_thread.stop()
+    streamproc.shutdown()
     sys.exit(0)
 
 
@@ -31,23 +38,64 @@ signal.signal(signal.SIGTERM, signal_term_handler)
 signal.signal(signal.SIGINT, signal_term_handler)
 
 define("port", default=8888, help="run on the given port", type=int)
+define("datacfg", default="cfg/coco.data", help="detector data config")
+define("cfg", default="cfg/yolo.cfg", help="detector network config")
+define("weights", default="yolo.weights", help="detector weights")
+define("thresh", default=.24, help="detection threshold", type=float)
+define("hier_thresh", default=.5, help="hierarchical detection threshold", type=float)
+define("pool_size", default=streamproc.DETECTOR_POOL_SIZE, help="number of detector workers", type=int)
+define("batch_size", default=streamproc.DETECTOR_BATCH_SIZE, help="frames per detector batch", type=int)
+define("warmup", default=True, help="load the detector in the background at startup", type=bool)
+define("send_queue", default=4, help="frames a client may fall behind before old ones are dropped", type=int)
+define("webm_send_queue", default=256, help="WEBM chunks a client may fall behind before it is closed", type=int)
 
 cl = []
 
+# Query arguments accepted for each frame scheduling policy
+SCHEDULER_ARGS = {
+    'queue': [('maxlen', int)],
+    'nth': [('n', int)],
+    'fps': [('target_fps', float)],
+}
+
 
 class VideoWebSocketHandler(tornado.websocket.WebSocketHandler):
+    """Publishes the uploaded video as a named stream, or watches one with ?watch=<stream>."""
+
+    _ids = itertools.count()
+
     def __init__(self, application, request, **kwargs):
         super(VideoWebSocketHandler, self).__init__(application, request, **kwargs)
         self._video_fname = None
         self._conn = None
         self._process = None
+        self.client = 'client-{}'.format(next(self._ids))
         self.stream_proc = None
+        self.watching = None
+        self.send_queue = None
 
     def close_video(self):
+        if self.send_queue:
+            self.send_queue.close()
+            metrics.REGISTRY.remove_collector(self.send_queue.collect_metrics)
+            metrics.REGISTRY.remove(client=self.client)
+            self.send_queue = None
+        if self.watching:
+            HUB.unsubscribe(*self.watching)
+            self.watching = None
         if self.stream_proc:
-            self.stream_proc.stop()
+            HUB.unpublish(self.stream_proc.name)
             self.stream_proc = None
 
+    def _open_send_queue(self, mode, stream):
+        # The WEBM stream breaks when chunks are lost, clients too slow for it are closed
+        if mode == StreamProc.WEBM_STREAM:
+            self.send_queue = SendQueue(self.write_message, options.webm_send_queue, drop_oldest=False,
+                                        on_overflow=self.close, stream=stream, client=self.client)
+        else:
+            self.send_queue = SendQueue(self.write_message, options.send_queue, stream=stream, client=self.client)
+        metrics.REGISTRY.add_collector(self.send_queue.collect_metrics)
+
     def check_origin(self, origin):
         return True
 
@@ -57,21 +105,68 @@ class VideoWebSocketHandler(tornado.websocket.WebSocketHandler):
             cl.append(self)
 
         self.close_video()
-        self.stream_proc = StreamProc()
-        self.stream_proc.run(self.on_out_data)
-
-    def on_out_data(self, data):
-        if data:
-            print("send data back len={}".format(len(data)))
-            try:
-                self.write_message(data, binary=True)
-            except tornado.websocket.WebSocketError as e:
-                logging.exception('Cannot send data back')
-                self.close_video()
+        mode = self.get_argument('mode', StreamProc.JPEG_IMAGE)
+        watch = self.get_argument('watch', None)
+        if watch is not None:
+            self.watch(watch, mode)
+            return
+        policy = self.get_argument('policy', None)
+        scheduler_args = {}
+        for name, convert in SCHEDULER_ARGS.get(policy, []):
+            value = self.get_argument(name, None)
+            if value is not None:
+                scheduler_args[name] = convert(value)
+        full_res = self.get_argument('full_res', None)
+        if full_res is not None:
+            full_res = full_res.lower() in ('1', 'true', 'yes')
+        yuv = self.get_argument('yuv', None)
+        if yuv is not None:
+            yuv = yuv.lower() in ('1', 'true', 'yes')
+        # motion=<threshold> skips detection on frames of a static camera that did not change
+        motion_gate = None
+        motion = self.get_argument('motion', None)
+        if motion is not None:
+            gate_args = {'threshold': float(motion)}
+            refresh = self.get_argument('motion_refresh', None)
+            if refresh is not None:
+                gate_args['refresh_interval'] = int(refresh)
+            motion_gate = MotionGate(**gate_args)
+        # detect_every=<n> detects on every nth frame and tracks the boxes in between
+        tracker = None
+        detect_every = self.get_argument('detect_every', None)
+        if detect_every is not None and int(detect_every) > 1:
+            tracker = IouTracker(int(detect_every))
+        try:
+            self.stream_proc = HUB.publish(self.get_argument('stream', None))
+        except KeyError as e:
+            logging.warning('%s', e)
+            self.close(4009, 'stream is already published')
+            return
+        self._open_send_queue(mode, self.stream_proc.name)
+        self.stream_proc.run(self.on_out_data, mode, policy, full_res, yuv, motion_gate, tracker,
+                             **scheduler_args)
+
+    def watch(self, stream, mode):
+        """Receive the mode output of a stream another client publishes."""
+        self._open_send_queue(mode, stream)
+        loop = tornado.ioloop.IOLoop.current()
+        try:
+            HUB.subscribe(stream, mode, self.on_out_data, on_close=lambda: loop.add_callback(self.close))
+        except KeyError:
+            self.close(4004, 'unknown stream')
+            return
+        self.watching = (stream, mode, self.on_out_data)
+
+    def on_out_data(self, data, binary=True):
+        """Called from the StreamProc threads, the queue writes on the IOLoop."""
+        send_queue = self.send_queue
+        if data and send_queue is not None:
+            send_queue.put(data, binary)
 
     def on_message(self, message):
         # print('on_message type {} size {}'.format(type(message), len(message)))
-        self.stream_proc.process_data(message)
+        if self.stream_proc is not None:
+            self.stream_proc.process_data(message)
         # if not self._writer.write_message(message):
         #    print('No connection')
         #    # self.write_message(u"You said: " + message)
@@ -83,12 +178,21 @@ class VideoWebSocketHandler(tornado.websocket.WebSocketHandler):
         self.close_video()
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """Prometheus scrape endpoint."""
+
+    def get(self):
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(metrics.REGISTRY.render())
+
+
 class Application(tornado.web.Application):
     def __init__(self):
         root_dir = os.path.dirname(__file__)
         static_dir = os.path.join(root_dir, 'static')
         handlers = [
             (r'/ws/video', VideoWebSocketHandler),
+            (r'/metrics', MetricsHandler),
             (r'/(favicon.ico)', tornado.web.StaticFileHandler, {'path': static_dir}),
             (r'/(.*)', tornado.web.StaticFileHandler, {'path': static_dir, 'default_filename': 'index.html'}),
         ]
@@ -104,9 +208,14 @@ class Application(tornado.web.Application):
 def main():
 
     tornado.options.parse_command_line()
+    streamproc.configure(datacfg=options.datacfg, cfgfile=options.cfg, weightfile=options.weights,
+                         thresh=options.thresh, hier_thresh=options.hier_thresh,
+                         size=options.pool_size, batch_size=options.batch_size)
     logging.info('Run on port %i', options.port)
     app = Application()
     app.listen(options.port)
+    if options.warmup:
+        streamproc.warmup()
 
     loop = tornado.ioloop.IOLoop.current()
 
@@ -114,7 +223,7 @@ def main():
         logging.info('Stopping IOLoop')
         loop.stop()
 
-    glib_thread.register_stop_callback(stop_cb)
+    streamproc.get_glib_thread().register_stop_callback(stop_cb)
     loop.start()
 
 
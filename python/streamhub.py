@@ -0,0 +1,88 @@
+from __future__ import print_function
+import logging
+import threading
+
+from streamproc import StreamProc, get_glib_thread
+
+logger = logging.getLogger(__name__)
+
+
+class StreamHub(object):
+    """Named StreamProcs shared by one publisher and any number of subscribers.
+
+    The publisher feeds the video into the StreamProc returned by
+    publish(); subscribers attach to it by name with their own output mode
+    and handler, so a source is decoded and detected once however many
+    viewers, recorders or analytics hooks follow it. Each handler applies
+    its own drop policy, e.g. through a sendqueue.SendQueue.
+    """
+
+    def __init__(self):
+        self._streams = {}
+        # name -> list of (mode, handler, on_close) of the subscribers
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, name=None):
+        """Create and register the StreamProc of a new stream, the caller runs it.
+
+        Raises KeyError if a stream of that name is already published.
+        """
+        with self._lock:
+            if name in self._streams:
+                raise KeyError('stream {} is already published'.format(name))
+            proc = StreamProc(name)
+            if proc.name in self._streams:
+                # A generated name taken by a named stream
+                proc.stop()
+                raise KeyError('stream {} is already published'.format(proc.name))
+            self._streams[proc.name] = proc
+            self._subscribers[proc.name] = []
+        logger.info('Published stream %s', proc.name)
+        return proc
+
+    def get(self, name):
+        with self._lock:
+            return self._streams.get(name)
+
+    def names(self):
+        with self._lock:
+            return sorted(self._streams)
+
+    def subscribe(self, name, mode, handler, on_close=None):
+        """Subscribe handler to the mode output of stream name, see StreamProc.subscribe.
+
+        on_close is called when the stream is unpublished. Raises KeyError
+        for unknown streams.
+        """
+        with self._lock:
+            proc = self._streams[name]
+            self._subscribers[name].append((mode, handler, on_close))
+        proc.subscribe(mode, handler)
+        return proc
+
+    def unsubscribe(self, name, mode, handler):
+        with self._lock:
+            proc = self._streams.get(name)
+            if proc is None:
+                return
+            self._subscribers[name] = [s for s in self._subscribers[name] if s[1] != handler]
+        proc.unsubscribe(mode, handler)
+
+    def unpublish(self, name):
+        """Stop a stream and notify its subscribers."""
+        with self._lock:
+            proc = self._streams.pop(name, None)
+            subscribers = self._subscribers.pop(name, [])
+        if proc is None:
+            return
+        logger.info('Unpublished stream %s with %i subscribers', name, len(subscribers))
+        for mode, handler, on_close in subscribers:
+            proc.unsubscribe(mode, handler)
+            if on_close is not None:
+                on_close()
+        get_glib_thread().unregister_stop_callback(proc.stop)
+        proc.stop()
+
+
+HUB = StreamHub()
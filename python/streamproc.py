@@ -5,51 +5,91 @@ import sys
 import gi
 
 gi.require_version('Gst', '1.0')
-from gi.repository import GLib, GObject, Gst
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GLib, GObject, Gst, GstVideo
 import numpy
 import cv2
 import darknet
+from detpool import DetectorPool
+from framering import FrameRing
+from framesched import make_scheduler
+from metrics import REGISTRY
 import atexit
+import collections
+import itertools
+import json
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, Future
 
 logger = logging.getLogger(__name__)
 
-
-class DarknetProc(object):
-
-    def __init__(self):
-        logger.info('Init darknet')
-        self.det = darknet.make_detector_demo("cfg/coco.data", "cfg/yolo.cfg", "yolo.weights", .24, .5)
-        self._lock = threading.Lock()
-        atexit.register(self.destroy)
-
-    def destroy(self):
-        with self._lock:
-            if self.det is not None:
-                darknet.free_detector_demo(self.det)
-                self.det = None
-
-    def process_image(self, image):
-        with self._lock:
-            height, width, depth = image.shape
-            bytes_per_line = width * depth
-            # Create darknet image from OpenCV image and convert from BGR to RGB
-            dimg = darknet.data_to_image(image.ctypes, width, height, depth, bytes_per_line)
-            # darknet.rgbgr_image(dimg)
-            # Process image with darknet
-            darknet.detector_demo_process_image(self.det, dimg)
-            # Convert RGB to BGR and copy into original OpenCV image
-            darknet.rgbgr_image(dimg)
-            darknet.copy_image_into_data(dimg, image.ctypes, width, height, depth, bytes_per_line)
-            del dimg
-            return image
-
-    def __del__(self):
-        self.destroy()
-
-
-darknet_proc = DarknetProc()
+# Number of independent detectors, each pinned to its share of the CPUs
+DETECTOR_POOL_SIZE = 1
+# Frames from all streams are batched up to this size or until this many
+# seconds passed since the first pending frame
+DETECTOR_BATCH_SIZE = 4
+DETECTOR_MAX_WAIT = 0.015
+# Shared memory slots per stream for decoded frames waiting for inference
+FRAME_RING_SLOTS = 4
+# Decoded frames the WEBM stream may queue for inference before dropping
+WEBM_QUEUE_LENGTH = 8
+# Frames between VP8 keyframes, viewers joining a shared WEBM stream start at one
+WEBM_KEYFRAME_INTERVAL = 60
+# Buffers an element may hold before its latency probe forgets them
+STAGE_PROBE_MAX_PENDING = 64
+
+
+# DetectorPool arguments of the shared detector, see configure()
+_detector_config = dict(datacfg="cfg/coco.data", cfgfile="cfg/yolo.cfg", weightfile="yolo.weights",
+                        thresh=.24, hier_thresh=.5, size=DETECTOR_POOL_SIZE,
+                        batch_size=DETECTOR_BATCH_SIZE, max_wait=DETECTOR_MAX_WAIT)
+_darknet_proc = None
+_darknet_proc_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Set the DetectorPool arguments of the detector shared by all streams.
+
+    Only possible before the detector is created by get_darknet_proc().
+    """
+    unknown = set(kwargs).difference(_detector_config)
+    if unknown:
+        raise TypeError('Unknown detector options: {}'.format(', '.join(sorted(unknown))))
+    with _darknet_proc_lock:
+        if _darknet_proc is not None:
+            raise RuntimeError('detector is already created')
+        _detector_config.update(kwargs)
+
+
+def get_darknet_proc():
+    """Return the shared detector, loading the network on first use."""
+    global _darknet_proc
+    with _darknet_proc_lock:
+        if _darknet_proc is None:
+            _darknet_proc = DetectorPool(**_detector_config)
+        return _darknet_proc
+
+
+def warmup(background=True):
+    """Create the shared detector and run a blank frame through every worker.
+
+    With background the work is done on a new thread, which is returned.
+    """
+    def run():
+        proc = get_darknet_proc()
+        frame = numpy.zeros((416, 416, 3), dtype=numpy.uint8)
+        for worker in proc.workers:
+            worker.detect(frame)
+        logger.info('Detector warmed up')
+
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(name='DetectorWarmup', target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
 
 
 # based on https://stackoverflow.com/questions/22582031/reading-a-h264-rtsp-stream-into-python-and-opencv
@@ -73,7 +113,9 @@ class GLibThread(object):
         self.stop_callbacks.append(cb)
 
     def unregister_stop_callback(self, cb):
-        self.stop_callbacks.remove(cb)
+        # Stopped objects unregister themselves, they may be stopped twice
+        if cb in self.stop_callbacks:
+            self.stop_callbacks.remove(cb)
 
     def _run_loop(self):
         try:
@@ -88,20 +130,97 @@ class GLibThread(object):
     def stop(self):
         logger.info('stopping glib loop')
         try:
-            for cb in self.stop_callbacks:
+            # Callbacks unregister themselves while they run
+            for cb in list(self.stop_callbacks):
                 cb()
         finally:
             self.loop.quit()
 
 
-glib_thread = GLibThread()
+_glib_thread = None
+_glib_thread_lock = threading.Lock()
+
+
+def get_glib_thread():
+    """Return the thread running the GLib main loop, initializing GStreamer on first use."""
+    global _glib_thread
+    with _glib_thread_lock:
+        if _glib_thread is None:
+            _glib_thread = GLibThread()
+        return _glib_thread
+
+
+def shutdown():
+    """Stop all streams and the GLib main loop if it was started."""
+    with _glib_thread_lock:
+        thread = _glib_thread
+    if thread is not None:
+        thread.stop()
+
+
+class _ReorderBuffer(object):
+    """Emits results in the order their frames were queued.
+
+    Frames are registered with expect() when queued and finished with
+    complete() or skip(), in any order and from any thread.
+    """
+
+    def __init__(self, emit):
+        self._emit = emit
+        self._order = collections.deque()
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def expect(self, seq):
+        with self._lock:
+            self._order.append(seq)
+
+    def complete(self, seq, result):
+        with self._lock:
+            self._results[seq] = result
+            while self._order and self._order[0] in self._results:
+                result = self._results.pop(self._order.popleft())
+                if result is not None:
+                    self._emit(result)
+
+    def skip(self, seq):
+        self.complete(seq, None)
+
+
+def probe_stage(element, stage, stream):
+    """Observe the time buffers spend in a GStreamer element as stage_seconds.
+
+    Buffers are matched between the sink and src pad by their pts, which
+    decoders, converters and encoders preserve.
+    """
+    starts = {}
+
+    def on_sink(pad, info):
+        if len(starts) >= STAGE_PROBE_MAX_PENDING:
+            starts.clear()
+        starts[info.get_buffer().pts] = time.time()
+        return Gst.PadProbeReturn.OK
+
+    def on_src(pad, info):
+        start = starts.pop(info.get_buffer().pts, None)
+        if start is not None:
+            REGISTRY.observe('stage_seconds', time.time() - start, stream=stream, stage=stage)
+        return Gst.PadProbeReturn.OK
+
+    element.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, on_sink)
+    element.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_src)
 
 
 class StreamProc(object):
     WEBM_STREAM = "webm"
     JPEG_IMAGE = "jpeg"
+    DETECTIONS = "detections"
 
-    def __init__(self):
+    _ids = itertools.count()
+
+    def __init__(self, name=None):
+        # Label of the stream in the metrics
+        self.name = name or 'stream-{}'.format(next(self._ids))
         self.in_pipeline = None
         self.out_pipeline = None
         self.appsrc = None
@@ -110,12 +229,37 @@ class StreamProc(object):
         self.framerate_num = 30
         self.framerate_denom = 1
         self.fps = float(self.framerate_num) / float(self.framerate_denom)
-        self.out_data_handler = None
+        # Handlers per output mode, see subscribe()
+        self._outputs = {}
+        self._outputs_lock = threading.Lock()
+        self._webm_headers = []
+        self._webm_joined = set()
+        self._out_pts_base = None
         self.fd = None
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self._ft_image = None
-
-        glib_thread.register_stop_callback(self.stop)
+        self.detector = None
+        self.executor = None
+        self.scheduler = None
+        self._reorder = None
+        self._pts_base = None
+        self.frames = None
+        # Size of the decoded video before scaling it to the network input
+        self.source_size = None
+        self.full_res = True
+        # Decoded frames are taken as planar YUV instead of RGB
+        self.yuv = False
+        self._in_layout = None
+        self._bgr_frames = threading.local()
+        # Optional motiongate.MotionGate and a Future of the detections of
+        # the frame that became its reference
+        self.motion_gate = None
+        self._gate_dets = None
+        self._gate_lock = threading.Lock()
+        # Optional tracker.IouTracker filling the frames between keyframes
+        # and the numbers of the admitted frames it picked as keyframes
+        self.tracker = None
+        self._keyframes = set()
+
+        get_glib_thread().register_stop_callback(self.stop)
 
     def stop(self):
         logger.info("stopping pipelines")
@@ -125,26 +269,37 @@ class StreamProc(object):
         if self.out_pipeline is not None:
             self.out_pipeline.set_state(Gst.State.NULL)
             self.out_pipeline = None
-        if self._ft_image is not None:
-            self._ft_image.cancel()
-        glib_thread.unregister_stop_callback(self.stop)
+        if self.scheduler is not None:
+            logger.info('Frame statistics: %s', self.scheduler.stats.snapshot())
+            self.scheduler.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        REGISTRY.remove_collector(self.collect_metrics)
+        REGISTRY.remove(stream=self.name)
+        get_glib_thread().unregister_stop_callback(self.stop)
 
     def __del__(self):
         self.stop()
 
-    def create_out_pipeline(self, width, height):
-        self.out_pipeline = Gst.parse_launch("appsrc name=src do-timestamp=1 ! "
-                                             "video/x-raw, format=RGB,width={width},height={height}, "
+    def create_out_pipeline(self, width, height, format='BGR'):
+        # Buffers carry the decoder timestamps, the queues let conversion
+        # and encoding of one frame overlap with inference of the next
+        self.out_pipeline = Gst.parse_launch("appsrc name=src format=time ! "
+                                             "video/x-raw, format={format},width={width},height={height}, "
                                              " framerate=(fraction){framerate_num}/{framerate_denom} ! "
-                                             "videoconvert ! "
-                                             "video/x-raw, format=(string)I420 ! vp8enc ! "
+                                             "queue ! videoconvert name=outconvert ! "
+                                             "video/x-raw, format=(string)I420 ! queue ! "
+                                             "vp8enc deadline=1 keyframe-max-dist={keyframe_interval} name=encoder ! "
                                              "webmmux streamable=true name=stream ! appsink name=outsink "
                                              .format(framerate_num=self.framerate_num,
                                                      framerate_denom=self.framerate_denom,
-                                                     width=width, height=height))
+                                                     width=width, height=height, format=format,
+                                                     keyframe_interval=WEBM_KEYFRAME_INTERVAL))
         self.appsrc = self.out_pipeline.get_by_name("src")
         self.appsrc.set_property('emit-signals', True)
         self.appsrc.set_property("format", Gst.Format.TIME)
+        probe_stage(self.out_pipeline.get_by_name("outconvert"), 'convert_out', self.name)
+        probe_stage(self.out_pipeline.get_by_name("encoder"), 'vp8_encode', self.name)
 
         # getting the sink by its name set in CLI
         self.out_sink = self.out_pipeline.get_by_name("outsink")
@@ -164,38 +319,279 @@ class StreamProc(object):
         self.out_pipeline.set_state(Gst.State.PLAYING)
 
     def on_out_buffer(self, appsink):
-        if self.out_data_handler:
-
-            sample = appsink.emit('pull-sample')
-            caps = sample.get_caps()
-            # print("OUT CAPS", caps.to_string(), file=sys.stderr)
-            struct = caps.get_structure(0)
-            width = struct.get_int('width')[1]
-            height = struct.get_int('height')[1]
-            # get the buffer
-            buf = sample.get_buffer()
-            data = buf.extract_dup(0, buf.get_size())
-
-            if self.fd is None:
-                logger.debug("Opened dump.webm")
-                self.fd = open('dump.webm', 'wb')
-            self.fd.write(data)
-            self.fd.flush()
-
-            self.out_data_handler(data)
+        sample = appsink.emit('pull-sample')
+        buf = sample.get_buffer()
+        data = buf.extract_dup(0, buf.get_size())
+
+        if self.fd is None:
+            logger.debug("Opened dump.webm")
+            self.fd = open('dump.webm', 'wb')
+        self.fd.write(data)
+        self.fd.flush()
+
+        if buf.has_flags(Gst.BufferFlags.HEADER):
+            # Sent to every handler before its first cluster
+            self._webm_headers.append(data)
+            return False
+        keyframe = not buf.has_flags(Gst.BufferFlags.DELTA_UNIT)
+        joining = []
+        with self._outputs_lock:
+            handlers = self._outputs.get(self.WEBM_STREAM, ())
+            if keyframe:
+                # Handlers subscribed later join at the next keyframe
+                joining = [h for h in handlers if h not in self._webm_joined]
+                self._webm_joined.update(joining)
+            handlers = [h for h in handlers if h in self._webm_joined]
+        for handler in handlers:
+            if handler in joining:
+                for header in self._webm_headers:
+                    handler(header)
+            handler(data)
         return False
 
-    def _process_bufdata_to_jpeg(self, data, width, height):
-        arr = numpy.ndarray(
-            (height, width, 3),
-            buffer=data,
-            dtype=numpy.uint8)
-
-        darknet_proc.process_image(arr)
-        # cv2.cvtColor(src=arr, dst=arr, code=cv2.COLOR_RGB2BGR)
-        ret, jpeg = cv2.imencode('.jpg', arr)
-        data = jpeg.tobytes()
-        self.out_data_handler(data)
+    def collect_metrics(self):
+        """Frame counters of the scheduler, see metrics.MetricsRegistry.add_collector."""
+        stats = self.scheduler.stats
+        for outcome in ('received', 'processed', 'dropped', 'errors'):
+            yield 'frames_total', 'counter', {'stream': self.name, 'outcome': outcome}, getattr(stats, outcome)
+        yield 'queue_age_seconds', 'gauge', {'stream': self.name}, stats.avg_queue_age
+        gate = self.motion_gate
+        if gate is not None:
+            for outcome in ('passed', 'skipped'):
+                yield 'motion_gate_frames_total', 'counter', {'stream': self.name, 'outcome': outcome}, \
+                    getattr(gate, outcome)
+
+    def _slot_frame(self, slot):
+        """Return the frame of a slot as HWC array or darknet.YUV_FRAME."""
+        if slot.planes is None:
+            return slot.array()
+        return darknet.yuv_frame(slot.data, slot.width, slot.height, slot.format, slot.planes, slot.bt709)
+
+    def _bgr_frame(self, width, height):
+        """Return a BGR output frame reused by the calling worker thread."""
+        frame = getattr(self._bgr_frames, 'frame', None)
+        if frame is None or frame.shape[:2] != (height, width):
+            frame = self._bgr_frames.frame = numpy.empty((height, width, 3), dtype=numpy.uint8)
+        return frame
+
+    def _detect_slot(self, slot, frame, out=None):
+        """Return the detections of the frame of a slot, drawn into out when given.
+
+        With a tracker only keyframes run through the detector, the
+        tracks are carried to the other frames. Frames the motion gate
+        finds unchanged get the detections of the last detected frame.
+        Returns the detections, their track IDs or None without a tracker,
+        and where they came from: 'detector', 'motion_gate' or 'tracker'.
+        """
+        tracker = self.tracker
+        if tracker is not None and slot.seq not in self._keyframes:
+            with REGISTRY.time('stage_seconds', stream=self.name, stage='track'):
+                dets, track_ids = tracker.predict(slot.seq)
+            self._draw(frame, dets, out)
+            return dets, track_ids, 'tracker'
+        source = 'detector'
+        dets = None
+        gate = self.motion_gate
+        reference = None
+        if gate is not None:
+            # Frames are compared with the frame that set the gate reference
+            # and wait for its detections, which may still be running on
+            # another worker
+            with REGISTRY.time('stage_seconds', stream=self.name, stage='motion_gate'):
+                with self._gate_lock:
+                    if gate.update(slot.array()) or self._gate_dets is None:
+                        reference = self._gate_dets = Future()
+                    else:
+                        previous = self._gate_dets
+            if reference is None:
+                try:
+                    dets = previous.result()
+                except Exception:
+                    dets = None
+                else:
+                    source = 'motion_gate'
+                    self._draw(frame, dets, out)
+        if dets is None:
+            try:
+                with REGISTRY.time('stage_seconds', stream=self.name, stage='inference'):
+                    dets = self.detector.detect(frame, out)
+            except Exception as e:
+                if reference is not None:
+                    reference.set_exception(e)
+                raise
+            if reference is not None:
+                reference.set_result(dets)
+        track_ids = None
+        if tracker is not None:
+            self._keyframes.discard(slot.seq)
+            with REGISTRY.time('stage_seconds', stream=self.name, stage='track'):
+                track_ids = tracker.update(dets, slot.seq)
+        return dets, track_ids, source
+
+    def _draw(self, frame, dets, out):
+        if out is not None:
+            with REGISTRY.time('stage_seconds', stream=self.name, stage='draw'):
+                self.detector.draw(frame, dets, out)
+
+    def _process_slot(self, slot):
+        """Detect on the frame of a slot and produce the output of every subscribed mode.
+
+        Detection runs once however many handlers are subscribed; frames
+        are only annotated and JPEG or WEBM encoded when some handler
+        wants them.
+        """
+        outputs = self._outputs
+        want_jpeg = bool(outputs.get(self.JPEG_IMAGE))
+        want_webm = bool(outputs.get(self.WEBM_STREAM)) and self.appsrc is not None
+        jpeg = out_buf = None
+        try:
+            frame = self._slot_frame(slot)
+            yuv = slot.planes is not None
+            # The slot is writable shared memory, so annotated BGR images
+            # are written back in place. YUV frames are annotated in place
+            # for the WEBM output, which was created for their format, and
+            # into a separate BGR frame for JPEG.
+            if want_jpeg:
+                out = self._bgr_frame(slot.width, slot.height) if yuv else slot.array()
+            elif want_webm:
+                out = frame if yuv else slot.array()
+            else:
+                out = None
+            dets, track_ids, source = self._detect_slot(slot, frame, out)
+            if want_jpeg:
+                if want_webm and yuv:
+                    self._draw(frame, dets, frame)
+                with REGISTRY.time('stage_seconds', stream=self.name, stage='jpeg_encode'):
+                    ret, jpeg = cv2.imencode('.jpg', out)
+            if want_webm:
+                # Copied on purpose: PyGObject marshals the data of
+                # new_wrapped_full into a temporary array, so the slot
+                # memory cannot be wrapped, and the slot is reused as
+                # soon as it is released below rather than once the
+                # encoder, several queued frames behind, is done with it
+                out_buf = Gst.Buffer.new_wrapped(slot.data[:slot.size].tobytes())
+                out_buf.dts = out_buf.pts = slot.pts
+                out_buf.duration = slot.duration
+            width, height, frame_num = slot.width, slot.height, slot.seq
+        finally:
+            seq = slot.seq
+            slot.release()
+            self._reorder.complete(seq, out_buf)
+        if jpeg is not None:
+            data = jpeg.tobytes()
+            for handler in outputs.get(self.JPEG_IMAGE, ()):
+                handler(data)
+        if outputs.get(self.DETECTIONS):
+            if not self.full_res and self.source_size is not None:
+                # Boxes are relative and the scaled frame has the source aspect ratio
+                width, height = self.source_size
+            msg = json.dumps({
+                "frame": frame_num,
+                "width": width,
+                "height": height,
+                "source": source,
+                "detections": darknet.detections_to_list(dets, self.detector.names, track_ids)
+            })
+            for handler in outputs.get(self.DETECTIONS, ()):
+                handler(msg, False)
+
+    def _drop_slot(self, slot):
+        if slot.seq in self._keyframes:
+            self._keyframes.discard(slot.seq)
+            self.tracker.keyframe_dropped(slot.seq)
+        self._reorder.skip(slot.seq)
+        slot.release()
+
+    def _push_out_buffer(self, out_buf):
+        if self._out_pts_base is None:
+            # The output may start in the middle of the input stream
+            self._out_pts_base = out_buf.pts
+        out_buf.dts = out_buf.pts = max(out_buf.pts - self._out_pts_base, 0)
+        self.appsrc.emit("push-buffer", out_buf)
+
+    def subscribe(self, mode, handler):
+        """Add a handler(data, binary=True) receiving the output of mode for every frame.
+
+        Any number of handlers of any mode may share the stream, e.g.
+        websocket viewers, recorders or analytics hooks. Handlers are
+        called from the worker threads, WEBM ones from the GStreamer
+        thread, starting with the stream headers and the next keyframe.
+        """
+        with self._outputs_lock:
+            outputs = dict(self._outputs)
+            outputs[mode] = outputs.get(mode, ()) + (handler,)
+            # Replaced as a whole, so readers never need the lock
+            self._outputs = outputs
+
+    def unsubscribe(self, mode, handler):
+        with self._outputs_lock:
+            outputs = dict(self._outputs)
+            outputs[mode] = tuple(h for h in outputs.get(mode, ()) if h != handler)
+            self._outputs = outputs
+            self._webm_joined.discard(handler)
+
+    def _frame_timing(self, buf):
+        """Return pts relative to the first frame and duration of a decoded buffer."""
+        duration = buf.duration
+        if duration == Gst.CLOCK_TIME_NONE:
+            duration = int(Gst.SECOND / self.fps)
+        pts = buf.pts
+        if pts == Gst.CLOCK_TIME_NONE:
+            pts = self.num_frames * duration
+        if self._pts_base is None:
+            self._pts_base = pts
+        return max(pts - self._pts_base, 0), duration
+
+    def _input_layout(self, caps, width, height):
+        """Return the format, the planes and whether YUV frames use the BT.709 matrix.
+
+        planes is None for RGB frames.
+        """
+        struct = caps.get_structure(0)
+        format = struct.get_string('format')
+        if format == 'RGB':
+            return format, None, False
+        key = (format, width, height, struct.get_string('colorimetry'))
+        if self._in_layout is None or self._in_layout[0] != key:
+            try:
+                info = GstVideo.VideoInfo.new_from_caps(caps)
+            except AttributeError:
+                # GStreamer before 1.20
+                info = GstVideo.VideoInfo()
+                info.from_caps(caps)
+            planes = [(info.offset[i], info.stride[i]) for i in range(info.finfo.n_planes)]
+            # HD sources are usually BT.709, the decoder caps tell
+            bt709 = info.colorimetry.matrix == GstVideo.VideoColorMatrix.BT709
+            self._in_layout = (key, planes, bt709)
+        return (format,) + self._in_layout[1:]
+
+    def _acquire_frame_slot(self, buf, width, height, format='RGB', planes=None, bt709=False):
+        """Copy a decoded buffer into a free shared frame slot.
+
+        Returns None when all slots are in use.
+        """
+        size = buf.get_size()
+        if self.frames is None or self.frames.slot_size < size:
+            # Slots still in use keep the old mapping alive until released
+            self.frames = FrameRing(self._ring_slots, size)
+        slot = self.frames.acquire()
+        if slot is None:
+            return None
+        ok, info = buf.map(Gst.MapFlags.READ)
+        if not ok:
+            slot.release()
+            raise RuntimeError('Cannot map buffer')
+        try:
+            pts, duration = self._frame_timing(buf)
+            if planes is None:
+                # Rows may be padded, derive the stride from the buffer size
+                slot.write(info.data, width, height, 3, size // height, pts, self.num_frames, duration)
+            else:
+                slot.write(info.data, width, height, 1, planes[0][1], pts, self.num_frames, duration,
+                           format, planes, bt709)
+        finally:
+            buf.unmap(info)
+        return slot
 
     def on_new_buffer(self, appsink):
         # print('new_buffer')
@@ -205,48 +601,35 @@ class StreamProc(object):
         struct = caps.get_structure(0)
         width = struct.get_int('width')[1]
         height = struct.get_int('height')[1]
-
-        if self.out_data_handler:
-            if self.out_data_handler_mode == self.JPEG_IMAGE:
-
-                if self._ft_image is None or self._ft_image.done():
-                    if self._ft_image is not None:
-                        exc = self._ft_image.exception()
-                        if exc is not None:
-                            logger.error('Error while processing image: %s', exc)
-                    # print('FT_IMAGE', self._ft_image, file=sys.stderr)
-                    # get the buffer
-                    buf = sample.get_buffer()
-                    data = buf.extract_dup(0, buf.get_size())
-                    # print('submit job {}x{}'.format(width, height), file=sys.stderr)
-                    self._ft_image = self.executor.submit(self._process_bufdata_to_jpeg, data, width, height)
-
-            elif self.out_data_handler_mode == self.WEBM_STREAM:
-                # get the buffer
-                buf = sample.get_buffer()
-                data = buf.extract_dup(0, buf.get_size())
-                arr = numpy.ndarray(
-                    (height, width, 3),
-                    buffer=data,
-                    dtype=numpy.uint8)
-
-                data = arr.tostring()
-                duration = (1.0 / self.fps) * Gst.SECOND
-                timestamp = self.num_frames * duration
-                out_buf = Gst.Buffer.new_allocate(None, len(data), None)
-                out_buf.fill(0, data)
-                out_buf.duration = duration
-                out_buf.dts = out_buf.pts = timestamp
-
-                if not self.appsrc:
-                    self.create_out_pipeline(width, height)
-
-                self.appsrc.emit("push-buffer", out_buf)
+        format, planes, bt709 = self._input_layout(caps, width, height)
+
+        if self._outputs.get(self.WEBM_STREAM) and not self.appsrc:
+            # YUV frames are annotated in place and encoded as they are
+            self.create_out_pipeline(width, height, 'BGR' if planes is None else format)
+
+        # Only frames the scheduler wants are copied out of GStreamer
+        if any(self._outputs.values()) and self.scheduler.admit():
+            slot = self._acquire_frame_slot(sample.get_buffer(), width, height, format, planes,
+                                             bt709)
+            if slot is None:
+                self.scheduler.reject()
+            else:
+                # Keyframes are picked here in frame order, the workers
+                # take frames out of order
+                if self.tracker is not None and self.tracker.is_keyframe(slot.seq):
+                    self._keyframes.add(slot.seq)
+                self._reorder.expect(slot.seq)
+                self.scheduler.push(slot)
 
         self.num_frames += 1
 
         return False
 
+    def on_decoder_element_added(self, bin, element):
+        factory = element.get_factory()
+        if factory is not None and 'Decoder' in factory.get_metadata('klass'):
+            probe_stage(element, 'decode', self.name)
+
     def on_message(self, bus, message):
         t = message.type
         logger.debug('Message type %s', t)
@@ -292,12 +675,99 @@ class StreamProc(object):
             err, debug = message.parse_error()
             logger.error("Output Error: %s %s", err, debug)
 
-    def run(self, out_data_handler, out_data_handler_mode=JPEG_IMAGE):
-        self.out_data_handler = out_data_handler
+    def _on_scale_caps(self, pad, info):
+        """Fit the scaled frames into the network input once the source size is known."""
+        event = info.get_event()
+        if event.type == Gst.EventType.CAPS:
+            struct = event.parse_caps().get_structure(0)
+            ok_w, width = struct.get_int('width')
+            ok_h, height = struct.get_int('height')
+            if ok_w and ok_h:
+                self.source_size = (width, height)
+                # Same size letterbox_data_into resizes to, so it only pads
+                net_w, net_h = self.detector.input_size
+                if float(net_w) / width < float(net_h) / height:
+                    new_w, new_h = net_w, height * net_w // width
+                else:
+                    new_w, new_h = width * net_h // height, net_h
+                logger.info('Scaling %ix%i frames to %ix%i', width, height, new_w, new_h)
+                caps = Gst.Caps.from_string('video/x-raw, width={}, height={}, pixel-aspect-ratio=1/1'
+                                            .format(max(new_w, 1), max(new_h, 1)))
+                self.in_pipeline.get_by_name("scalecaps").set_property('caps', caps)
+        return Gst.PadProbeReturn.OK
+
+    def run(self, out_data_handler, out_data_handler_mode=JPEG_IMAGE, scheduler_policy=None, full_res=None,
+            yuv=None, motion_gate=None, tracker=None, **scheduler_args):
+        """Start decoding, scheduler_policy selects how frames are dropped under load.
+
+        See framesched.SCHEDULERS for the policies, scheduler_args are
+        passed to the scheduler. Single images are produced from the latest
+        frame by default, while the WEBM stream queues frames and runs as
+        many of them through the detector at once as it can take.
+
+        Without full_res frames are scaled to the network input size while
+        decoding, keeping their aspect ratio, which saves converting and
+        copying full size frames. By default only the annotated outputs
+        are produced at full resolution.
+
+        With yuv the decoder output is taken as I420 or NV12, which darknet
+        converts while letterboxing instead of videoconvert producing RGB.
+        It is the default except for JPEG images, which OpenCV encodes
+        from BGR anyway.
+
+        motion_gate, a motiongate.MotionGate, lets frames that barely
+        changed reuse the detections of the last detected frame instead of
+        running the network.
+
+        tracker, a tracker.IouTracker, only detects on every Nth frame and
+        moves the boxes along on the others, with stable track IDs. It
+        needs all frames, so frames are queued like for the WEBM stream
+        and one worker more is started to draw while a keyframe is
+        detected.
+
+        out_data_handler, if given, is subscribed to out_data_handler_mode;
+        the mode also selects the defaults above when more handlers of
+        other modes subscribe later, see subscribe().
+        """
+        if out_data_handler is not None:
+            self.subscribe(out_data_handler_mode, out_data_handler)
         self.out_data_handler_mode = out_data_handler_mode
+        self.detector = get_darknet_proc()
+        if full_res is None:
+            full_res = out_data_handler_mode != self.DETECTIONS
+        self.full_res = full_res
+        if yuv is None:
+            yuv = out_data_handler_mode != self.JPEG_IMAGE
+        self.yuv = yuv
+        self.motion_gate = motion_gate
+        self.tracker = tracker
+        self._reorder = _ReorderBuffer(self._push_out_buffer)
+        if scheduler_policy is None and (out_data_handler_mode == self.WEBM_STREAM or tracker is not None):
+            scheduler_policy = 'queue'
+            scheduler_args.setdefault('maxlen', WEBM_QUEUE_LENGTH)
+        if out_data_handler_mode == self.WEBM_STREAM or tracker is not None:
+            scheduler_args.setdefault('max_in_flight', self.detector.capacity + (1 if tracker is not None else 0))
+        if scheduler_policy is None:
+            scheduler_policy = 'latest'
+        max_in_flight = scheduler_args.get('max_in_flight', 1)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.scheduler = make_scheduler(scheduler_policy, self.executor, self._process_slot, self._drop_slot,
+                                        **scheduler_args)
+        # Enough slots for the frames in flight, the waiting ones and the one being copied
+        self._ring_slots = max(FRAME_RING_SLOTS, max_in_flight + scheduler_args.get('maxlen', 1) + 1)
         # simplest way to create a pipeline
-        self.in_pipeline = Gst.parse_launch("appsrc name=insrc ! queue ! decodebin name=decoder ! videoconvert ! "
-                                            "video/x-raw, format=RGB ! queue ! appsink name=sink ")
+        scale = "" if full_res else "videoscale name=scale ! capsfilter name=scalecaps ! "
+        # videoconvert passes I420 and NV12 through untouched
+        in_format = "{ I420, NV12 }" if yuv else "RGB"
+        self.in_pipeline = Gst.parse_launch("appsrc name=insrc ! queue ! decodebin name=decoder ! " + scale +
+                                            "videoconvert name=convert ! "
+                                            "video/x-raw, format=" + in_format + " ! queue ! appsink name=sink ")
+        if not full_res:
+            self.in_pipeline.get_by_name("scale").get_static_pad('sink').add_probe(
+                Gst.PadProbeType.EVENT_DOWNSTREAM, self._on_scale_caps)
+        self.in_pipeline.get_by_name("decoder").connect('element-added', self.on_decoder_element_added)
+        probe_stage(self.in_pipeline.get_by_name("convert"), 'convert', self.name)
+        REGISTRY.add_collector(self.collect_metrics)
 
         self.in_src = self.in_pipeline.get_by_name("insrc")
 
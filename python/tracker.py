@@ -0,0 +1,178 @@
+from __future__ import division
+import itertools
+import logging
+import threading
+
+import numpy
+
+import darknet
+
+logger = logging.getLogger(__name__)
+
+# Minimum overlap of a detection with the predicted box of a track
+DEFAULT_IOU_THRESHOLD = 0.3
+# Detections on keyframes a track may miss before it is dropped
+DEFAULT_MAX_MISSES = 2
+# Weight of the newest measurement in the velocity estimate
+VELOCITY_ALPHA = 0.5
+
+
+def iou_matrix(a, b):
+    """IoU of every box in a with every box in b, both (n, 4) arrays of center x, y, w, h."""
+    a = a[:, None, :]
+    b = b[None, :, :]
+    left = numpy.maximum(a[..., 0] - a[..., 2] / 2, b[..., 0] - b[..., 2] / 2)
+    right = numpy.minimum(a[..., 0] + a[..., 2] / 2, b[..., 0] + b[..., 2] / 2)
+    top = numpy.maximum(a[..., 1] - a[..., 3] / 2, b[..., 1] - b[..., 3] / 2)
+    bottom = numpy.minimum(a[..., 1] + a[..., 3] / 2, b[..., 1] + b[..., 3] / 2)
+    inter = numpy.clip(right - left, 0, None) * numpy.clip(bottom - top, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - inter
+    return numpy.where(union > 0, inter / numpy.where(union > 0, union, 1), 0)
+
+
+def _boxes(dets):
+    return numpy.stack([dets["x"], dets["y"], dets["w"], dets["h"]], axis=1).astype(numpy.float64)
+
+
+class Track(object):
+    """Box of one object followed across frames with a constant velocity."""
+
+    __slots__ = ('id', 'class_id', 'score', 'box', 'velocity', 'seq', 'misses')
+
+    def __init__(self, track_id, class_id, score, box, seq):
+        self.id = track_id
+        self.class_id = class_id
+        self.score = score
+        self.box = box
+        self.velocity = numpy.zeros(4)
+        self.seq = seq
+        self.misses = 0
+
+    def predict(self, seq):
+        """Return the box extrapolated to frame seq, sizes never shrink below zero."""
+        box = self.box + self.velocity * (seq - self.seq)
+        box[2:] = numpy.maximum(box[2:], 0)
+        return box
+
+    def update(self, score, box, seq):
+        """Move the track to a detection of frame seq, ignored if the track has seen a newer frame."""
+        dt = seq - self.seq
+        if dt < 0:
+            return
+        if dt > 0:
+            measured = (box - self.box) / dt
+            self.velocity += VELOCITY_ALPHA * (measured - self.velocity)
+            self.seq = seq
+        self.box = box
+        self.score = score
+        self.misses = 0
+
+
+class IouTracker(object):
+    """Detect-every-N tracker keeping stable IDs for detections.
+
+    Full detection runs on keyframes only, is_keyframe() decides which
+    frames those are and has to be asked in frame order, e.g. as frames
+    are admitted; keyframe_dropped() gives a keyframe back that was never
+    detected. update() associates the detections of a keyframe
+    with the tracks greedily by IoU of the same class, starting new tracks
+    for unmatched detections and dropping tracks that missed more than
+    max_misses keyframes. predict() carries the tracks to the frames in
+    between with their constant velocity, so detections are available for
+    every frame at the cost of running the network on every Nth.
+    """
+
+    def __init__(self, interval=5, iou_threshold=DEFAULT_IOU_THRESHOLD, max_misses=DEFAULT_MAX_MISSES):
+        self.interval = interval
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.tracks = []
+        self._ids = itertools.count(1)
+        self._last_keyframe = None
+        # Newest keyframe passed to update(), older ones may finish later
+        self._last_update = None
+        self._lock = threading.Lock()
+
+    def is_keyframe(self, seq):
+        """Return whether frame seq should run through the detector.
+
+        Counts frames since the last keyframe, so frames dropped before
+        they got here do not delay the next detection. Frames have to be
+        asked in order.
+        """
+        with self._lock:
+            if self._last_keyframe is None or seq - self._last_keyframe >= self.interval:
+                self._last_keyframe = seq
+                return True
+            return False
+
+    def keyframe_dropped(self, seq):
+        """Make the next frame a keyframe if keyframe seq is dropped before detection."""
+        with self._lock:
+            if self._last_keyframe == seq:
+                self._last_keyframe = None
+
+    def update(self, dets, seq):
+        """Associate the DETECTION_DTYPE array of keyframe seq with the tracks.
+
+        Returns the track ID of every detection. A keyframe detected after
+        a newer one only gets the IDs of the tracks it matches, 0 for the
+        other detections; it neither moves tracks nor counts misses.
+        """
+        ids = numpy.zeros(len(dets), dtype=numpy.int64)
+        boxes = _boxes(dets)
+        with self._lock:
+            stale = self._last_update is not None and seq < self._last_update
+            if not stale:
+                self._last_update = seq
+            tracks = self.tracks
+            matched = set()
+            if tracks and len(dets):
+                predicted = numpy.array([t.predict(seq) for t in tracks])
+                iou = iou_matrix(predicted, boxes)
+                same_class = numpy.array([t.class_id for t in tracks])[:, None] == dets["class_id"][None, :]
+                iou[~same_class] = 0
+                for flat in numpy.argsort(-iou, axis=None, kind='mergesort'):
+                    ti, di = divmod(int(flat), len(dets))
+                    if iou[ti, di] < self.iou_threshold:
+                        break
+                    if ti in matched or ids[di]:
+                        continue
+                    tracks[ti].update(float(dets["score"][di]), boxes[di], seq)
+                    ids[di] = tracks[ti].id
+                    matched.add(ti)
+            if stale:
+                return ids
+            survivors = []
+            for i, t in enumerate(tracks):
+                if i not in matched:
+                    t.misses += 1
+                    if t.misses > self.max_misses:
+                        continue
+                survivors.append(t)
+            for di in numpy.flatnonzero(ids == 0):
+                t = Track(next(self._ids), int(dets["class_id"][di]), float(dets["score"][di]), boxes[di], seq)
+                survivors.append(t)
+                ids[di] = t.id
+            self.tracks = survivors
+        return ids
+
+    def predict(self, seq):
+        """Return the tracks seen on the last keyframe at frame seq.
+
+        Returns a DETECTION_DTYPE array and the track IDs of its entries.
+        """
+        with self._lock:
+            tracks = [t for t in self.tracks if not t.misses]
+            dets = numpy.zeros(len(tracks), dtype=darknet.DETECTION_DTYPE)
+            ids = numpy.array([t.id for t in tracks], dtype=numpy.int64)
+            for i, t in enumerate(tracks):
+                x, y, w, h = t.predict(seq)
+                dets[i] = (t.class_id, t.score, x, y, w, h)
+        return dets, ids
+
+    def reset(self):
+        with self._lock:
+            self.tracks = []
+            self._last_keyframe = None
+            self._last_update = None
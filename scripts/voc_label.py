@@ -1,13 +1,44 @@
-import xml.etree.ElementTree as ET
-import pickle
+"""Convert VOC annotations to darknet labels and write the image lists.
+
+With no arguments it converts the VOC 2007 and 2012 sets below VOCdevkit
+like before and writes 2007_train.txt ... as well as train.txt and
+train.all.txt. Other datasets in VOC layout are given as DIR:SET, with
+Annotations, ImageSets/Main and JPEGImages below DIR:
+
+    python scripts/voc_label.py
+    python scripts/voc_label.py --classes data/mydata.names \\
+        --sets /data/mydata:train /data/mydata:val --combined train.txt=mydata_train,mydata_val
+
+Annotations are parsed by a pool of processes. Every dataset keeps a cache
+of the annotations it converted in labels/.voc_label.json; annotations whose
+size and mtime, or else content hash, did not change since are skipped,
+as long as the classes stay the same.
+"""
+from __future__ import print_function, division
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
-from os import listdir, getcwd
-from os.path import join
+import sys
+import time
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 sets=[('2012', 'train'), ('2012', 'val'), ('2007', 'train'), ('2007', 'val'), ('2007', 'test')]
 
 classes = ["aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair", "cow", "diningtable", "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train", "tvmonitor"]
 
+combined = [('train.txt', ['2007_train', '2007_val', '2012_train', '2012_val']),
+            ('train.all.txt', ['2007_train', '2007_val', '2007_test', '2012_train', '2012_val'])]
+
+CACHE_NAME = '.voc_label.json'
+
+# class name -> id, set in every worker by init_worker
+class_ids = {}
+
 
 def convert(size, box):
     dw = 1./(size[0])
@@ -22,38 +53,145 @@ def convert(size, box):
     h = h*dh
     return (x,y,w,h)
 
-def convert_annotation(year, image_id):
-    in_file = open('VOCdevkit/VOC%s/Annotations/%s.xml'%(year, image_id))
-    out_file = open('VOCdevkit/VOC%s/labels/%s.txt'%(year, image_id), 'w')
-    tree=ET.parse(in_file)
-    root = tree.getroot()
+def init_worker(names):
+    global class_ids
+    class_ids = dict((name, i) for i, name in enumerate(names))
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def convert_annotation(job):
+    """Write the label file of one annotation unless the cached entry still matches.
+
+    job is (image_id, in_path, out_path, cached entry or None). Returns the image id
+    and its new cache entry [size, mtime, sha1], and whether it was written.
+    """
+    image_id, in_path, out_path, cached = job
+    st = os.stat(in_path)
+    entry = [st.st_size, st.st_mtime, None]
+    if cached is not None and os.path.exists(out_path):
+        if cached[:2] == entry[:2]:
+            return image_id, cached, False
+        entry[2] = file_hash(in_path)
+        if cached[2] == entry[2]:
+            return image_id, entry, False
+    root = ET.parse(in_path).getroot()
     size = root.find('size')
     w = int(size.find('width').text)
     h = int(size.find('height').text)
 
+    lines = []
     for obj in root.iter('object'):
-        difficult = obj.find('difficult').text
-        cls = obj.find('name').text
-        if cls not in classes or int(difficult)==1:
+        difficult = obj.find('difficult')
+        cls_id = class_ids.get(obj.find('name').text)
+        if cls_id is None or (difficult is not None and int(difficult.text)==1):
             continue
-        cls_id = classes.index(cls)
         xmlbox = obj.find('bndbox')
         b = (float(xmlbox.find('xmin').text), float(xmlbox.find('xmax').text), float(xmlbox.find('ymin').text), float(xmlbox.find('ymax').text))
         bb = convert((w,h), b)
-        out_file.write(str(cls_id) + " " + " ".join([str(a) for a in bb]) + '\n')
+        lines.append(str(cls_id) + " " + " ".join([str(a) for a in bb]) + '\n')
+    with open(out_path, 'w') as out_file:
+        out_file.write(''.join(lines))
+    if entry[2] is None:
+        entry[2] = file_hash(in_path)
+    return image_id, entry, True
+
+def resolve_set(spec, devkit):
+    """Return the dataset directory, image set and list name of DIR:SET or YEAR:SET."""
+    path, image_set = spec.rsplit(':', 1)
+    if os.path.isdir(path):
+        return path, image_set, '%s_%s'%(os.path.basename(os.path.normpath(path)), image_set)
+    return os.path.join(devkit, 'VOC%s'%path), image_set, '%s_%s'%(path, image_set)
+
+def load_cache(path, key):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if cache.get('key') != key:
+        return {}
+    return cache.get('annotations', {})
+
+def save_cache(path, key, annotations):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'key': key, 'annotations': annotations}, f)
+    os.rename(tmp, path)
 
-wd = getcwd()
+def convert_set(pool, dataset, image_set, names, ext, chunksize):
+    """Convert the annotations of one image set, returns its image paths and counts."""
+    labels = os.path.join(dataset, 'labels')
+    if not os.path.exists(labels):
+        os.makedirs(labels)
+    with open(os.path.join(dataset, 'ImageSets', 'Main', '%s.txt'%image_set)) as f:
+        image_ids = f.read().strip().split()
+    cache_path = os.path.join(labels, CACHE_NAME)
+    key = hashlib.sha1(json.dumps(names).encode('utf-8')).hexdigest()
+    cache = load_cache(cache_path, key)
+    jobs = [(image_id, os.path.join(dataset, 'Annotations', '%s.xml'%image_id),
+             os.path.join(labels, '%s.txt'%image_id), cache.get(image_id)) for image_id in image_ids]
+    written = 0
+    for image_id, entry, changed in pool.imap_unordered(convert_annotation, jobs, chunksize):
+        cache[image_id] = entry
+        written += changed
+    # Sets of a dataset share the cache, entries of other sets are kept
+    save_cache(cache_path, key, cache)
+    images = os.path.abspath(os.path.join(dataset, 'JPEGImages'))
+    paths = ['%s/%s.%s\n'%(images, image_id, ext) for image_id in image_ids]
+    return paths, written
 
-for year, image_set in sets:
-    if not os.path.exists('VOCdevkit/VOC%s/labels/'%(year)):
-        os.makedirs('VOCdevkit/VOC%s/labels/'%(year))
-    image_ids = open('VOCdevkit/VOC%s/ImageSets/Main/%s.txt'%(year, image_set)).read().strip().split()
-    list_file = open('%s_%s.txt'%(year, image_set), 'w')
-    for image_id in image_ids:
-        list_file.write('%s/VOCdevkit/VOC%s/JPEGImages/%s.jpg\n'%(wd, year, image_id))
-        convert_annotation(year, image_id)
-    list_file.close()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--devkit', default='VOCdevkit', help='directory of the VOC<year> datasets')
+    parser.add_argument('--sets', nargs='+', default=['%s:%s'%s for s in sets],
+                        help='image sets as YEAR:SET below the devkit or DIR:SET')
+    parser.add_argument('--classes', help='file with one class name per line or comma separated names, '
+                        'VOC classes by default')
+    parser.add_argument('--combined', nargs='*',
+                        default=['%s=%s'%(name, ','.join(parts)) for name, parts in combined],
+                        help='lists joining the lists of several sets, as FILE=NAME,NAME')
+    parser.add_argument('--ext', default='jpg', help='image file extension')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunksize', type=int, default=64, help='annotations per task sent to a worker')
+    return parser.parse_args(argv)
 
-os.system("cat 2007_train.txt 2007_val.txt 2012_train.txt 2012_val.txt > train.txt")
-os.system("cat 2007_train.txt 2007_val.txt 2007_test.txt 2012_train.txt 2012_val.txt > train.all.txt")
+def main(argv=None):
+    args = parse_args(argv)
+    names = classes
+    if args.classes:
+        if os.path.isfile(args.classes):
+            with open(args.classes) as f:
+                names = [line.strip() for line in f if line.strip()]
+        else:
+            names = args.classes.split(',')
+
+    lists = {}
+    start = time.time()
+    pool = multiprocessing.Pool(args.jobs, init_worker, (names,))
+    try:
+        for spec in args.sets:
+            dataset, image_set, name = resolve_set(spec, args.devkit)
+            paths, written = convert_set(pool, dataset, image_set, names, args.ext, args.chunksize)
+            with open('%s.txt'%name, 'w') as list_file:
+                list_file.writelines(paths)
+            lists[name] = paths
+            print('%s: %d images, %d labels written'%(name, len(paths), written))
+    finally:
+        pool.close()
+        pool.join()
+
+    for spec in args.combined:
+        out, parts = spec.split('=', 1)
+        missing = [p for p in parts.split(',') if p not in lists]
+        if missing:
+            print('Skipping %s, sets not converted: %s'%(out, ', '.join(missing)), file=sys.stderr)
+            continue
+        with open(out, 'w') as f:
+            for p in parts.split(','):
+                f.writelines(lists[p])
+    print('Done in %.1fs'%(time.time() - start))
 
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,12 @@
 
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include <string.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 pthread_mutex_t mutex = PTHREAD_MUTEX_INITIALIZER;
 
@@ -53,6 +58,211 @@ char **get_random_paths(char **paths, int n, int m)
     return random_paths;
 }
 
+int *get_random_indexes(int n, int m)
+{
+    int *indexes = calloc(n, sizeof(int));
+    int i;
+    pthread_mutex_lock(&mutex);
+    for(i = 0; i < n; ++i){
+        indexes[i] = rand()%m;
+    }
+    pthread_mutex_unlock(&mutex);
+    return indexes;
+}
+
+/* Training shards written by python/shardpack.py. NAME.shards lists the
+ * shards, one base path per line relative to the list; every shard has
+ * its HWC uint8 pixels in BASE.bin, one SHARD_RECORD_SIZE record per image
+ * in BASE.index.npy and the float32 class, x, y, w, h boxes in
+ * BASE.boxes.npy. All parts stay memory mapped. */
+#define SHARD_RECORD_SIZE 28
+#define SHARD_BOX_SIZE (5*sizeof(float))
+
+typedef struct{
+    void *base;
+    size_t size;
+} mapped_file;
+
+typedef struct{
+    mapped_file bin, index, boxes;
+    const unsigned char *records;
+    const float *box_data;
+    int n;
+    size_t nboxes;
+} shard;
+
+struct shard_set{
+    int n;
+    int count;
+    int *starts;
+    shard *shards;
+};
+
+typedef struct{
+    uint64_t offset;
+    uint32_t h, w;
+    uint64_t box_start;
+    uint32_t box_count;
+} shard_record;
+
+static mapped_file map_file(const char *filename)
+{
+    mapped_file m = {0};
+    int fd = open(filename, O_RDONLY);
+    if(fd < 0) file_error((char *)filename);
+    struct stat st;
+    if(fstat(fd, &st) < 0) file_error((char *)filename);
+    m.size = st.st_size;
+    if(m.size){
+        m.base = mmap(0, m.size, PROT_READ, MAP_SHARED, fd, 0);
+        if(m.base == MAP_FAILED) file_error((char *)filename);
+    }
+    close(fd);
+    return m;
+}
+
+static void unmap_file(mapped_file m)
+{
+    if(m.size) munmap(m.base, m.size);
+}
+
+/* Returns the data of a .npy file, only its header is checked */
+static const unsigned char *npy_data(mapped_file m, const char *filename, size_t item_size, size_t *n)
+{
+    const unsigned char *p = m.base;
+    size_t start;
+    if(m.size < 10 || memcmp(p, "\x93NUMPY", 6)) error("Not a .npy file");
+    if(p[6] == 1) start = 10 + (p[8] | p[9] << 8);
+    else start = 12 + (p[8] | p[9] << 8 | p[10] << 16 | (size_t)p[11] << 24);
+    if(start > m.size || (m.size - start) % item_size){
+        fprintf(stderr, "Invalid shard part %s\n", filename);
+        error("Invalid shard");
+    }
+    *n = (m.size - start) / item_size;
+    return p + start;
+}
+
+static shard_record get_shard_record(const shard *s, int i)
+{
+    shard_record r;
+    const unsigned char *p = s->records + (size_t)i*SHARD_RECORD_SIZE;
+    memcpy(&r.offset, p, 8);
+    memcpy(&r.h, p + 8, 4);
+    memcpy(&r.w, p + 12, 4);
+    memcpy(&r.box_start, p + 16, 8);
+    memcpy(&r.box_count, p + 24, 4);
+    return r;
+}
+
+static void load_shard(shard *s, const char *base)
+{
+    char buff[4096 + 16];
+    size_t n;
+    int i;
+    snprintf(buff, sizeof(buff), "%s.index.npy", base);
+    s->index = map_file(buff);
+    s->records = npy_data(s->index, buff, SHARD_RECORD_SIZE, &n);
+    s->n = n;
+    snprintf(buff, sizeof(buff), "%s.boxes.npy", base);
+    s->boxes = map_file(buff);
+    s->box_data = (const float *)npy_data(s->boxes, buff, SHARD_BOX_SIZE, &s->nboxes);
+    snprintf(buff, sizeof(buff), "%s.bin", base);
+    s->bin = map_file(buff);
+    for(i = 0; i < s->n; ++i){
+        shard_record r = get_shard_record(s, i);
+        if(r.offset > s->bin.size || (uint64_t)r.w*r.h*3 > s->bin.size - r.offset ||
+                r.box_start > s->nboxes || r.box_count > s->nboxes - r.box_start){
+            fprintf(stderr, "Invalid record %d in shard %s\n", i, base);
+            error("Invalid shard");
+        }
+    }
+}
+
+shard_set *load_shards(const char *filename)
+{
+    list *plist = get_paths(filename);
+    char **names = (char **)list_to_array(plist);
+    char dir[4096] = {0};
+    const char *slash = strrchr(filename, '/');
+    if(slash) strncpy(dir, filename, slash - filename + 1);
+    shard_set *set = calloc(1, sizeof(shard_set));
+    set->n = plist->size;
+    set->shards = calloc(set->n, sizeof(shard));
+    set->starts = calloc(set->n + 1, sizeof(int));
+    int i;
+    for(i = 0; i < set->n; ++i){
+        char base[4096];
+        snprintf(base, sizeof(base), "%s%s", names[i][0] == '/' ? "" : dir, names[i]);
+        load_shard(set->shards + i, base);
+        set->starts[i+1] = set->starts[i] + set->shards[i].n;
+        free(names[i]);
+    }
+    set->count = set->starts[set->n];
+    free(names);
+    free_list(plist);
+    if(!set->count) error("No images in the shards");
+    fprintf(stderr, "%d images in %d shards\n", set->count, set->n);
+    return set;
+}
+
+void free_shards(shard_set *set)
+{
+    int i;
+    for(i = 0; i < set->n; ++i){
+        unmap_file(set->shards[i].bin);
+        unmap_file(set->shards[i].index);
+        unmap_file(set->shards[i].boxes);
+    }
+    free(set->shards);
+    free(set->starts);
+    free(set);
+}
+
+int shards_size(shard_set *set)
+{
+    return set->count;
+}
+
+/* Image index of the shard set as a float CHW image and its boxes like read_boxes */
+static image load_shard_image(shard_set *set, int index, box_label **boxes, int *count)
+{
+    int lo = 0, hi = set->n - 1;
+    while(lo < hi){
+        int mid = (lo + hi + 1)/2;
+        if(set->starts[mid] <= index) lo = mid;
+        else hi = mid - 1;
+    }
+    const shard *s = set->shards + lo;
+    shard_record r = get_shard_record(s, index - set->starts[lo]);
+    image im = make_image(r.w, r.h, 3);
+    const unsigned char *pixels = (const unsigned char *)s->bin.base + r.offset;
+    int x, y, k;
+    for(k = 0; k < 3; ++k){
+        for(y = 0; y < im.h; ++y){
+            for(x = 0; x < im.w; ++x){
+                im.data[k*im.w*im.h + y*im.w + x] = pixels[(y*im.w + x)*3 + k]/255.;
+            }
+        }
+    }
+    *count = r.box_count;
+    *boxes = calloc(r.box_count ? r.box_count : 1, sizeof(box_label));
+    int i;
+    for(i = 0; i < *count; ++i){
+        const float *b = s->box_data + (r.box_start + i)*5;
+        box_label *l = *boxes + i;
+        l->id = b[0];
+        l->x = b[1];
+        l->y = b[2];
+        l->w = b[3];
+        l->h = b[4];
+        l->left   = l->x - l->w/2;
+        l->right  = l->x + l->w/2;
+        l->top    = l->y - l->h/2;
+        l->bottom = l->y + l->h/2;
+    }
+    return im;
+}
+
 char **find_replace_paths(char **paths, int n, char *find, char *replace)
 {
     char **replace_paths = calloc(n, sizeof(char*));
@@ -251,7 +461,7 @@ void fill_truth_swag(char *path, float *truth, int classes, int flip, float dx,
     free(boxes);
 }
 
-void fill_truth_region(char *path, float *truth, int classes, int num_boxes, int flip, float dx, float dy, float sx, float sy)
+box_label *read_region_boxes(char *path, int *count)
 {
     char labelpath[4096];
     find_replace(path, "images", "labels", labelpath);
@@ -261,8 +471,12 @@ void fill_truth_region(char *path, float *truth, int classes, int num_boxes, int
     find_replace(labelpath, ".png", ".txt", labelpath);
     find_replace(labelpath, ".JPG", ".txt", labelpath);
     find_replace(labelpath, ".JPEG", ".txt", labelpath);
-    int count = 0;
-    box_label *boxes = read_boxes(labelpath, &count);
+    return read_boxes(labelpath, count);
+}
+
+/* Takes ownership of boxes */
+void fill_truth_region_boxes(box_label *boxes, int count, float *truth, int classes, int num_boxes, int flip, float dx, float dy, float sx, float sy)
+{
     randomize_boxes(boxes, count);
     correct_boxes(boxes, count, dx, dy, sx, sy, flip);
     float x,y,w,h;
@@ -299,6 +513,13 @@ void fill_truth_region(char *path, float *truth, int classes, int num_boxes, int
     free(boxes);
 }
 
+void fill_truth_region(char *path, float *truth, int classes, int num_boxes, int flip, float dx, float dy, float sx, float sy)
+{
+    int count = 0;
+    box_label *boxes = read_region_boxes(path, &count);
+    fill_truth_region_boxes(boxes, count, truth, classes, num_boxes, flip, dx, dy, sx, sy);
+}
+
 void load_rle(image im, int *rle, int n)
 {
     int count = 0;
@@ -405,7 +626,7 @@ void fill_truth_iseg(char *path, int num_boxes, float *truth, int classes, int w
 }
 
 
-void fill_truth_detection(char *path, int num_boxes, float *truth, int classes, int flip, float dx, float dy, float sx, float sy)
+box_label *read_detection_boxes(char *path, int *count)
 {
     char labelpath[4096];
     find_replace(path, "images", "labels", labelpath);
@@ -416,8 +637,12 @@ void fill_truth_detection(char *path, int num_boxes, float *truth, int classes,
     find_replace(labelpath, ".png", ".txt", labelpath);
     find_replace(labelpath, ".JPG", ".txt", labelpath);
     find_replace(labelpath, ".JPEG", ".txt", labelpath);
-    int count = 0;
-    box_label *boxes = read_boxes(labelpath, &count);
+    return read_boxes(labelpath, count);
+}
+
+/* Takes ownership of boxes */
+void fill_truth_detection_boxes(box_label *boxes, int count, int num_boxes, float *truth, int classes, int flip, float dx, float dy, float sx, float sy)
+{
     randomize_boxes(boxes, count);
     correct_boxes(boxes, count, dx, dy, sx, sy, flip);
     if(count > num_boxes) count = num_boxes;
@@ -443,6 +668,13 @@ void fill_truth_detection(char *path, int num_boxes, float *truth, int classes,
     free(boxes);
 }
 
+void fill_truth_detection(char *path, int num_boxes, float *truth, int classes, int flip, float dx, float dy, float sx, float sy)
+{
+    int count = 0;
+    box_label *boxes = read_detection_boxes(path, &count);
+    fill_truth_detection_boxes(boxes, count, num_boxes, truth, classes, flip, dx, dy, sx, sy);
+}
+
 #define NUMCHARS 37
 
 void print_letters(float *pred, int n)
@@ -780,9 +1012,17 @@ data load_data_iseg(int n, char **paths, int m, int w, int h, int classes, int b
     return d;
 }
 
-data load_data_region(int n, char **paths, int m, int w, int h, int size, int classes, float jitter, float hue, float saturation, float exposure)
+/* Samples come from shards when given, else from the image files of paths */
+static image load_sample(char **paths, shard_set *shards, int index, int detection, box_label **boxes, int *count)
 {
-    char **random_paths = get_random_paths(paths, n, m);
+    if(shards) return load_shard_image(shards, index, boxes, count);
+    *boxes = detection ? read_detection_boxes(paths[index], count) : read_region_boxes(paths[index], count);
+    return load_image_color(paths[index], 0, 0);
+}
+
+static data load_region(int n, char **paths, shard_set *shards, int m, int w, int h, int size, int classes, float jitter, float hue, float saturation, float exposure)
+{
+    int *indexes = get_random_indexes(n, m);
     int i;
     data d = {0};
     d.shallow = 0;
@@ -795,7 +1035,9 @@ data load_data_region(int n, char **paths, int m, int w, int h, int size, int cl
     int k = size*size*(5+classes);
     d.y = make_matrix(n, k);
     for(i = 0; i < n; ++i){
-        image orig = load_image_color(random_paths[i], 0, 0);
+        box_label *boxes;
+        int count;
+        image orig = load_sample(paths, shards, indexes[i], 0, &boxes, &count);
 
         int oh = orig.h;
         int ow = orig.w;
@@ -825,15 +1067,25 @@ data load_data_region(int n, char **paths, int m, int w, int h, int size, int cl
         random_distort_image(sized, hue, saturation, exposure);
         d.X.vals[i] = sized.data;
 
-        fill_truth_region(random_paths[i], d.y.vals[i], classes, size, flip, dx, dy, 1./sx, 1./sy);
+        fill_truth_region_boxes(boxes, count, d.y.vals[i], classes, size, flip, dx, dy, 1./sx, 1./sy);
 
         free_image(orig);
         free_image(cropped);
     }
-    free(random_paths);
+    free(indexes);
     return d;
 }
 
+data load_data_region(int n, char **paths, int m, int w, int h, int size, int classes, float jitter, float hue, float saturation, float exposure)
+{
+    return load_region(n, paths, 0, m, w, h, size, classes, jitter, hue, saturation, exposure);
+}
+
+data load_data_region_shards(int n, shard_set *shards, int w, int h, int size, int classes, float jitter, float hue, float saturation, float exposure)
+{
+    return load_region(n, 0, shards, shards->count, w, h, size, classes, jitter, hue, saturation, exposure);
+}
+
 data load_data_compare(int n, char **paths, int m, int classes, int w, int h)
 {
     if(m) paths = get_random_paths(paths, 2*n, m);
@@ -951,9 +1203,9 @@ data load_data_swag(char **paths, int n, int classes, float jitter)
     return d;
 }
 
-data load_data_detection(int n, char **paths, int m, int w, int h, int boxes, int classes, float jitter, float hue, float saturation, float exposure)
+static data load_detection(int n, char **paths, shard_set *shards, int m, int w, int h, int boxes, int classes, float jitter, float hue, float saturation, float exposure)
 {
-    char **random_paths = get_random_paths(paths, n, m);
+    int *indexes = get_random_indexes(n, m);
     int i;
     data d = {0};
     d.shallow = 0;
@@ -964,7 +1216,9 @@ data load_data_detection(int n, char **paths, int m, int w, int h, int boxes, in
 
     d.y = make_matrix(n, 5*boxes);
     for(i = 0; i < n; ++i){
-        image orig = load_image_color(random_paths[i], 0, 0);
+        box_label *labels;
+        int count;
+        image orig = load_sample(paths, shards, indexes[i], 1, &labels, &count);
         image sized = make_image(w, h, orig.c);
         fill_image(sized, .5);
 
@@ -996,14 +1250,24 @@ data load_data_detection(int n, char **paths, int m, int w, int h, int boxes, in
         d.X.vals[i] = sized.data;
 
 
-        fill_truth_detection(random_paths[i], boxes, d.y.vals[i], classes, flip, -dx/w, -dy/h, nw/w, nh/h);
+        fill_truth_detection_boxes(labels, count, boxes, d.y.vals[i], classes, flip, -dx/w, -dy/h, nw/w, nh/h);
 
         free_image(orig);
     }
-    free(random_paths);
+    free(indexes);
     return d;
 }
 
+data load_data_detection(int n, char **paths, int m, int w, int h, int boxes, int classes, float jitter, float hue, float saturation, float exposure)
+{
+    return load_detection(n, paths, 0, m, w, h, boxes, classes, jitter, hue, saturation, exposure);
+}
+
+data load_data_detection_shards(int n, shard_set *shards, int w, int h, int boxes, int classes, float jitter, float hue, float saturation, float exposure)
+{
+    return load_detection(n, 0, shards, shards->count, w, h, boxes, classes, jitter, hue, saturation, exposure);
+}
+
 void *load_thread(void *ptr)
 {
     //printf("Loading data: %d\n", rand());
@@ -1026,8 +1290,12 @@ void *load_thread(void *ptr)
         *a.d = load_data_iseg(a.n, a.paths, a.m, a.w, a.h, a.classes, a.num_boxes, a.coords, a.min, a.max, a.angle, a.aspect, a.hue, a.saturation, a.exposure);
     } else if (a.type == SEGMENTATION_DATA){
         *a.d = load_data_seg(a.n, a.paths, a.m, a.w, a.h, a.classes, a.min, a.max, a.angle, a.aspect, a.hue, a.saturation, a.exposure, a.scale);
+    } else if (a.type == REGION_DATA && a.shards){
+        *a.d = load_data_region_shards(a.n, a.shards, a.w, a.h, a.num_boxes, a.classes, a.jitter, a.hue, a.saturation, a.exposure);
     } else if (a.type == REGION_DATA){
         *a.d = load_data_region(a.n, a.paths, a.m, a.w, a.h, a.num_boxes, a.classes, a.jitter, a.hue, a.saturation, a.exposure);
+    } else if (a.type == DETECTION_DATA && a.shards){
+        *a.d = load_data_detection_shards(a.n, a.shards, a.w, a.h, a.num_boxes, a.classes, a.jitter, a.hue, a.saturation, a.exposure);
     } else if (a.type == DETECTION_DATA){
         *a.d = load_data_detection(a.n, a.paths, a.m, a.w, a.h, a.num_boxes, a.classes, a.jitter, a.hue, a.saturation, a.exposure);
     } else if (a.type == SWAG_DATA){
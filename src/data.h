@@ -25,6 +25,8 @@ void print_letters(float *pred, int n);
 data load_data_captcha(char **paths, int n, int m, int k, int w, int h);
 data load_data_captcha_encode(char **paths, int n, int m, int w, int h);
 data load_data_detection(int n, char **paths, int m, int w, int h, int boxes, int classes, float jitter, float hue, float saturation, float exposure);
+data load_data_detection_shards(int n, shard_set *shards, int w, int h, int boxes, int classes, float jitter, float hue, float saturation, float exposure);
+data load_data_region_shards(int n, shard_set *shards, int w, int h, int size, int classes, float jitter, float hue, float saturation, float exposure);
 data load_data_tag(char **paths, int n, int m, int k, int min, int max, int size, float angle, float aspect, float hue, float saturation, float exposure);
 matrix load_image_augment_paths(char **paths, int n, int min, int max, int size, float angle, float aspect, float hue, float saturation, float exposure, int center);
 data load_data_super(char **paths, int n, int m, int w, int h, int scale);
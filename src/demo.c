@@ -305,6 +305,16 @@ struct detector_demo {
     int names_size;
     network *net;
     image **alphabet;
+    int num;
+    int classes;
+    box *boxes;
+    float **probs;
+    float **masks;
+    detection_result *results;
+    int results_count;
+    int results_size;
+    detector_demo_timings timings;
+    int max_batch;
 };
 
 detector_demo * make_detector_demo(const char *datacfg,
@@ -313,6 +323,7 @@ detector_demo * make_detector_demo(const char *datacfg,
                                    const float thresh,
                                    const float hier_thresh)
 {
+    int j;
     detector_demo *det = malloc(sizeof(detector_demo));
     det->thresh = thresh;
     det->hier_thresh = hier_thresh;
@@ -323,47 +334,239 @@ detector_demo * make_detector_demo(const char *datacfg,
     det->alphabet = load_alphabet();
     det->net = load_network(cfgfile, weightfile, 0);
     set_batch_network(det->net, 1);
+    det->max_batch = 1;
     srand(2222222);
     det->nms=.3;
 
+    layer l = det->net->layers[det->net->n-1];
+    det->num = l.w*l.h*l.n;
+    det->classes = l.classes;
+    det->boxes = calloc(det->num, sizeof(box));
+    det->probs = calloc(det->num, sizeof(float *));
+    for(j = 0; j < det->num; ++j) det->probs[j] = calloc(l.classes + 1, sizeof(float *));
+    det->masks = 0;
+    if (l.coords > 4){
+        det->masks = calloc(det->num, sizeof(float*));
+        for(j = 0; j < det->num; ++j) det->masks[j] = calloc(l.coords-4, sizeof(float *));
+    }
+    det->results = 0;
+    det->results_count = 0;
+    det->results_size = 0;
+    memset(&det->timings, 0, sizeof(det->timings));
+
     free_list_contents(options);
     free_list(options);
 
     return det;
 }
 
-void detector_demo_process_image(detector_demo *det, image im)
+/* Buffers are only reallocated for a batch larger than any before, smaller
+ * batches run in the first entries of them, so a call with n frames only
+ * computes n entries */
+void detector_demo_set_batch(detector_demo *det, int batch)
 {
-    int j;
+    set_batch_network(det->net, batch);
+    if (batch > det->max_batch) {
+        /* reallocates the layer buffers and the network input for the new batch */
+        resize_network(det->net, det->net->w, det->net->h);
+        det->max_batch = batch;
+    }
+}
+
+/* Draws detections of an earlier detect call into im, several classes
+ * of the same box share one label like in draw_detections. Only reads
+ * the names and the alphabet, so it may run next to a detect call. */
+void detector_demo_draw(detector_demo *det, image im, detection_result *dets, int n)
+{
+    int i, k;
+    int num = 0;
+    if (n <= 0) return;
+    box *boxes = calloc(n, sizeof(box));
+    float **probs = calloc(n, sizeof(float *));
+    for(i = 0; i < n; ++i){
+        for(k = 0; k < num; ++k){
+            if (!memcmp(&boxes[k], &dets[i].bbox, sizeof(box))) break;
+        }
+        if (k == num) {
+            boxes[num] = dets[i].bbox;
+            probs[num] = calloc(det->classes, sizeof(float));
+            ++num;
+        }
+        probs[k][dets[i].class_id] = dets[i].prob;
+    }
+    draw_detections(im, num, det->thresh, boxes, probs, 0, det->names, det->alphabet, det->classes);
+    for(k = 0; k < num; ++k) free(probs[k]);
+    free(probs);
+    free(boxes);
+}
+
+network *detector_demo_get_network(detector_demo *det)
+{
+    return det->net;
+}
+
+int detector_demo_get_batch(detector_demo *det)
+{
+    return det->max_batch;
+}
+
+static int detector_demo_collect(detector_demo *det)
+{
+    int i, j;
+    int count = 0;
+    for(i = 0; i < det->num; ++i){
+        for(j = 0; j < det->classes; ++j){
+            if (det->probs[i][j] > det->thresh){
+                if (det->results_count == det->results_size) {
+                    det->results_size = det->results_size ? 2*det->results_size : 64;
+                    det->results = realloc(det->results, det->results_size*sizeof(detection_result));
+                }
+                detection_result *d = det->results + det->results_count++;
+                d->class_id = j;
+                d->prob = det->probs[i][j];
+                d->bbox = det->boxes[i];
+                ++count;
+            }
+        }
+    }
+    return count;
+}
+
+/* Runs the batch already letterboxed into net->input and collects the
+ * detections of each entry, boxes relative to the original widths and
+ * heights. Detections are drawn into ims when given. */
+static int detector_demo_forward(detector_demo *det, int n, const int *widths, const int *heights, image *ims, int *counts)
+{
+    int b;
+    double time, now;
+    network *net = det->net;
+
+    time=what_time_is_it_now();
+    network_predict(net, net->input);
+    now=what_time_is_it_now();
+    det->timings.forward = now-time;
+    det->timings.nms = 0;
+    det->timings.draw = 0;
+
+    det->results_count = 0;
+    layer l = net->layers[net->n-1];
+    for(b = 0; b < n; ++b){
+        /* boxes are decoded one batch entry at a time; batch 2 would make
+         * get_region_boxes average the two entries as a flipped pair */
+        layer lb = l;
+        lb.output = l.output + b*l.outputs;
+        lb.batch = 1;
+        time=what_time_is_it_now();
+        get_region_boxes(lb, widths[b], heights[b], net->w, net->h, det->thresh, det->probs, det->boxes, det->masks, 0, 0, det->hier_thresh, 1);
+        if (det->nms) do_nms_sort(det->boxes, det->probs, det->num, det->classes, det->nms);
+        int count = detector_demo_collect(det);
+        if (counts) counts[b] = count;
+        now=what_time_is_it_now();
+        det->timings.nms += now-time;
+        if (ims) {
+            draw_detections(ims[b], det->num, det->thresh, det->boxes, det->probs, det->masks, det->names, det->alphabet, det->classes);
+            det->timings.draw += what_time_is_it_now()-now;
+        }
+    }
+    return det->results_count;
+}
+
+static int detector_demo_predict(detector_demo *det, image *ims, int n, int draw, int *counts)
+{
+    int b;
     double time;
-    image sized = letterbox_image(im, det->net->w, det->net->h);
-    //image sized = resize_image(im, net->w, net->h);
-    //image sized2 = resize_max(im, net->w);
-    //image sized = crop_image(sized2, -((net->w - sized2.w)/2), -((net->h - sized2.h)/2), net->w, net->h);
-    //resize_network(net, sized.w, sized.h);
-    layer l = det->net->layers[det->net->n-1];
+    network *net = det->net;
+    if (n != net->batch) detector_demo_set_batch(det, n);
 
-    box *boxes = calloc(l.w*l.h*l.n, sizeof(box));
-    float **probs = calloc(l.w*l.h*l.n, sizeof(float *));
-    for(j = 0; j < l.w*l.h*l.n; ++j) probs[j] = calloc(l.classes + 1, sizeof(float *));
-    float **masks = 0;
-    if (l.coords > 4){
-        masks = calloc(l.w*l.h*l.n, sizeof(float*));
-        for(j = 0; j < l.w*l.h*l.n; ++j) masks[j] = calloc(l.coords-4, sizeof(float *));
+    int *widths = calloc(2*n, sizeof(int));
+    int *heights = widths + n;
+    time=what_time_is_it_now();
+    for(b = 0; b < n; ++b){
+        image boxed = float_to_image(net->w, net->h, net->c, net->input + b*net->inputs);
+        fill_image(boxed, .5);
+        letterbox_image_into(ims[b], net->w, net->h, boxed);
+        widths[b] = ims[b].w;
+        heights[b] = ims[b].h;
     }
+    det->timings.letterbox = what_time_is_it_now()-time;
+
+    int total = detector_demo_forward(det, n, widths, heights, draw ? ims : 0, counts);
+    free(widths);
+    return total;
+}
 
-    float *X = sized.data;
+int detector_demo_detect_yuv(detector_demo *det, yuv_frame *frames, int n, int *counts)
+{
+    int b;
+    double time;
+    network *net = det->net;
+    if (n != net->batch) detector_demo_set_batch(det, n);
+
+    int *widths = calloc(2*n, sizeof(int));
+    int *heights = widths + n;
     time=what_time_is_it_now();
-    network_predict(det->net, X);
-    printf("Predicted in %f seconds.\n", what_time_is_it_now()-time);
-    get_region_boxes(l, im.w, im.h, det->net->w, det->net->h, det->thresh, probs, boxes, masks, 0, 0, det->hier_thresh, 1);
-    //if (nms) do_nms_obj(boxes, probs, l.w*l.h*l.n, l.classes, nms);
-    if (det->nms) do_nms_sort(boxes, probs, l.w*l.h*l.n, l.classes, det->nms);
-    draw_detections(im, l.w*l.h*l.n, det->thresh, boxes, probs, masks, det->names, det->alphabet, l.classes);
-
-    free_image(sized);
-    free(boxes);
-    free_ptrs((void **)probs, l.w*l.h*l.n);
+    for(b = 0; b < n; ++b){
+        image boxed = float_to_image(net->w, net->h, net->c, net->input + b*net->inputs);
+        letterbox_yuv_into(frames[b], boxed);
+        widths[b] = frames[b].w;
+        heights[b] = frames[b].h;
+    }
+    det->timings.letterbox = what_time_is_it_now()-time;
+
+    int total = detector_demo_forward(det, n, widths, heights, 0, counts);
+    free(widths);
+    return total;
+}
+
+int detector_demo_detect_frames(detector_demo *det, frame_data *frames, int n, int swap_rb, int *counts)
+{
+    int b;
+    double time;
+    network *net = det->net;
+    if (n != net->batch) detector_demo_set_batch(det, n);
+
+    int *widths = calloc(2*n, sizeof(int));
+    int *heights = widths + n;
+    time=what_time_is_it_now();
+    for(b = 0; b < n; ++b){
+        image boxed = float_to_image(net->w, net->h, net->c, net->input + b*net->inputs);
+        frame_data f = frames[b];
+        letterbox_data_into(f.data, f.w, f.h, f.c, f.bytes_per_line, swap_rb, boxed);
+        widths[b] = f.w;
+        heights[b] = f.h;
+    }
+    det->timings.letterbox = what_time_is_it_now()-time;
+
+    int total = detector_demo_forward(det, n, widths, heights, 0, counts);
+    free(widths);
+    return total;
+}
+
+void detector_demo_process_image(detector_demo *det, image im)
+{
+    detector_demo_predict(det, &im, 1, 1, 0);
+}
+
+int detector_demo_detect(detector_demo *det, image im, int draw)
+{
+    return detector_demo_predict(det, &im, 1, draw, 0);
+}
+
+int detector_demo_detect_batch(detector_demo *det, image *ims, int n, int draw, int *counts)
+{
+    return detector_demo_predict(det, ims, n, draw, counts);
+}
+
+int detector_demo_get_detections(detector_demo *det, detection_result *dets, int max_dets)
+{
+    int n = det->results_count < max_dets ? det->results_count : max_dets;
+    if (n > 0) memcpy(dets, det->results, n*sizeof(detection_result));
+    return det->results_count;
+}
+
+detector_demo_timings detector_demo_get_timings(detector_demo *det)
+{
+    return det->timings;
 }
 
 void detector_demo_process_file(detector_demo *det,
@@ -371,11 +574,11 @@ void detector_demo_process_file(detector_demo *det,
                                 const char *outfile)
 {
     int j;
-    double time;
     printf("%s: ", filename);
     image im = load_image_color(filename, 0,0);
 
     detector_demo_process_image(det, im);
+    printf("Predicted in %f seconds.\n", det->timings.forward);
 
     if (outfile) {
         save_image(im, outfile);
@@ -389,6 +592,10 @@ void detector_demo_process_file(detector_demo *det,
 
 void free_detector_demo(detector_demo *det)
 {
+    free(det->boxes);
+    free_ptrs((void **)det->probs, det->num);
+    if (det->masks) free_ptrs((void **)det->masks, det->num);
+    free(det->results);
     free_network(det->net);
     free_alphabet(det->alphabet);
     free_ptrs((void**)det->names, det->names_size);
@@ -3,7 +3,12 @@
 #include "blas.h"
 #include "cuda.h"
 #include <stdio.h>
+#include <stdint.h>
 #include <math.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 #define STB_IMAGE_IMPLEMENTATION
 #include "stb_image.h"
@@ -219,11 +224,95 @@ void draw_bbox(image a, box bbox, int w, float r, float g, float b)
     }
 }
 
+/* Packed glyph atlas written by data/labels/make_labels.py: a header, one
+ * index entry per glyph and the glyphs as float CHW images, little endian */
+#define ALPHABET_ATLAS "data/labels/labels.atlas"
+#define ALPHABET_ATLAS_MAGIC 0x414c4e44 /* "DNLA" */
+#define ALPHABET_ATLAS_VERSION 1
+#define ALPHABET_SIZES 8
+
+typedef struct{
+    uint32_t magic;
+    uint32_t version;
+    uint32_t nsize;
+    uint32_t first;
+    uint32_t last;
+    uint32_t channels;
+    uint32_t reserved[2];
+} alphabet_atlas_header;
+
+typedef struct{
+    int32_t w;
+    int32_t h;
+    uint64_t offset;
+} alphabet_atlas_entry;
+
+typedef struct{
+    void *base;
+    size_t size;
+} alphabet_mapping;
+
+/* Glyph images point into the mapping, which is kept in the slot after the
+ * last size so free_alphabet can tell both kinds of alphabets apart */
+static image **map_alphabet(const char *filename)
+{
+    int i, j;
+    const int nsize = ALPHABET_SIZES;
+    int fd = open(filename, O_RDONLY);
+    if(fd < 0) return 0;
+    struct stat st;
+    if(fstat(fd, &st) < 0 || st.st_size < (off_t)sizeof(alphabet_atlas_header)){
+        close(fd);
+        return 0;
+    }
+    size_t size = st.st_size;
+    /* private writable mapping, pages stay shared unless someone writes */
+    void *base = mmap(0, size, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if(base == MAP_FAILED) return 0;
+
+    alphabet_atlas_header *header = base;
+    size_t index_size = sizeof(alphabet_atlas_header) + (size_t)nsize*(header->last - header->first)*sizeof(alphabet_atlas_entry);
+    if(header->magic != ALPHABET_ATLAS_MAGIC || header->version != ALPHABET_ATLAS_VERSION ||
+            header->nsize != nsize || header->first > 32 || header->last < 127 || header->last > 128 ||
+            header->channels != 3 || index_size > size){
+        fprintf(stderr, "Ignoring invalid glyph atlas %s\n", filename);
+        munmap(base, size);
+        return 0;
+    }
+    alphabet_atlas_entry *entries = (alphabet_atlas_entry *)(header + 1);
+    image **alphabets = calloc(nsize + 1, sizeof(image *));
+    for(j = 0; j < nsize; ++j){
+        alphabets[j] = calloc(128, sizeof(image));
+        for(i = header->first; i < header->last; ++i){
+            alphabet_atlas_entry e = entries[j*(header->last - header->first) + i - header->first];
+            size_t bytes = (size_t)e.w*e.h*header->channels*sizeof(float);
+            if(e.w < 0 || e.h < 0 || e.offset % sizeof(float) || e.offset > size || bytes > size - e.offset){
+                fprintf(stderr, "Ignoring invalid glyph atlas %s\n", filename);
+                for(j = 0; j < nsize; ++j) free(alphabets[j]);
+                free(alphabets);
+                munmap(base, size);
+                return 0;
+            }
+            image im = {e.w, e.h, header->channels, (float *)((char *)base + e.offset)};
+            alphabets[j][i] = im;
+        }
+    }
+    alphabet_mapping *mapping = calloc(1, sizeof(alphabet_mapping));
+    mapping->base = base;
+    mapping->size = size;
+    alphabets[nsize] = (image *)mapping;
+    return alphabets;
+}
+
 image **load_alphabet()
 {
     int i, j;
-    const int nsize = 8;
-    image **alphabets = calloc(nsize, sizeof(image));
+    const int nsize = ALPHABET_SIZES;
+    image **alphabets = map_alphabet(ALPHABET_ATLAS);
+    if(alphabets) return alphabets;
+    fprintf(stderr, "No glyph atlas %s, loading the label PNGs; run make labels\n", ALPHABET_ATLAS);
+    alphabets = calloc(nsize + 1, sizeof(image *));
     for(j = 0; j < nsize; ++j){
         alphabets[j] = calloc(128, sizeof(image));
         for(i = 32; i < 127; ++i){
@@ -238,13 +327,20 @@ image **load_alphabet()
 void free_alphabet(image **alphabet)
 {
     int i, j;
-    const int nsize = 8;
+    const int nsize = ALPHABET_SIZES;
+    alphabet_mapping *mapping = (alphabet_mapping *)alphabet[nsize];
     for(j = 0; j < nsize; ++j){
-        for(i = 32; i < 127; ++i){
-            free_image(alphabet[j][i]);
+        if(!mapping){
+            for(i = 32; i < 127; ++i){
+                free_image(alphabet[j][i]);
+            }
         }
         free(alphabet[j]);
     }
+    if(mapping){
+        munmap(mapping->base, mapping->size);
+        free(mapping);
+    }
     free(alphabet);
 }
 
@@ -987,6 +1083,268 @@ void letterbox_image_into(image im, int w, int h, image boxed)
     free_image(resized);
 }
 
+/* Interpolates an interleaved 8 bit frame to new_w x new_h normalized to
+ * [0, 1] into out at dx, dy. Interpolation matches resize_image. */
+static void resize_data_region(const unsigned char *data, int width, int height, int bytes_per_pixel, int bytes_per_line, int swap_rb, image out, int dx0, int dy0, int new_w, int new_h)
+{
+    int y, c, k;
+    int plane = out.w*out.h;
+    float w_scale = (float)(width - 1) / (new_w - 1);
+    float h_scale = (float)(height - 1) / (new_h - 1);
+    for(y = 0; y < new_h; ++y){
+        float sy = y*h_scale;
+        int iy = (int) sy;
+        float dy = sy - iy;
+        if(y == new_h-1 || height == 1){
+            iy = height-1;
+            dy = 0;
+        }
+        const unsigned char *row0 = data + iy*bytes_per_line;
+        const unsigned char *row1 = dy > 0 ? row0 + bytes_per_line : row0;
+        float *dst = out.data + (y + dy0)*out.w + dx0;
+        for(c = 0; c < new_w; ++c){
+            float sx = c*w_scale;
+            int ix = (int) sx;
+            float dx = sx - ix;
+            if(c == new_w-1 || width == 1){
+                ix = width-1;
+                dx = 0;
+            }
+            const unsigned char *p0 = row0 + ix*bytes_per_pixel;
+            const unsigned char *p1 = row1 + ix*bytes_per_pixel;
+            int next = dx > 0 ? bytes_per_pixel : 0;
+            for(k = 0; k < out.c; ++k){
+                /* gray frames are replicated into every channel */
+                int src = bytes_per_pixel == 1 ? 0 : (swap_rb && k != 1) ? 2 - k : k;
+                float top = (1-dx)*p0[src] + dx*p0[src + next];
+                float bot = (1-dx)*p1[src] + dx*p1[src + next];
+                dst[k*plane + c] = ((1-dy)*top + dy*bot)/255.;
+            }
+        }
+    }
+}
+
+/* Resizes an interleaved 8 bit frame to fit boxed, keeping its aspect
+ * ratio, and writes it normalized to [0, 1] into the middle of boxed with
+ * .5 around it, in one pass without intermediate images. Interpolation
+ * matches letterbox_image. With swap_rb the first and third channels are
+ * exchanged, e.g. to read BGR frames. Frames need at least boxed.c
+ * channels or a single gray one. */
+letterbox_geometry letterbox_data_into(const unsigned char *data, int width, int height, int bytes_per_pixel, int bytes_per_line, int swap_rb, image boxed)
+{
+    int w = boxed.w;
+    int h = boxed.h;
+    int new_w = width;
+    int new_h = height;
+    if (((float)w/width) < ((float)h/height)) {
+        new_w = w;
+        new_h = (height * w)/width;
+    } else {
+        new_h = h;
+        new_w = (width * h)/height;
+    }
+    letterbox_geometry g;
+    g.w = new_w;
+    g.h = new_h;
+    g.dx = (w-new_w)/2;
+    g.dy = (h-new_h)/2;
+    g.scale = (float)new_w/width;
+
+    int r, c, k;
+    int plane = w*h;
+    for(r = 0; r < h; ++r){
+        int y = r - g.dy;
+        if(y < 0 || y >= new_h){
+            for(k = 0; k < boxed.c; ++k) fill_cpu(w, .5, boxed.data + k*plane + r*w, 1);
+            continue;
+        }
+        for(k = 0; k < boxed.c; ++k){
+            float *out = boxed.data + k*plane + r*w;
+            for(c = 0; c < g.dx; ++c) out[c] = .5;
+            for(c = g.dx + new_w; c < w; ++c) out[c] = .5;
+        }
+    }
+    resize_data_region(data, width, height, bytes_per_pixel, bytes_per_line, swap_rb, boxed, g.dx, g.dy, new_w, new_h);
+    return g;
+}
+
+/* Stretches an interleaved 8 bit frame over all of out like resize_image,
+ * see letterbox_data_into for the frame layout */
+void resize_data_into(const unsigned char *data, int width, int height, int bytes_per_pixel, int bytes_per_line, int swap_rb, image out)
+{
+    resize_data_region(data, width, height, bytes_per_pixel, bytes_per_line, swap_rb, out, 0, 0, out.w, out.h);
+}
+
+/* Limited range YUV to RGB in [0, 1], BT.601 or BT.709 coefficients
+ * scaled by 1/255 */
+static const float yuv_coef[2][5] = {
+    {1.164/255., 1.596/255., .392/255., .813/255., 2.017/255.},
+    {1.164/255., 1.793/255., .213/255., .533/255., 2.112/255.}};
+
+static inline float clamp01(float x)
+{
+    return x < 0 ? 0 : (x > 1 ? 1 : x);
+}
+
+static inline void yuv_pixel_to_rgb(const float *m, float y, float u, float v, float *r, float *g, float *b)
+{
+    float l = m[0]*(y - 16);
+    u -= 128;
+    v -= 128;
+    *r = clamp01(l + m[1]*v);
+    *g = clamp01(l - m[2]*u - m[3]*v);
+    *b = clamp01(l + m[4]*u);
+}
+
+/* Converts a YUV frame into a planar RGB image of the same size */
+void yuv_into_image(yuv_frame f, image im)
+{
+    int x, y;
+    int plane = im.w*im.h;
+    const float *m = yuv_coef[f.bt709 ? 1 : 0];
+    for(y = 0; y < f.h; ++y){
+        const unsigned char *yrow = f.y + y*f.y_stride;
+        const unsigned char *urow = f.u + (y/2)*f.uv_stride;
+        const unsigned char *vrow = f.v + (y/2)*f.uv_stride;
+        float *r = im.data + y*im.w;
+        float *g = r + plane;
+        float *b = g + plane;
+        for(x = 0; x < f.w; ++x){
+            int uv = (x/2)*f.uv_step;
+            yuv_pixel_to_rgb(m, yrow[x], urow[uv], vrow[uv], r + x, g + x, b + x);
+        }
+    }
+}
+
+static inline unsigned char to_byte(float x)
+{
+    return (unsigned char) constrain(0, 255, x + .5);
+}
+
+/* Writes a planar RGB image of the frame size into the YUV planes,
+ * chroma is averaged over each 2x2 block */
+void image_into_yuv(image im, yuv_frame f)
+{
+    int x, y, dx, dy;
+    int plane = im.w*im.h;
+    float kr = f.bt709 ? .2126 : .299;
+    float kb = f.bt709 ? .0722 : .114;
+    float kg = 1 - kr - kb;
+    for(y = 0; y < f.h; ++y){
+        for(x = 0; x < f.w; ++x){
+            int i = y*im.w + x;
+            float l = kr*im.data[i] + kg*im.data[plane + i] + kb*im.data[2*plane + i];
+            f.y[y*f.y_stride + x] = to_byte(16 + 219*l);
+        }
+    }
+    for(y = 0; y < f.h; y += 2){
+        for(x = 0; x < f.w; x += 2){
+            float r = 0, g = 0, b = 0;
+            int n = 0;
+            for(dy = 0; dy < 2 && y + dy < f.h; ++dy){
+                for(dx = 0; dx < 2 && x + dx < f.w; ++dx){
+                    int i = (y + dy)*im.w + x + dx;
+                    r += im.data[i];
+                    g += im.data[plane + i];
+                    b += im.data[2*plane + i];
+                    ++n;
+                }
+            }
+            r /= n; g /= n; b /= n;
+            float l = kr*r + kg*g + kb*b;
+            int uv = (y/2)*f.uv_stride + (x/2)*f.uv_step;
+            f.u[uv] = to_byte(128 + 224*(b - l)/(2*(1 - kb)));
+            f.v[uv] = to_byte(128 + 224*(r - l)/(2*(1 - kr)));
+        }
+    }
+}
+
+/* Like letterbox_data_into for YUV frames. The planes are interpolated
+ * before converting, so every pixel is converted once */
+letterbox_geometry letterbox_yuv_into(yuv_frame f, image boxed)
+{
+    int w = boxed.w;
+    int h = boxed.h;
+    int new_w = f.w;
+    int new_h = f.h;
+    if (((float)w/f.w) < ((float)h/f.h)) {
+        new_w = w;
+        new_h = (f.h * w)/f.w;
+    } else {
+        new_h = h;
+        new_w = (f.w * h)/f.h;
+    }
+    letterbox_geometry g;
+    g.w = new_w;
+    g.h = new_h;
+    g.dx = (w-new_w)/2;
+    g.dy = (h-new_h)/2;
+    g.scale = (float)new_w/f.w;
+
+    int r, c, k;
+    int plane = w*h;
+    const float *m = yuv_coef[f.bt709 ? 1 : 0];
+    float w_scale = (float)(f.w - 1) / (new_w - 1);
+    float h_scale = (float)(f.h - 1) / (new_h - 1);
+    int *xs = calloc(4*new_w, sizeof(int));
+    float *dxs = calloc(new_w, sizeof(float));
+    for(c = 0; c < new_w; ++c){
+        float sx = c*w_scale;
+        int ix = (int) sx;
+        float dx = sx - ix;
+        if(c == new_w-1 || f.w == 1){
+            ix = f.w-1;
+            dx = 0;
+        }
+        int ix1 = dx > 0 ? ix + 1 : ix;
+        xs[4*c] = ix;
+        xs[4*c+1] = ix1;
+        xs[4*c+2] = (ix/2)*f.uv_step;
+        xs[4*c+3] = (ix1/2)*f.uv_step;
+        dxs[c] = dx;
+    }
+    for(r = 0; r < h; ++r){
+        int y = r - g.dy;
+        if(y < 0 || y >= new_h){
+            for(k = 0; k < boxed.c; ++k) fill_cpu(w, .5, boxed.data + k*plane + r*w, 1);
+            continue;
+        }
+        float sy = y*h_scale;
+        int iy = (int) sy;
+        float dy = sy - iy;
+        if(y == new_h-1 || f.h == 1){
+            iy = f.h-1;
+            dy = 0;
+        }
+        int iy1 = dy > 0 ? iy + 1 : iy;
+        const unsigned char *y0 = f.y + iy*f.y_stride;
+        const unsigned char *y1 = f.y + iy1*f.y_stride;
+        const unsigned char *u0 = f.u + (iy/2)*f.uv_stride;
+        const unsigned char *u1 = f.u + (iy1/2)*f.uv_stride;
+        const unsigned char *v0 = f.v + (iy/2)*f.uv_stride;
+        const unsigned char *v1 = f.v + (iy1/2)*f.uv_stride;
+        float *out = boxed.data + r*w;
+        for(k = 0; k < boxed.c; ++k){
+            for(c = 0; c < g.dx; ++c) out[k*plane + c] = .5;
+            for(c = g.dx + new_w; c < w; ++c) out[k*plane + c] = .5;
+        }
+        out += g.dx;
+        for(c = 0; c < new_w; ++c){
+            const int *x = xs + 4*c;
+            float dx = dxs[c];
+            float yv = (1-dy)*((1-dx)*y0[x[0]] + dx*y0[x[1]]) + dy*((1-dx)*y1[x[0]] + dx*y1[x[1]]);
+            float uv = (1-dy)*((1-dx)*u0[x[2]] + dx*u0[x[3]]) + dy*((1-dx)*u1[x[2]] + dx*u1[x[3]]);
+            float vv = (1-dy)*((1-dx)*v0[x[2]] + dx*v0[x[3]]) + dy*((1-dx)*v1[x[2]] + dx*v1[x[3]]);
+            float rgb[3];
+            yuv_pixel_to_rgb(m, yv, uv, vv, rgb, rgb + 1, rgb + 2);
+            for(k = 0; k < 3 && k < boxed.c; ++k) out[k*plane + c] = rgb[k];
+        }
+    }
+    free(xs);
+    free(dxs);
+    return g;
+}
+
 image letterbox_image(image im, int w, int h)
 {
     int new_w = im.w;
@@ -1469,15 +1827,8 @@ void test_resize(char *filename)
 }
 
 
-image load_image_stb(char *filename, int channels)
+static image stb_to_image(unsigned char *data, int w, int h, int c)
 {
-    int w, h, c;
-    unsigned char *data = stbi_load(filename, &w, &h, &c, channels);
-    if (!data) {
-        fprintf(stderr, "Cannot load image \"%s\"\nSTB Reason: %s\n", filename, stbi_failure_reason());
-        exit(0);
-    }
-    if(channels) c = channels;
     int i,j,k;
     image im = make_image(w, h, c);
     for(k = 0; k < c; ++k){
@@ -1493,6 +1844,32 @@ image load_image_stb(char *filename, int channels)
     return im;
 }
 
+image load_image_stb(char *filename, int channels)
+{
+    int w, h, c;
+    unsigned char *data = stbi_load(filename, &w, &h, &c, channels);
+    if (!data) {
+        fprintf(stderr, "Cannot load image \"%s\"\nSTB Reason: %s\n", filename, stbi_failure_reason());
+        exit(0);
+    }
+    if(channels) c = channels;
+    return stb_to_image(data, w, h, c);
+}
+
+/* Decodes an encoded image held in memory. Unlike load_image a broken
+ * image does not end the process, an image without data is returned. */
+image load_image_memory(const unsigned char *buf, int len, int channels)
+{
+    int w, h, c;
+    unsigned char *data = stbi_load_from_memory(buf, len, &w, &h, &c, channels);
+    if (!data) {
+        image empty = {0};
+        return empty;
+    }
+    if(channels) c = channels;
+    return stb_to_image(data, w, h, c);
+}
+
 image load_image(const char *filename, int w, int h, int c)
 {
 #ifdef OPENCV
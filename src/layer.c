@@ -110,3 +110,8 @@ int get_layer_n(layer *l)
 {
     return l->n;
 }
+
+int get_layer_classes(layer *l)
+{
+    return l->classes;
+}
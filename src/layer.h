@@ -6,5 +6,6 @@
 int get_layer_h(layer *l);
 int get_layer_w(layer *l);
 int get_layer_n(layer *l);
+int get_layer_classes(layer *l);
 
 #endif
@@ -64,19 +64,73 @@ size_t get_current_batch(network *net)
     return batch_num;
 }
 
+network *load_network_batch(const char *cfg, const char *weights, int clear, int batch)
+{
+    network *net = parse_network_cfg_batch(cfg, batch);
+    if(weights && weights[0] != 0){
+        load_weights(net, weights);
+    }
+    if(clear) (*net->seen) = 0;
+    return net;
+}
+
 void reset_network_state(network *net, int b)
 {
     int i;
     for (i = 0; i < net->n; ++i) {
-        #ifdef GPU
         layer l = net->layers[i];
+        #ifdef GPU
         if(l.state_gpu){
             fill_gpu(l.outputs, 0, l.state_gpu + l.outputs*b, 1);
         }
         if(l.h_gpu){
             fill_gpu(l.outputs, 0, l.h_gpu + l.outputs*b, 1);
         }
+        if(l.c_gpu){
+            fill_gpu(l.outputs, 0, l.c_gpu + l.outputs*b, 1);
+        }
+        #endif
+        if(l.state) fill_cpu(l.outputs, 0, l.state + l.outputs*b, 1);
+        if(l.h_cpu) fill_cpu(l.outputs, 0, l.h_cpu + l.outputs*b, 1);
+        if(l.c_cpu) fill_cpu(l.outputs, 0, l.c_cpu + l.outputs*b, 1);
+    }
+}
+
+static void gather_rows(float *x, int size, const int *rows, int n)
+{
+    int j;
+    float *tmp = calloc(size*n, sizeof(float));
+    for(j = 0; j < n; ++j) copy_cpu(size, x + rows[j]*size, 1, tmp + j*size, 1);
+    copy_cpu(size*n, tmp, 1, x, 1);
+    free(tmp);
+}
+
+#ifdef GPU
+static void gather_rows_gpu(float *x_gpu, int size, const int *rows, int n)
+{
+    int j;
+    float *tmp = calloc(size*n, sizeof(float));
+    for(j = 0; j < n; ++j) cuda_pull_array(x_gpu + rows[j]*size, tmp + j*size, size);
+    cuda_push_array(x_gpu, tmp, size*n);
+    free(tmp);
+}
+#endif
+
+/* Recurrent state of batch entry j becomes that of entry rows[j] for the
+ * first n entries, e.g. to follow the surviving beams of a beam search. */
+void reorder_network_state(network *net, const int *rows, int n)
+{
+    int i;
+    for (i = 0; i < net->n; ++i) {
+        layer l = net->layers[i];
+        #ifdef GPU
+        if(l.state_gpu) gather_rows_gpu(l.state_gpu, l.outputs, rows, n);
+        if(l.h_gpu) gather_rows_gpu(l.h_gpu, l.outputs, rows, n);
+        if(l.c_gpu) gather_rows_gpu(l.c_gpu, l.outputs, rows, n);
         #endif
+        if(l.state) gather_rows(l.state, l.outputs, rows, n);
+        if(l.h_cpu) gather_rows(l.h_cpu, l.outputs, rows, n);
+        if(l.c_cpu) gather_rows(l.c_cpu, l.outputs, rows, n);
     }
 }
 
@@ -554,6 +608,7 @@ float *network_predict_image(network *net, image im)
 
 int network_width(network *net){return net->w;}
 int network_height(network *net){return net->h;}
+int network_batch(network *net){return net->batch;}
 
 matrix network_predict_data_multi(network *net, data test, int n)
 {
@@ -683,6 +738,8 @@ float network_accuracy_multi(network *net, data d, int n)
 void free_network(network *net)
 {
     int i;
+    /* layers must not free arrays pointing into the mapping */
+    free_mapped_weights(net);
     for(i = 0; i < net->n; ++i){
         free_layer(net->layers[i]);
     }
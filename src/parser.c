@@ -1,7 +1,12 @@
 #include <stdio.h>
 #include <string.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include <assert.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 #include "activation_layer.h"
 #include "activations.h"
@@ -632,6 +637,13 @@ int is_network(section *s)
 }
 
 network *parse_network_cfg(const char *filename)
+{
+    return parse_network_cfg_batch(filename, 0);
+}
+
+/* Like parse_network_cfg with batch sequences per pass instead of the
+ * configured batch, unless batch is 0 */
+network *parse_network_cfg_batch(const char *filename, int batch)
 {
     list *sections = read_cfg(filename);
     node *n = sections->front;
@@ -644,6 +656,7 @@ network *parse_network_cfg(const char *filename)
     list *options = s->options;
     if(!is_network(s)) error("First section must be [net] or [network]");
     parse_net_options(options, net);
+    if(batch > 0) net->batch = batch*net->time_steps;
 
     params.h = net->h;
     params.w = net->w;
@@ -1092,6 +1105,241 @@ void load_convolutional_weights(layer l, FILE *fp)
 }
 
 
+/* Mapped weight files hold the same parameters as regular weight files in
+ * the order load_weights_upto reads them, already transposed where needed.
+ * Every array is preceded by its length and starts at a multiple of
+ * WEIGHTS_MAP_ALIGNMENT bytes, so layers can point straight into a mapping
+ * of the file shared by all processes using it. */
+#define WEIGHTS_MAP_MAGIC 0x4d574e44 /* "DNWM" */
+#define WEIGHTS_MAP_VERSION 1
+#define WEIGHTS_MAP_ALIGNMENT 64
+
+typedef struct{
+    uint32_t magic;
+    uint32_t version;
+    int32_t major;
+    int32_t minor;
+    int32_t revision;
+    uint32_t alignment;
+    uint64_t seen;
+} weights_map_header;
+
+typedef void (*weights_map_fn)(float **array, size_t n, void *ctx);
+
+static void map_connected_arrays(layer *l, weights_map_fn fn, void *ctx)
+{
+    fn(&l->biases, l->outputs, ctx);
+    fn(&l->weights, (size_t)l->outputs*l->inputs, ctx);
+    if (l->batch_normalize && (!l->dontloadscales)){
+        fn(&l->scales, l->outputs, ctx);
+        fn(&l->rolling_mean, l->outputs, ctx);
+        fn(&l->rolling_variance, l->outputs, ctx);
+    }
+}
+
+static void map_convolutional_arrays(layer *l, weights_map_fn fn, void *ctx)
+{
+    fn(&l->biases, l->n, ctx);
+    if (l->batch_normalize && (!l->dontloadscales)){
+        fn(&l->scales, l->n, ctx);
+        fn(&l->rolling_mean, l->n, ctx);
+        fn(&l->rolling_variance, l->n, ctx);
+    }
+    fn(&l->weights, l->nweights, ctx);
+}
+
+/* Calls fn on every parameter array of the layers in [start, cutoff) in file order */
+static void map_weight_arrays(network *net, int start, int cutoff, weights_map_fn fn, void *ctx)
+{
+    int i;
+    for(i = start; i < net->n && i < cutoff; ++i){
+        layer *l = &net->layers[i];
+        if (l->dontload) continue;
+        if(l->type == CONVOLUTIONAL || l->type == DECONVOLUTIONAL){
+            map_convolutional_arrays(l, fn, ctx);
+        }
+        if(l->type == CONNECTED){
+            map_connected_arrays(l, fn, ctx);
+        }
+        if(l->type == BATCHNORM){
+            fn(&l->scales, l->c, ctx);
+            fn(&l->rolling_mean, l->c, ctx);
+            fn(&l->rolling_variance, l->c, ctx);
+        }
+        if(l->type == CRNN){
+            map_convolutional_arrays(l->input_layer, fn, ctx);
+            map_convolutional_arrays(l->self_layer, fn, ctx);
+            map_convolutional_arrays(l->output_layer, fn, ctx);
+        }
+        if(l->type == RNN){
+            map_connected_arrays(l->input_layer, fn, ctx);
+            map_connected_arrays(l->self_layer, fn, ctx);
+            map_connected_arrays(l->output_layer, fn, ctx);
+        }
+        if (l->type == LSTM) {
+            map_connected_arrays(l->wi, fn, ctx);
+            map_connected_arrays(l->wf, fn, ctx);
+            map_connected_arrays(l->wo, fn, ctx);
+            map_connected_arrays(l->wg, fn, ctx);
+            map_connected_arrays(l->ui, fn, ctx);
+            map_connected_arrays(l->uf, fn, ctx);
+            map_connected_arrays(l->uo, fn, ctx);
+            map_connected_arrays(l->ug, fn, ctx);
+        }
+        if (l->type == GRU) {
+            map_connected_arrays(l->wz, fn, ctx);
+            map_connected_arrays(l->wr, fn, ctx);
+            map_connected_arrays(l->wh, fn, ctx);
+            map_connected_arrays(l->uz, fn, ctx);
+            map_connected_arrays(l->ur, fn, ctx);
+            map_connected_arrays(l->uh, fn, ctx);
+        }
+        if(l->type == LOCAL){
+            fn(&l->biases, l->outputs, ctx);
+            fn(&l->weights, (size_t)l->size*l->size*l->c*l->n*l->out_w*l->out_h, ctx);
+        }
+    }
+}
+
+static void write_aligned_array(float **array, size_t n, void *ctx)
+{
+    static const char zeros[WEIGHTS_MAP_ALIGNMENT] = {0};
+    FILE *fp = ctx;
+    uint64_t count = n;
+    fwrite(&count, sizeof(uint64_t), 1, fp);
+    long pos = ftell(fp);
+    fwrite(zeros, 1, (WEIGHTS_MAP_ALIGNMENT - pos % WEIGHTS_MAP_ALIGNMENT) % WEIGHTS_MAP_ALIGNMENT, fp);
+    fwrite(*array, sizeof(float), n, fp);
+}
+
+void save_weights_mapped(network *net, const char *filename)
+{
+#ifdef GPU
+    if(net->gpu_index >= 0){
+        cuda_set_device(net->gpu_index);
+    }
+    int i;
+    for(i = 0; i < net->n; ++i){
+        layer l = net->layers[i];
+        if(l.type == CONVOLUTIONAL || l.type == DECONVOLUTIONAL) pull_convolutional_layer(l);
+        if(l.type == CONNECTED) pull_connected_layer(l);
+        if(l.type == BATCHNORM) pull_batchnorm_layer(l);
+        if(l.type == LOCAL) pull_local_layer(l);
+    }
+#endif
+    fprintf(stderr, "Saving mapped weights to %s\n", filename);
+    FILE *fp = fopen(filename, "wb");
+    if(!fp) file_error(filename);
+
+    weights_map_header header = {WEIGHTS_MAP_MAGIC, WEIGHTS_MAP_VERSION, 0, 2, 0, WEIGHTS_MAP_ALIGNMENT, *net->seen};
+    fwrite(&header, sizeof(header), 1, fp);
+    map_weight_arrays(net, 0, net->n, write_aligned_array, fp);
+    fclose(fp);
+}
+
+typedef struct{
+    char *base;
+    size_t size;
+    size_t offset;
+    int skip;
+    int error;
+} weights_map_reader;
+
+static void point_to_mapped_array(float **array, size_t n, void *ctx)
+{
+    weights_map_reader *r = ctx;
+    if(r->error) return;
+    uint64_t count;
+    if(r->offset + sizeof(uint64_t) > r->size){
+        r->error = 1;
+        return;
+    }
+    memcpy(&count, r->base + r->offset, sizeof(uint64_t));
+    r->offset += sizeof(uint64_t);
+    r->offset += (WEIGHTS_MAP_ALIGNMENT - r->offset % WEIGHTS_MAP_ALIGNMENT) % WEIGHTS_MAP_ALIGNMENT;
+    if(count != n || r->offset > r->size || n*sizeof(float) > r->size - r->offset){
+        r->error = 1;
+        return;
+    }
+    if(!r->skip){
+        free(*array);
+        *array = (float *)(r->base + r->offset);
+    }
+    r->offset += n*sizeof(float);
+}
+
+static void unmap_array(float **array, size_t n, void *ctx)
+{
+    weights_map_reader *r = ctx;
+    char *p = (char *)*array;
+    if(p >= r->base && p < r->base + r->size) *array = 0;
+}
+
+static void load_weights_mapped(network *net, const char *filename, int start, int cutoff)
+{
+    if(net->weights_map){
+        fprintf(stderr, "Network already uses mapped weights, cannot map %s\n", filename);
+        exit(-1);
+    }
+    int fd = open(filename, O_RDONLY);
+    if(fd < 0) file_error(filename);
+    struct stat st;
+    if(fstat(fd, &st) < 0) file_error(filename);
+    weights_map_reader r = {0};
+    r.size = st.st_size;
+    /* private writable mapping: pages are shared with every other process
+     * mapping the file until a layer writes to them, e.g. when training */
+    r.base = mmap(0, r.size, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if(r.base == MAP_FAILED) file_error(filename);
+
+    weights_map_header header;
+    if(r.size < sizeof(header)) r.error = 1;
+    else memcpy(&header, r.base, sizeof(header));
+    if(r.error || header.version != WEIGHTS_MAP_VERSION || header.alignment != WEIGHTS_MAP_ALIGNMENT){
+        fprintf(stderr, "Unsupported mapped weights file %s\n", filename);
+        exit(-1);
+    }
+    *net->seen = header.seen;
+    r.offset = sizeof(header);
+    /* arrays of the layers before start are passed over without being mapped */
+    r.skip = 1;
+    map_weight_arrays(net, 0, start, point_to_mapped_array, &r);
+    r.skip = 0;
+    map_weight_arrays(net, start, cutoff, point_to_mapped_array, &r);
+    if(r.error){
+        fprintf(stderr, "Mapped weights file %s does not match the network\n", filename);
+        exit(-1);
+    }
+    net->weights_map = r.base;
+    net->weights_map_size = r.size;
+#ifdef GPU
+    int i;
+    for(i = start; i < net->n && i < cutoff; ++i){
+        layer l = net->layers[i];
+        if(gpu_index < 0) break;
+        if(l.type == CONVOLUTIONAL || l.type == DECONVOLUTIONAL) push_convolutional_layer(l);
+        if(l.type == CONNECTED) push_connected_layer(l);
+        if(l.type == BATCHNORM) push_batchnorm_layer(l);
+        if(l.type == LOCAL) push_local_layer(l);
+    }
+#endif
+    fprintf(stderr, "Mapped weights from %s\n", filename);
+}
+
+void free_mapped_weights(network *net)
+{
+    if(!net->weights_map) return;
+    weights_map_reader r = {0};
+    r.base = net->weights_map;
+    r.size = net->weights_map_size;
+    map_weight_arrays(net, 0, net->n, unmap_array, &r);
+    munmap(net->weights_map, net->weights_map_size);
+    net->weights_map = 0;
+    net->weights_map_size = 0;
+}
+
+
 void load_weights_upto(network *net, const char *filename, int start, int cutoff)
 {
 #ifdef GPU
@@ -1108,6 +1356,12 @@ void load_weights_upto(network *net, const char *filename, int start, int cutoff
     int minor;
     int revision;
     fread(&major, sizeof(int), 1, fp);
+    if ((uint32_t)major == WEIGHTS_MAP_MAGIC){
+        fclose(fp);
+        fprintf(stderr, "\n");
+        load_weights_mapped(net, filename, start, cutoff);
+        return;
+    }
     fread(&minor, sizeof(int), 1, fp);
     fread(&revision, sizeof(int), 1, fp);
     if ((major*10 + minor) >= 2 && major < 1000 && minor < 1000){
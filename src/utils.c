@@ -7,6 +7,9 @@
 #include <float.h>
 #include <limits.h>
 #include <time.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 #include "utils.h"
 
@@ -334,6 +337,14 @@ void free_ptr(void *ptr)
     free(ptr);
 }
 
+/* Sets the OpenMP thread count for parallel regions started by the calling thread */
+void set_num_threads(int n)
+{
+#ifdef _OPENMP
+    omp_set_num_threads(n);
+#endif
+}
+
 char *fgetl(FILE *fp)
 {
     if(feof(fp)) return 0;